@@ -1,11 +1,27 @@
-from flask import Flask, make_response
+import base64
+import time
+
+from flask import Flask, Response, make_response, request
 
 from apps import associated_press as ap
+from utils import inventory
+from utils.exceptions import ProfilerActiveException
+from utils.freshness import freshness_report
+from utils.json_codec import codec
 from utils.logger import get_logger
+from utils.settings import get_settings
 
 logger = get_logger()
 app = Flask(__name__)
 
+# the longest /api/debug/profile holds its request open
+MAX_PROFILE_SECONDS = 300
+# rows per page of /api/ap/inventory, and per query of /api/ap/inventory.ndjson
+DEFAULT_INVENTORY_PAGE = 100
+MAX_INVENTORY_PAGE = 1000
+INVENTORY_EXPORT_BATCH = 1000
+INVENTORY_COLUMNS = ["source_id", "arc_id", "ap_url", "arc_type", "sha1", "updated_at"]
+
 
 @app.route("/api/health", methods=["GET"])
 def health():
@@ -40,5 +56,116 @@ def handle_ap_wire():
     return res
 
 
+@app.route("/api/ap/freshness", methods=["GET"])
+def handle_ap_freshness():
+    # p50/p95/p99 seconds from ap publishing an item to it landing in arc, per arc type
+    hours = request.args.get("hours", default=24, type=float)
+    arc_type = request.args.get("type", default=None)
+    conn = inventory.create_connection(get_settings().sqldb_location)
+    inventory.create_table(conn)
+    report = freshness_report(conn, hours, arc_type)
+    conn.close()
+    return make_response({"hours": hours, "freshness": report})
+
+
+def encode_cursor(key: tuple):
+    return base64.urlsafe_b64encode(codec.dumps(list(key))).decode()
+
+
+def decode_cursor(cursor: str, order: str):
+    """the page key of a cursor from encode_cursor, raises ValueError for anything else"""
+    key = codec.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(key, list) or len(key) != len(inventory.INVENTORY_PAGE_KEYS[order]):
+        raise ValueError(f"not a cursor of the {order} order")
+    return tuple(key)
+
+
+def inventory_query():
+    """the order, filters and cursor of an inventory request, raises ValueError for ones it can not follow"""
+    since = request.args.get("since", default=None, type=float)
+    until = request.args.get("until", default=None, type=float)
+    # a time range walks the updated_at index in order, rather than the whole primary key
+    order = request.args.get("order", default="source_id" if since is None and until is None else "updated_at")
+    if order not in inventory.INVENTORY_PAGE_KEYS:
+        raise ValueError(f"order is one of {', '.join(inventory.INVENTORY_PAGE_KEYS)}")
+    after = request.args.get("after", default=None)
+    return {
+        "order": order,
+        "after": decode_cursor(after, order) if after else None,
+        "arc_type": request.args.get("type", default=None),
+        "since": since,
+        "until": until,
+        "sha1": request.args.get("sha1", default=None),
+        "source_id": request.args.get("source_id", default=None),
+    }
+
+
+@app.route("/api/ap/inventory", methods=["GET"])
+def handle_ap_inventory():
+    # a page of inventory rows and the cursor of the next page, pass it back as after. see select_inventory_page
+    try:
+        query = inventory_query()
+    except ValueError as e:
+        return make_response({"message": str(e)}, 400)
+    limit = min(max(request.args.get("limit", default=DEFAULT_INVENTORY_PAGE, type=int), 1), MAX_INVENTORY_PAGE)
+    conn = inventory.create_connection(get_settings().sqldb_location)
+    inventory.create_table(conn)
+    rows = inventory.select_inventory_page(conn, limit, **query)
+    conn.close()
+    # only a full page can have more rows after it
+    after = encode_cursor(inventory.inventory_page_key(rows[-1], query["order"])) if len(rows) == limit else None
+    return make_response({"rows": [dict(zip(INVENTORY_COLUMNS, row)) for row in rows], "next": after})
+
+
+@app.route("/api/ap/inventory.ndjson", methods=["GET"])
+def handle_ap_inventory_export():
+    # every inventory row the filters match, or the first limit of them, one json object per line. the rows are read
+    # and sent a page at a time, each page its own query, so the export neither holds the inventory in memory nor
+    # holds a read lock that the ingest's inserts would wait on
+    try:
+        query = inventory_query()
+    except ValueError as e:
+        return make_response({"message": str(e)}, 400)
+    limit = request.args.get("limit", default=None, type=int)
+
+    def lines():
+        conn = inventory.create_connection(get_settings().sqldb_location)
+        inventory.create_table(conn)
+        after, remaining = query["after"], limit
+        try:
+            while remaining is None or remaining > 0:
+                batch = INVENTORY_EXPORT_BATCH if remaining is None else min(INVENTORY_EXPORT_BATCH, remaining)
+                rows = inventory.select_inventory_page(conn, batch, **{**query, "after": after})
+                for row in rows:
+                    yield codec.dumps(dict(zip(INVENTORY_COLUMNS, row))) + b"\n"
+                if len(rows) < batch:
+                    break
+                after = inventory.inventory_page_key(rows[-1], query["order"])
+                if remaining is not None:
+                    remaining -= len(rows)
+        finally:
+            conn.close()
+
+    return Response(lines(), mimetype="application/x-ndjson")
+
+
+@app.route("/api/debug/profile", methods=["GET"])
+def handle_debug_profile():
+    # profiles whatever the server does in the next seconds, e.g. an /api/ap run started from another tab,
+    # and returns the per stage report. see apps/associated_press/profiling.py
+    from apps.associated_press.profiling import profiler_from_config
+
+    seconds = min(max(request.args.get("seconds", default=10, type=float), 0), MAX_PROFILE_SECONDS)
+    try:
+        profiler = profiler_from_config().start()
+    except ProfilerActiveException as e:
+        return make_response({"message": str(e)}, 409)
+    try:
+        time.sleep(seconds)
+    finally:
+        report = profiler.stop()
+    return make_response({"seconds": seconds, "profile": report})
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080, debug=True, threaded=True)
@@ -1,50 +1,101 @@
 # http://api.ap.org/media/v/docs/Feed_Examples.htm
 # http://api.ap.org/media/v/docs/Getting_Content_Updates.htm
-import json
-import arrow
+import time
 from http import HTTPStatus
-from typing import Optional
 from sqlite3 import connect
+from threading import Event
+from typing import Optional
 
 import requests
-from decouple import config
-from jmespath import search
+from decouple import UndefinedValueError
 from ratelimit import limits, sleep_and_retry
-from xmltodict import parse
 
-from apps.associated_press.converter import APPhotoConverter, APStoryConverter
+from apps.associated_press.admission import AdmissionController, admission_from_config
+from apps.associated_press.converter import APPhotoConverter, APStoryConverter, convert_photo_batch
+from apps.associated_press.feed_query import FEED_URL, estimate_bytes_saved, feed_query_from_settings
+from apps.associated_press.relay import relay_images
+from apps.associated_press.send_policy import is_unavailable, migration_center
+from apps.associated_press.send_queue import SendQueue
 from utils import inventory
-from utils.constants import AP_ASSOCIATIONS_JMESPATH_STR, AP_RESULTS_JMESPATH_STR, MIGRATION_CENTER_ANS_URL, PHOTO_API_URL
+from utils.archive import ans_digest, get_archive
+from utils.constants import (
+    AP_ASSOCIATIONS_JMESPATH_STR,
+    AP_RESULTS_JMESPATH_STR,
+    MIGRATION_CENTER_ANS_URL,
+    PHOTO_API_URL,
+    PHOTO_RATE_LIMIT_CALLS,
+    RATE_LIMIT_PERIOD,
+    STORY_RATE_LIMIT_CALLS,
+)
 from utils.exceptions import IncompleteWirePhotoException, IncompleteWireStoryException, WireExistsInArcException
+from utils.json_codec import codec
+from utils.json_stream import JsonStream
+from utils.lazy import lazy_module
 from utils.logger import get_logger
+from utils.settings import get_settings
+from utils.staging import staging_store_from_config
+from utils.tracing import current_span, start_trace
+
+# imported on first use, see utils/lazy.py
+jmespath = lazy_module("jmespath")
+xmltodict = lazy_module("xmltodict")
 
 logger = get_logger()
 
+# a streamed feed page is read element by element out of data.items, see utils/json_stream.py
+FEED_ITEMS_PATH = ("data", "items")
+FEED_CAPTURE_PATHS = [("data", "next_page"), ("params", "seq"), ("data", "item")]
+FEED_ITEM_PROJECTION = AP_RESULTS_JMESPATH_STR.replace("data.items[*].", "", 1)
+FEED_STREAM_CHUNK_BYTES = 64 * 1024
+
+
 def ap_headers():
     # AP Media API docs recommend using x-api-key header
-    return {"x-api-key": config("AP_API_KEY")}
+    return {"x-api-key": get_settings().ap_api_key}
 
 
 def fetch_feed(next_page: Optional[str] = None):
-    url = "https://api.ap.org/media/v/content/feed"
-    params = {}
-    q = config("AP_QUERY", None)
+    items, _ = fetch_feed_page(next_page)
+    return items
+
+
+def fetch_feed_page(next_page: Optional[str] = None, query: Optional[str] = None):
+    """fetch one page of the feed, returning its items and the next_page url that continues the feed's sequence.
+    a named feed passes its own query, see apps/associated_press/feeds.py, otherwise AP_QUERY is used.
+    the type, pricing and field filters of the first request are built from settings, see feed_query.py"""
+    url = FEED_URL
+    feed_query = feed_query_from_settings(query)
     items = None
     if next_page:
         url = next_page
-    elif q:
-        params["q"] = q
-        logger.info("Associated Press Query Param", extra={"q": q})
+    else:
+        params = feed_query.params()
+        logger.info("Associated Press Query Param", extra=params)
+    settings = get_settings()
+    streaming = settings.ap_feed_streaming
     if next_page:
         # next_page URL already contains the necessary query params
-        res = requests.get(url, headers=ap_headers())
+        res = requests.get(url, headers=ap_headers(), stream=streaming)
     else:
-        res = requests.get(url, params=params, headers=ap_headers())
+        res = requests.get(url, params=params, headers=ap_headers(), stream=streaming)
     if res.ok:
-        data = res.json()
-        next_page = search("data.next_page", data) or None
-        previous_sequence = search("params.seq", data) or None
+        if streaming:
+            data, items, size = read_feed_stream(res)
+        else:
+            data = res.json()
+            # select relevant data from the results
+            items = jmespath.search(AP_RESULTS_JMESPATH_STR, data)
+            size = len(res.content or b"")
+        next_page = jmespath.search("data.next_page", data) or None
+        previous_sequence = jmespath.search("params.seq", data) or None
         sequence = next_page.split("seq=")[-1] if next_page else None
+        # items the server side filters should have kept out, a steady count means a filter is missing
+        unusable = sum(1 for item in items if feed_query.unusable(item)) if items else 0
+        # a single item response is not a feed page, there is nothing filtered to compare it with
+        usable = len(items) - unusable if items is not None else None
+        bytes_saved = (
+            estimate_bytes_saved(size, usable, settings.ap_feed_baseline_bytes_per_item) if usable is not None else None
+        )
 
         # initial intent was to log the sequence ids in the db in case was  useful info when tracing back this task's runs. decided not to log in db.
         logger.info(
@@ -53,20 +104,21 @@ def fetch_feed(next_page: Optional[str] = None):
                 "previous_sequence": previous_sequence,
                 "sequence": sequence,
                 "next_page": next_page,
+                "bytes": size,
+                "items": len(items) if items else 0,
+                "unusable_items": unusable,
+                "bytes_saved": bytes_saved,
             },
         )
 
-        # select relevant data from the results
-        items = search(AP_RESULTS_JMESPATH_STR, data)
-
         # when using next_page variable, the request might bring back a single item rather than an array of items
         # single item result happens when a story has photo "associations" and you're fetching an item of photo data
         # requires a different structure to the jmespath search string
         if items is None:
             # do not process ap images that incur cost
-            priced = search("data.item.renditions.main.priced || data.item.renditions.main.pricetag", data)
+            priced = jmespath.search("data.item.renditions.main.priced || data.item.renditions.main.pricetag", data)
             if priced in ["Unlimited", False, None, "false"]:
-                items = search(AP_ASSOCIATIONS_JMESPATH_STR, data)
+                items = jmespath.search(AP_ASSOCIATIONS_JMESPATH_STR, data)
             else:
                 logger.warning(
                     "Picture excluded because it would incur cost",
@@ -75,7 +127,37 @@ def fetch_feed(next_page: Optional[str] = None):
     else:
         logger.error(f"{res.status_code} {url}")
         next_page = sequence = previous_sequence = None
-    return items
+    return items, next_page
+
+
+def iter_feed_stream(stream: JsonStream):
+    """the projected items of a streamed feed page, one at a time. each element of data.items is projected as
+    AP_RESULTS_JMESPATH_STR projects the whole page, and dropped before the next one is read"""
+    expression = jmespath.compile(FEED_ITEM_PROJECTION)
+    for element in stream:
+        item = expression.search(element)
+        if item is not None:
+            yield item
+
+
+def read_feed_stream(res):
+    """a feed page read from the response stream, as (data, items, bytes). data only holds the values read besides the
+    items: data.next_page, params.seq, and data.item when the url was a single item. items is None when the page had
+    no data.items, as it is when the whole page is parsed"""
+    stream = JsonStream(res.iter_content(FEED_STREAM_CHUNK_BYTES), FEED_ITEMS_PATH, FEED_CAPTURE_PATHS)
+    try:
+        # the projected items are kept in a list rather than handed to build_wires as they are parsed. build_wires
+        # fetches a story's xml for every item and process_wires waits on the rate limits, so the ap response would be
+        # held open for minutes and could time out halfway through the page. the callers also need the page's
+        # next_page and item count before anything is checkpointed or offered. what streaming saves is the raw page and
+        # its whole parsed tree, which are many times the size of the projected items
+        items = list(iter_feed_stream(stream))
+    finally:
+        res.close()
+    data = {}
+    for path, value in stream.captured.items():
+        data.setdefault(path[0], {})[path[1]] = value
+    return data, items if stream.found else None, stream.bytes
 
 
 def fetch_story_item(url: str, item: dict):
@@ -83,31 +165,42 @@ def fetch_story_item(url: str, item: dict):
     # Also Convert the XML to JSON and add to source data. Will use this to compute the sha1.
     res = requests.get(url, headers=ap_headers())
     if res.ok:
-        data = parse(res.content).get("nitf", {})
-        data = json.loads(json.dumps(data))
-        item["content_json"] = data
-        converter = APStoryConverter(
-            item,
-            org_name=config("ARC_ORG_ID"),
-            website=config("ARC_ORG_WEBSITE"),
-            section=config("ARC_WEBSITE_SECTION"),
-            story_data=res.content,
-        )
-        return converter
+        return story_converter(item, res.content)
+
+
+def story_converter(item: dict, story_data: bytes):
+    """the converter for a feed item and its downloaded or archived story xml"""
+    data = xmltodict.parse(story_data).get("nitf", {})
+    # plain dicts in place of xmltodict's OrderedDicts
+    data = codec.loads(codec.dumps(data))
+    item["content_json"] = data
+    settings = get_settings()
+    converter = APStoryConverter(
+        item,
+        org_name=settings.arc_org_id,
+        website=settings.arc_org_website,
+        section=settings.arc_website_section,
+        story_data=story_data,
+    )
+    return converter
 
 
 def fetch_photo_item(item: dict):
     # AP Photos don't need more info than what comes via the feed/query initial request
     # to be parsed, so not querying the full photo url for additional data
-    converter = APPhotoConverter(item, org_name=config("ARC_ORG_ID"))
+    converter = APPhotoConverter(item, org_name=get_settings().arc_org_id)
     return converter
 
 
-def bearer_token():
-    if "sandbox." in config("ARC_ORG_ID"):
-        token = config("ARC_TOKEN_SANDBOX")
-    else:
-        token = config("ARC_TOKEN_PRODUCTION")
+def bearer_token(token: str = None):
+    # a fan-out target brings its own token, see apps/associated_press/fanout.py
+    if token is None:
+        settings = get_settings()
+        token = settings.arc_token
+        if token is None:
+            raise UndefinedValueError(
+                f"{settings.arc_token_name} not found. Declare it as envvar or define a default value."
+            )
 
     # Draft API requests require Arc-Priority header to route traffic to appropriate lane
     # request header Arc-Priority: ingestion ... events routed with lower priority.
@@ -122,11 +215,45 @@ def bearer_token():
     return {"Authorization": f"Bearer {token}", "Content-Type": "application/json", "Arc-Priority": priority_header}
 
 
+def send_policy(target=None):
+    """the retries and circuit breaker for migration center sends, a fan-out target has its own"""
+    return target.send_policy if target is not None else migration_center
+
+
+# every attempt at a migration center send, a retry as much as the first, takes one of its lane's rate limited calls.
+# a fan-out target has lanes of its own
 @sleep_and_retry
-@limits(calls=2, period=60)
-def process_wire_story(converter: APStoryConverter, count: str, conn: connect):
+@limits(calls=STORY_RATE_LIMIT_CALLS, period=RATE_LIMIT_PERIOD)
+def story_slot():
+    pass
+
+
+@sleep_and_retry
+@limits(calls=PHOTO_RATE_LIMIT_CALLS, period=RATE_LIMIT_PERIOD)
+def photo_slot():
+    pass
+
+
+def timed_slot(slot, span):
+    """slot, with each wait for it traced as a rate_limit_wait span"""
+
+    def wait():
+        with span.child("rate_limit_wait"):
+            slot()
+
+    return wait
+
+
+def send_failed(e: Exception):
+    """what process_wire_story and process_wire_photo return for a send that failed: SERVICE_UNAVAILABLE when arc could
+    not take the wire, see is_unavailable, so process_wires puts it back in line, otherwise the error"""
+    return HTTPStatus.SERVICE_UNAVAILABLE if is_unavailable(e) else str(e)
+
+
+def process_wire_story(converter: APStoryConverter, count: str, conn: connect, resend: bool = False, target=None):
     # apply converter to transform source into ans, send ans into migration center, inventory on success
     logger.info(f"{count} {converter}")
+    span = current_span()
     ans = None
     # a circulation is not required, but circulating wires to a section makes it easier to filter for wires in composer
     # without circulating to a section, you can still filter in Composer for the only stories belonging to the wire
@@ -136,20 +263,24 @@ def process_wire_story(converter: APStoryConverter, count: str, conn: connect):
     # a content operation is not required, but this POC will demonstrate how to send a future publishing operation
     # the content operation we are sending will delete the wire content once it has aged and become stale
     operation = None
-    org = config("ARC_ORG_ID")
+    org = target.org if target else get_settings().arc_org_id
     logger.info("GENERATE ANS & CIRCULATION & OPERATION")
     try:
-        ans = converter.convert_ans()
+        with span.child("convert"):
+            ans = converter.convert_ans()
+        converter.mark("converted")
         circulation = converter.get_circulation()
         operation = converter.get_scheduled_delete_operation()
         # this POC will enforce circulations and operations data in addition to the ans
         if ans is None or circulation is None or operation is None:
             raise IncompleteWireStoryException
 
-        logger.info("CHECK INVENTORY - DOES SAME SHA1 EXIST?")
-        sha1 = inventory.select_inventory_by_sha1(conn, ans.get("additional_properties").get("sha1"))
-        if sha1:
-            raise WireExistsInArcException
+        # a reconverted item is resent even though its source is unchanged, because its conversion is not
+        if not resend:
+            logger.info("CHECK INVENTORY - DOES SAME SHA1 EXIST?")
+            sha1 = inventory.select_inventory_by_sha1(conn, ans.get("additional_properties").get("sha1"))
+            if sha1:
+                raise WireExistsInArcException
 
     except Exception as e:
         logger.error(e, extra={"ans": ans is not None, "circulation": circulation is not None, "operation": operation is not None})
@@ -161,55 +292,83 @@ def process_wire_story(converter: APStoryConverter, count: str, conn: connect):
         "source_id": ans.get("source").get("source_id"),
         "headline": ans.get("headlines").get("basic"),
     }
+    body = None
     try:
         payload = {
             "ANS": ans,
             "circulations": [circulation],
             "operations": [operation],
         }
-        params = {"website": config("ARC_ORG_WEBSITE")}
-        res = requests.post(MIGRATION_CENTER_ANS_URL.format(org=org), params=params, json=payload, headers=bearer_token())
-        res.raise_for_status()
+        # encoded once, the same bytes are sent and, on a failure, logged
+        body = codec.dumps(payload)
+        extra["payload_bytes"] = len(body)
+        params = {"website": target.website if target else get_settings().arc_org_website}
+        with span.child(
+            "migration_center_post", arc_id=extra["arc_id"], source_id=extra["source_id"], payload_bytes=len(body)
+        ):
+            send_policy(target).post(
+                MIGRATION_CENTER_ANS_URL.format(org=org),
+                slot=timed_slot(target.story_slot if target else story_slot, span),
+                params=params,
+                data=body,
+                headers=bearer_token(target and target.token),
+            )
+        converter.mark("sent")
     except Exception as e:
         logger.error(e, extra=extra)
-        if "res" in locals():
+        if body is not None:
+            logger.debug("Migration Center payload", extra={**extra, "payload": body.decode("utf-8")})
+        res = getattr(e, "response", None)
+        if res is not None:
             # Migration Center error responses are typically JSON with an error_message or errors array
             try:
                 logger.error(res.json(), extra=extra)
             except Exception:
                 logger.error("Migration Center error without JSON body", extra=extra)
-        return str(e)
+        return send_failed(e)
 
-    logger.info("SAVE INVENTORY")
+    # the size of what was sent is only known once the ans is encoded, so it is logged here and not at conversion
+    logger.info("SAVE INVENTORY", extra={**extra, "sha1": ans.get("additional_properties").get("sha1")})
     inv_item = (
         ans.get("source").get("source_id"),
         ans.get("_id"),
         ans.get("additional_properties").get("ap_item_url"),
         ans.get("type"),
         ans.get("additional_properties").get("sha1"),
-        arrow.utcnow().format("YYYY-MM-DD HH:MM:SS.SSS"),
+        time.time(),
     )
     inventory.create_inventory(conn, inv_item)
+    converter.mark("inventoried")
+    inventory.create_freshness(conn, converter.get_freshness(ans.get("type")))
+    # the archive keeps the digest of the single org ans, a fan-out target's ans has its own arc ids
+    archive = get_archive() if target is None else None
+    if archive is not None:
+        archive.mark_sent(
+            ans.get("source").get("source_id"), converter.source_data.get("versioncreated"), ans_digest(ans)
+        )
     return HTTPStatus.CREATED
 
 
-@sleep_and_retry
-@limits(calls=5, period=60)
-def process_wire_photo(converter: APPhotoConverter, count: str, conn: connect):
+def process_wire_photo(converter: APPhotoConverter, count: str, conn: connect, resend: bool = False, target=None):
     # apply converter to transform source into ans, send ans into migration center, inventory on success
     logger.info(f"{count} {converter}")
+    span = current_span()
     ans = None
     sha1 = None
     logger.info("GENERATE ANS")
     try:
-        ans = converter.convert_ans()
+        with span.child("convert"):
+            ans = converter.convert_ans()
+        converter.mark("converted")
         if ans is None:
             raise IncompleteWirePhotoException
 
-        logger.info("CHECK INVENTORY - DOES SAME SHA1 EXIST?")
-        sha1 = inventory.select_inventory_by_sha1(conn, ans.get("additional_properties").get("sha1"))
-        if sha1:
-            raise WireExistsInArcException
+        # a reconverted item is resent even though its source is unchanged, because its conversion is not
+        if not resend:
+            logger.info("CHECK INVENTORY - DOES SAME SHA1 EXIST?")
+            sha1 = inventory.select_inventory_by_sha1(conn, ans.get("additional_properties").get("sha1"))
+            if sha1:
+                raise WireExistsInArcException
 
     except Exception as e:
         logger.error(e, extra={"ans": ans is not None, "sha1": sha1})
@@ -224,99 +383,296 @@ def process_wire_photo(converter: APPhotoConverter, count: str, conn: connect):
     }
     # Associated Press API requires the apikey to be passed in the header, but
     # You can't send headers to migration center or photo center api for them to pass along when they process the download
-    # So these calls will fail to load images into photo center, but leaving this here to show how it would work if it could
-    # One way to get these images would be to add another layer, and alter the code to do an HTTP GET to
-    # download and send the AP image to a public S3 bucket and giving it a new URL, then send that URL in the
-    # Image's ANS to Migration Center or Photo Center.
-    # You'd then want a seperate process to clean S3 and remove the image only after you have verified that it did make it through to Photo Center.
-    logger.info("AP APIKEY REQUEST HEADERS CANNOT BE ADDED TO MC or PC API, MISSING WHEN PHOTO CENTER ATTEMPTS AP DOWNLOAD, AP PHOTO NOT IMPORTED TO ARC XP")
+    # So unless the image was relayed, these calls will fail to load images into photo center.
+    # When AP_IMAGE_STAGING is set, process_wires() has already done an HTTP GET to download the AP image into a
+    # staging store you control (see apps/associated_press/relay.py), and the image's ANS is sent with that new URL.
+    # You'd then want a seperate process to clean the staging store and remove the image only after you have verified that it did make it through to Photo Center.
+    # the archive keeps the digest of the single org ans, a fan-out target's ans has its own arc ids. it is taken from the
+    # ans as converted, before a staged url replaces the ap one, so reconvert.py compares like with like
+    archive = get_archive() if target is None else None
+    digest = ans_digest(ans) if archive is not None else None
+    if converter.staged_url:
+        ans["additional_properties"]["originalUrl"] = converter.staged_url
+        logger.info(
+            "AP PHOTO RELAYED TO STAGING STORE, SENDING STAGED URL", extra={**extra, "staged_url": converter.staged_url}
+        )
+    else:
+        logger.info(
+            "AP APIKEY REQUEST HEADERS CANNOT BE ADDED TO MC or PC API, MISSING WHEN PHOTO CENTER ATTEMPTS AP DOWNLOAD, AP PHOTO NOT IMPORTED TO ARC XP"
+        )
 
+    body = None
     try:
-        payload = {"ANS": ans}
-        params = {"website": config("ARC_ORG_WEBSITE")}
-        res = requests.post(
-            MIGRATION_CENTER_ANS_URL.format(org=config("ARC_ORG_ID")), params=params, json=payload, headers=bearer_token()
-        )
-        res.raise_for_status()
+        # encoded once, the same bytes are sent and, on a failure, logged
+        body = codec.dumps({"ANS": ans})
+        extra["payload_bytes"] = len(body)
+        params = {"website": target.website if target else get_settings().arc_org_website}
+        org = target.org if target else get_settings().arc_org_id
+        with span.child(
+            "migration_center_post", arc_id=extra["arc_id"], source_id=extra["source_id"], payload_bytes=len(body)
+        ):
+            send_policy(target).post(
+                MIGRATION_CENTER_ANS_URL.format(org=org),
+                slot=timed_slot(target.photo_slot if target else photo_slot, span),
+                params=params,
+                data=body,
+                headers=bearer_token(target and target.token),
+            )
+        converter.mark("sent")
 
     except Exception as e:
         logger.error(e, extra=extra)
-        if "res" in locals():
+        if body is not None:
+            logger.debug("Migration Center payload", extra={**extra, "payload": body.decode("utf-8")})
+        res = getattr(e, "response", None)
+        if res is not None:
             try:
                 logger.error(res.json(), extra=extra)
             except Exception:
                 logger.error("Migration Center error without JSON body", extra=extra)
-        return str(e)
+        return send_failed(e)
 
-    logger.info("SAVE INVENTORY")
+    # the size of what was sent is only known once the ans is encoded, so it is logged here and not at conversion
+    logger.info("SAVE INVENTORY", extra={**extra, "sha1": ans.get("additional_properties").get("sha1")})
     inv_item = (
         ans.get("source").get("source_id"),
         ans.get("_id"),
         ans.get("additional_properties").get("ap_item_url"),
         ans.get("type"),
         ans.get("additional_properties").get("sha1"),
-        arrow.utcnow().format("YYYY-MM-DD HH:MM:SS.SSS"),
+        time.time(),
     )
     inventory.create_inventory(conn, inv_item)
+    converter.mark("inventoried")
+    inventory.create_freshness(conn, converter.get_freshness(ans.get("type")))
+    if archive is not None:
+        archive.mark_sent(ans.get("source").get("source_id"), converter.source_data.get("versioncreated"), digest)
     return HTTPStatus.CREATED
 
 
-def process_wires(converters: list):
+# times one call of process_wires puts a wire back in line after arc could not take it
+MAX_REQUEUES = 3
+
+
+def stage_images(photos: list, conn: connect, store):
+    """relay the images of the photo converters into the staging store, so their ans is sent with the staged url.
+    returns the converters staged"""
+    staged = relay_images(photos, store, ap_headers(), get_settings().image_relay_concurrency)
+    # recorded as soon as they are staged, so the reconciler never evicts an image that is still waiting to be sent
+    now = time.time()
+    first_check = now + get_settings().staging_recheck_seconds
+    staged_images = [
+        (
+            c.staged_key,
+            c.get_arc_id(c.source_data.get("source_id")),
+            c.source_data.get("source_id"),
+            c.staged_size,
+            now,
+            first_check,
+        )
+        for c in staged
+    ]
+    inventory.create_staged_images(conn, staged_images)
+    return staged
+
+
+def process_wires(
+    converters: list,
+    conn: connect = None,
+    stop: Event = None,
+    queue: SendQueue = None,
+    deadline: Optional[float] = None,
+    admission: AdmissionController = None,
+    store=None,
+    target=None,
+):
     """This will send each wire item into the correct downstream system.
-    There is no automatic retry or backoff, except if caused by the rate limiting.
-    If one step errors, the error will be logged and the individual item's progress will be halted.
-    The next item in the list will still process.
+    A send that failed because of arc (a timeout, a dropped connection, a 5xx or a 429) is retried with backoff, see
+    apps/associated_press/send_policy.py, and each attempt waits for its own rate limited call.
+    When the retries run out, or the circuit breaker refused the send, the wire goes back in the queue, at most
+    MAX_REQUEUES times a call, and once the breaker is open no more wires are sent until its cooldown has passed.
+    Any other error is logged and halts that item alone, the next item in the list will still process.
     Only fully successful items are inventoried.
+    Wires pass through a SendQueue first, which sends the most urgent wires first and sends repeated versions of one
+    source_id only once. An AdmissionController drops or defers the wires that a backlog would deliver expired or stale.
+    When a staging store is configured, the queued photos are relayed into it before anything is sent.
+    A long-running caller may pass in its own open connection, which is left open, an event that halts the loop, and
+    its own queue, which keeps held and unsent wires for the next call once the monotonic deadline passes.
+    A fan-out target sends the wires to its own org and website, within its own rate limits.
+    Returns the wires not sent that no queue keeps: the ones put back too often and, when the caller passed no queue,
+    the ones still in line, so the caller can give them back to the feed.
     """
+    owns_conn = conn is None
+    flush = queue is None
+    if flush:
+        queue = SendQueue()
     converters = list(filter(None, converters))
-    conn = inventory.create_connection(config("SQLDB_LOCATION", ":memory:"))
-    inventory.create_table(conn)
-    for index, converter in enumerate(converters):
-        count = f"{index + 1} of {len(converters)}"
-        if isinstance(converter, APStoryConverter):
-            process_wire_story(converter, count, conn)
-        elif isinstance(converter, APPhotoConverter):
-            process_wire_photo(converter, count, conn)
-    conn.close()
-
-
-def run_ap_ingest_wires():
+    for converter in converters:
+        converter.mark("queued")
+    queue.extend(converters)
+    if admission is None:
+        admission = admission_from_config()
+    admission.review(queue)
+    # the photos admitted are converted as one batch, process_wire_photo then sends the ans already converted
+    convert_photo_batch(list(queue))
+    if store is None:
+        store = target.store if target is not None else staging_store_from_config()
+    if owns_conn:
+        conn = inventory.create_connection(get_settings().sqldb_location)
+        inventory.create_table(conn)
+    if store is not None:
+        # relay only the images that will actually be sent, a photo with an unchanged sha1 is never sent
+        photos = [
+            c
+            for c in queue
+            if isinstance(c, APPhotoConverter) and not inventory.select_inventory_by_sha1(conn, c.get_sha1())
+        ]
+        stage_images(photos, conn, store)
+
+    total = len(queue)
+    sent = 0
+    breaker = send_policy(target).breaker
+    requeued, gave_up = {}, []
+    while True:
+        if stop is not None and stop.is_set():
+            logger.warning("Stop requested, remaining wires not sent", extra={"remaining": len(queue)})
+            break
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        if breaker.is_open:
+            # both lanes wait out the cooldown, the wires stay queued for a caller that keeps its queue
+            logger.warning(
+                "Migration Center circuit open, remaining wires not sent",
+                extra={"remaining": len(queue), **breaker.metrics()},
+            )
+            break
+        converter = queue.pop_ready(flush=flush)
+        if converter is None:
+            break
+        sent += 1
+        count = f"{sent} of {total}"
+        result = None
+        with converter.trace.child("send", count=count) as span:
+            if target is not None:
+                result = target.send(converter, count, conn)
+            elif isinstance(converter, APStoryConverter):
+                result = process_wire_story(converter, count, conn)
+            elif isinstance(converter, APPhotoConverter):
+                result = process_wire_photo(converter, count, conn)
+            span.tag(result=result)
+        if result == HTTPStatus.SERVICE_UNAVAILABLE and requeued.get(id(converter), 0) < MAX_REQUEUES:
+            # the send failed because arc could not take it, not because of the wire, so it goes back in line
+            requeued[id(converter)] = requeued.get(id(converter), 0) + 1
+            queue.put(converter)
+        elif result == HTTPStatus.SERVICE_UNAVAILABLE:
+            gave_up.append(converter)
+            converter.trace.finish(outcome="unavailable")
+        else:
+            converter.trace.finish(outcome="sent" if result == HTTPStatus.CREATED else "failed")
+    if queue.coalesced:
+        logger.info("Wire versions coalesced", extra={"coalesced": queue.coalesced, "queued": len(queue)})
+    logger.info(
+        "Send latency by urgency", extra={"latency": queue.latency_report(), "queued": len(queue), **breaker.metrics()}
+    )
+    if owns_conn:
+        conn.close()
+    unsent = gave_up + (list(queue) if flush else [])
+    if unsent:
+        logger.warning(
+            "Wires not taken by Migration Center",
+            extra={"unsent": len(unsent), "kept_queued": 0 if flush else len(queue)},
+        )
+    return unsent
+
+
+def run_ap_ingest_wires(profile: Optional[bool] = None):
+    # with profile, or AP_PROFILE, the run's stages are profiled and reported, see apps/associated_press/profiling.py
+    if profile is None:
+        profile = get_settings().ap_profile
+    if profile:
+        from apps.associated_press.profiling import profiled
+
+        with profiled():
+            return run_ap_ingest_wires(profile=False)
     # fetch items in ap feed
     items = fetch_feed()
+    wires = build_wires(items)
+    process_wires(wires)
+    return wires
+
+
+def record_fetched(converter, seen: float):
+    """record when the item was first seen in the feed and that its data has now been fetched,
+    and archive the raw payloads when AP_ARCHIVE_DIR is set"""
+    if converter is None:
+        return
+    converter.stages["feed_seen"] = seen
+    converter.mark("fetched")
+    archive = get_archive()
+    if archive is not None:
+        item = {key: value for key, value in converter.source_data.items() if key != "content_json"}
+        archive.append(item, converter.story_data, converter.get_arc_type(item.get("type")))
+
+
+def build_wires(items: list):
+    """initialize converters for the feed items, fetching story text and a story's associated photos along the way"""
     wires = []
     # initialize converters for each item in the feed
     for item in items:
+        seen = time.time()
+        # one trace per feed item, a story's photos are traced inside it, see utils/tracing.py
+        trace = start_trace("ap.item", source_id=item.get("source_id"), type=item.get("type"))
         if item.get("type") == "picture":
             # do not process ap images that incur cost
             if item.get("pricetag") in ["Unlimited", "", None]:
                 converter = fetch_photo_item(item)
+                converter.trace = trace
+                record_fetched(converter, seen)
                 wires.append(converter)
             else:
                 logger.warning(
                     "Picture excluded because it would incur cost",
                     extra={"source_id": item.get("source_id"), "priced": item.get("priced"), "pricetag": item.get("pricetag")},
                 )
+                trace.finish(outcome="priced")
         elif item.get("type") == "text":
-            converter = fetch_story_item(item.get("download_url"), item)
+            with trace.child("fetch_story", url=item.get("download_url")):
+                converter = fetch_story_item(item.get("download_url"), item)
+            if converter is None:
+                logger.warning(
+                    "Story fetch failed, story and its photos skipped", extra={"source_id": item.get("source_id")}
+                )
+                trace.finish(outcome="fetch_failed")
+                continue
+            converter.trace = trace
+            record_fetched(converter, seen)
             wires.append(converter)
 
             # if there are pictures associated with the story, add these converters to the wires array
             urls = converter.get_photo_associations_urls()
             for url in urls:
-                item = fetch_feed(url)
+                with trace.child("fetch_association", url=url):
+                    item = fetch_feed(url)
                 converter = fetch_photo_item(item)
+                converter.trace = trace.child("ap.association", url=url)
+                record_fetched(converter, seen)
                 wires.append(converter)
         else:
             # only process text and story wires. videos incur too much cost.
             logger.error(f"Unprocessable wire type: {item.get('type')}")
-
-    process_wires(wires)
+            trace.finish(outcome="unprocessable")
     return wires
 
 
 if __name__ == "__main__":  # pragma: no cover
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ingest the AP feed into Arc once")
+    parser.add_argument(
+        "--profile", action="store_true", default=None, help="profile the run's stages, see profiling.py"
+    )
     # will run the ap feed and ingest content... this is the same as running from the api endpoint
-    run_ap_ingest_wires()
+    run_ap_ingest_wires(parser.parse_args().profile)
 
     # # Will test sending one story to Draft API twice, triggering the POST -> PUT behavior
     # from tests.conftest import get_file_fixture
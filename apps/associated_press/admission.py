@@ -0,0 +1,110 @@
+from collections import Counter
+from typing import Optional
+
+from decouple import config
+
+from apps.associated_press.send_queue import SendQueue
+from utils.constants import EXPIRATION_DAYS, PHOTO_RATE_LIMIT_CALLS, RATE_LIMIT_PERIOD, STORY_RATE_LIMIT_CALLS
+from utils.lazy import lazy_module
+from utils.logger import get_logger
+
+arrow = lazy_module("arrow")
+
+logger = get_logger()
+
+DROP = "drop"
+DEFER = "defer"
+
+
+class AdmissionController:
+    """Decides which queued wires are still worth a rate limited Migration Center call.
+    With a deep queue, the last wire in each lane waits (wires ahead of it / calls per second) before it is sent.
+    A wire whose firstcreated would be older than the expiration horizon by then is dropped, since its scheduled delete
+    operation would remove it soon after it lands. A wire that would be older than max_age is stale news, and is
+    dropped or deferred behind the fresh wires depending on the stale_mode, so the budget goes to fresh news first.
+    """
+
+    def __init__(
+        self, max_age: Optional[float] = None, stale_mode: str = DEFER, expiration_days: float = EXPIRATION_DAYS
+    ):
+        self.max_age = max_age
+        self.stale_mode = stale_mode
+        self.expiration_age = expiration_days * 24 * 60 * 60
+        self.shed = Counter()
+
+    @staticmethod
+    def lane(converter):
+        return "story" if converter.source_data.get("type") == "text" else "photo"
+
+    @staticmethod
+    def seconds_per_call(lane: str):
+        calls = STORY_RATE_LIMIT_CALLS if lane == "story" else PHOTO_RATE_LIMIT_CALLS
+        return RATE_LIMIT_PERIOD / calls
+
+    def drain_seconds(self, queue: SendQueue):
+        """estimated seconds until every wire in the queue has been sent, the lanes send in parallel"""
+        depth = Counter(self.lane(converter) for converter in queue)
+        return max([depth[lane] * self.seconds_per_call(lane) for lane in depth], default=0)
+
+    def age_on_arrival(self, converter, eta: "arrow.Arrow"):
+        firstcreated = converter.source_data.get("firstcreated")
+        if not firstcreated:
+            return None
+        return (eta - arrow.get(firstcreated)).total_seconds()
+
+    def review(self, queue: SendQueue):
+        """drop or defer the queued wires that would arrive expired or stale, returns the counts shed in this review"""
+        now = arrow.utcnow()
+        position = Counter()
+        shed = Counter()
+        deferred = []
+        for converter in queue:
+            lane = self.lane(converter)
+            eta = now.shift(seconds=position[lane] * self.seconds_per_call(lane))
+            age = self.age_on_arrival(converter, eta)
+            reason = None
+            if age is not None and age >= self.expiration_age:
+                reason = "expired"
+            elif age is not None and self.max_age is not None and age >= self.max_age:
+                reason = "stale"
+
+            if reason is None:
+                position[lane] += 1
+                continue
+
+            extra = {"source_id": converter.source_data.get("source_id"), "reason": reason, "age_on_arrival": age}
+            if reason == "stale" and self.stale_mode == DEFER and queue.is_deferred(converter):
+                # deferred by an earlier review, it is only counted and logged once
+                continue
+            if reason == "stale" and self.stale_mode == DEFER:
+                deferred.append(converter)
+                shed["deferred"] += 1
+                logger.info("Wire deferred behind fresh wires", extra=extra)
+            else:
+                queue.remove(converter)
+                converter.trace.finish(outcome=reason)
+                shed[reason] += 1
+                logger.warning("Wire dropped before send", extra=extra)
+
+        for converter in deferred:
+            queue.defer(converter)
+
+        self.shed.update(shed)
+        if shed:
+            logger.info(
+                "Admission review",
+                extra={
+                    "queued": len(queue),
+                    "drain_seconds": self.drain_seconds(queue),
+                    "shed": dict(shed),
+                    "total_shed": dict(self.shed),
+                },
+            )
+        return shed
+
+
+def admission_from_config():
+    return AdmissionController(
+        max_age=config("AP_ADMISSION_MAX_AGE", default=None, cast=lambda v: float(v) if v else None),
+        stale_mode=config("AP_ADMISSION_STALE_MODE", default=DEFER),
+    )
@@ -2,16 +2,28 @@ import copy
 import hashlib
 import json
 import re
-from typing import Optional, Union
-
-import arrow
-from html2ans.default import Html2Ans
-from jmespath import search
-from slugify import slugify
+import time
+from typing import TYPE_CHECKING, Optional, Union
 
 from utils.arc_id import generate_arc_id
+from utils.block_cache import content_cache
+from utils.constants import EXPIRATION_DAYS
 from utils.exceptions import MismatchedContentTypeException
+from utils.freshness import STAGES as FRESHNESS_STAGES
+from utils.json_codec import hash_bytes
+from utils.lazy import lazy_module
 from utils.logger import get_logger
+from utils.tracing import NOOP_SPAN
+
+if TYPE_CHECKING:
+    from html2ans.default import Html2Ans
+
+# imported on first use, see utils/lazy.py. html2ans and bs4 are only needed to convert story bodies
+arrow = lazy_module("arrow")
+bs4 = lazy_module("bs4")
+html2ans_default = lazy_module("html2ans.default")
+jmespath = lazy_module("jmespath")
+slugify = lazy_module("slugify")
 
 logger = get_logger()
 
@@ -27,6 +39,67 @@ class AssociatedPressBaseConverter:
         self.converted_ans = {"version": self.ans_version}
         self.source_data = data
         self.story_data = story_data
+        # epoch seconds this item reached each stage of the ingest, see utils.freshness.STAGES
+        self.stages = {}
+        # where an image relayed into a staging store can be found, see apps/associated_press/relay.py
+        self.staged_key = None
+        self.staged_size = None
+        self.staged_url = None
+        # the converter this one reuses the conversion of, when the item is sent to more than one org, see for_target
+        self.shared = None
+        # converted along with a page of photos, see convert_photo_batch
+        self.batch_converted = False
+        # the item's trace, see utils/tracing.py, given by build_wires when AP_TRACE_FILE is set
+        self.trace = NOOP_SPAN
+
+    def for_target(self, org_name: str, website: str = None, section: str = None):
+        """a converter for another org and website that reuses this converter's conversion of the item.
+        only the fields that depend on the org and website are converted again for each target"""
+        target = copy.copy(self)
+        target.org_name = org_name
+        target.website = website
+        target.section = section
+        target.converted_ans = {"version": self.ans_version}
+        target.stages = dict(self.stages)
+        target.shared = self.shared or self
+        target.batch_converted = False
+        target.trace = self.trace.child("ap.target", org=org_name, website=website)
+        return target
+
+    def org_fields(self):
+        """the parts of the ans that depend on the org"""
+        return {"_id": self.get_arc_id(self.source_data.get("source_id")), "owner": {"id": self.org_name}}
+
+    def convert_shared(self):
+        """the shared converter's ans, converted once, with this converter's org fields"""
+        if "_id" not in self.shared.converted_ans:
+            self.shared.convert_ans()
+        self.converted_ans = copy.deepcopy(self.shared.converted_ans)
+        self.converted_ans.update(self.org_fields())
+        logger.info(
+            "conversion reused for org",
+            extra={
+                "arc_id": self.converted_ans.get("_id"),
+                "source_id": self.source_data.get("source_id"),
+                "org": self.org_name,
+            },
+        )
+        return self.converted_ans
+
+    def mark(self, stage: str):
+        self.stages[stage] = time.time()
+
+    def get_freshness(self, arc_type: str):
+        """the ap_feed_freshness row recording when this version of the item reached each stage"""
+        firstcreated = self.source_data.get("firstcreated")
+        versioncreated = self.source_data.get("versioncreated")
+        return (
+            self.source_data.get("source_id"),
+            versioncreated or "",
+            arc_type,
+            arrow.get(firstcreated).float_timestamp if firstcreated else None,
+            arrow.get(versioncreated).float_timestamp if versioncreated else None,
+        ) + tuple(self.stages.get(stage) for stage in FRESHNESS_STAGES)
 
     def convert_ans(self):
         logger.info(
@@ -38,28 +111,36 @@ class AssociatedPressBaseConverter:
                 "download_url": self.source_data.get("download_url")
             },
         )
-        self.converted_ans.update(
-            {
-                "_id": self.get_arc_id(self.source_data.get("source_id")),
-                "type": self.get_arc_type(self.source_data.get("type")),
-                "owner": {"id": self.org_name},
-                # the ap dates are already in proper format and don't need to be converted to work in arc
-                "publish_date": self.source_data.get("firstcreated"),
-                "display_date": self.source_data.get("firstcreated"),
-                # usually distributor field would reference an exact id value that is stored in the org's Global Settings.
-                # Doing so would change the mapping of the distributor key below.
-                # Change to the proper ans format if using a distributor id.
-                "distributor": {"category": "wires", "name": "Associated Press", "mode": "custom"},
-                "source": {
-                    "name": "Associated Press",
-                    "system": "Associated Press",
-                    "source_id": self.source_data.get("source_id"),
-                },
-                "additional_properties": {},
-            }
-        )
+        self.converted_ans.update(self.base_fields())
         return self.converted_ans
 
+    @staticmethod
+    def constant_fields():
+        """the parts of base_fields that are the same for every wire, which convert_photo_batch builds once a batch"""
+        return {
+            # usually distributor field would reference an exact id value that is stored in the org's Global Settings.
+            # Doing so would change the mapping of the distributor key below.
+            # Change to the proper ans format if using a distributor id.
+            "distributor": {"category": "wires", "name": "Associated Press", "mode": "custom"},
+            "source": {"name": "Associated Press", "system": "Associated Press"},
+        }
+
+    def base_fields(self, constant: dict = None):
+        """the ans fields every wire type shares. a batch passes in the constant_fields it built once, the distributor
+        is then one dict shared by the batch's ans, which nothing changes after conversion"""
+        constant = constant or self.constant_fields()
+        return {
+            "_id": self.get_arc_id(self.source_data.get("source_id")),
+            "type": self.get_arc_type(self.source_data.get("type")),
+            "owner": {"id": self.org_name},
+            # the ap dates are already in proper format and don't need to be converted to work in arc
+            "publish_date": self.source_data.get("firstcreated"),
+            "display_date": self.source_data.get("firstcreated"),
+            "distributor": constant["distributor"],
+            "source": {**constant["source"], "source_id": self.source_data.get("source_id")},
+            "additional_properties": {},
+        }
+
     def get_arc_id(self, source_id: str):
         """arc ids should consist of the content source id and also the arc org id"""
         return generate_arc_id(source_id, self.org_name)
@@ -71,15 +152,21 @@ class AssociatedPressBaseConverter:
 
     @staticmethod
     def get_expiration_date():
-        """generate a date 3 days from today. could be enhanced to have the number of days be an env variable"""
+        """generate a date EXPIRATION_DAYS days from today. could be enhanced to have the number of days be an env variable"""
         return str(
-            arrow.utcnow().shift(days=3).replace(hour=0, minute=0, second=0, microsecond=0).format("YYYY-MM-DDTHH:mm:ss") + "Z"
+            arrow.utcnow()
+            .shift(days=EXPIRATION_DAYS)
+            .replace(hour=0, minute=0, second=0, microsecond=0)
+            .format("YYYY-MM-DDTHH:mm:ss")
+            + "Z"
         )
 
 
 class APStoryConverter(AssociatedPressBaseConverter):
     def convert_ans(self):
         """transform AP Story into Arc ANS"""
+        if self.shared is not None:
+            return self.convert_shared()
         self.converted_ans = super().convert_ans()
         if self.converted_ans["type"] != "story":
             raise MismatchedContentTypeException
@@ -99,6 +186,7 @@ class APStoryConverter(AssociatedPressBaseConverter):
             }
         )
 
+        # a summary, the full ans is only logged at debug level when a send fails, see process_wire_story
         logger.info(
             "text conversion",
             extra={
@@ -106,7 +194,8 @@ class APStoryConverter(AssociatedPressBaseConverter):
                 "source_id": self.source_data.get("source_id"),
                 "headline": self.source_data.get("headline"),
                 "firstcreated": self.source_data.get("firstcreated"),
-                "converted_ans": self.converted_ans,
+                "sha1": self.converted_ans["additional_properties"]["sha1"],
+                "content_elements": len(self.converted_ans["content_elements"]),
             },
         )
 
@@ -138,6 +227,13 @@ class APStoryConverter(AssociatedPressBaseConverter):
         )
         return circulation
 
+    def org_fields(self):
+        return {
+            **super().org_fields(),
+            "canonical_website": self.website,
+            "related_content": {"basic": self.get_photo_associations()},
+        }
+
     def get_scheduled_delete_operation(self):
         """The payload needed to post to the Content Operations API to delete this item x days in future"""
         scheduled_delete = {
@@ -169,12 +265,15 @@ class APStoryConverter(AssociatedPressBaseConverter):
         hash_source.pop("url", None)
         hash_source.pop("priced", None)
         hash_source.pop("pricetag", None)
-        photos = search("associations.*.altids.itemid", hash_source)
+        # urgency only decides the order wires are sent in, and was not part of the hash before it was in the feed projection
+        hash_source.pop("urgency", None)
+        hash_source.pop("editorialpriority", None)
+        photos = jmespath.search("associations.*.altids.itemid", hash_source)
         hash_source["associations"] = photos
         hash_source.get("content_json").pop("@version", None)
         hash_source.get("content_json").pop("@change.date", None)
         hash_source.get("content_json").pop("@change.time", None)
-        source_data_str = json.dumps(hash_source).encode("utf-8")
+        source_data_str = hash_bytes(hash_source)
         logger.info(
             "computing sha1 hash for story",
             extra={
@@ -198,17 +297,17 @@ class APStoryConverter(AssociatedPressBaseConverter):
         return authors
 
     def get_website_url(self, headline: str):
-        return self.section + "/" + slugify(headline)
+        return self.section + "/" + slugify.slugify(headline)
 
     def get_photo_associations_urls(self):
         """return the urls of the photo associations so their full details can be requested"""
         associations = self.source_data.get("associations", None)
-        return search("* | [?type == `picture`].uri", associations) or []
+        return jmespath.search("* | [?type == `picture`].uri", associations) or []
 
     def get_photo_associations(self):
         """write ans references for each of the pictures in a story's associations.
         save original source id in case you need to research in the logs why this image did not import."""
-        ids = search("* | [?type == `picture`].altids.itemid", self.source_data.get("associations")) or []
+        ids = jmespath.search("* | [?type == `picture`].altids.itemid", self.source_data.get("associations")) or []
         ids = [
             {
                 "referent": {
@@ -224,33 +323,74 @@ class APStoryConverter(AssociatedPressBaseConverter):
         return ids
 
     def get_content_elements(self, story_data: bytes):
-        parser = Html2Ans(ans_version=self.ans_version)
+        parser = html2ans_default.Html2Ans(ans_version=self.ans_version)
         parser.WRAPPER_TAGS += ["block"]
         parser.EMPTY_STRINGS += ["\\n"]
-        content_elements = parser.generate_ans(story_data, "body.content")
-        return content_elements
+        if not content_cache.enabled:
+            return parser.generate_ans(story_data, "body.content")
+        soup = bs4.BeautifulSoup(story_data, parser.soup_parse_lib)
+        main_tag = soup.find("body.content")
+        if not main_tag:
+            return parser.generate_ans(story_data, "body.content")
+        # anything that changes what a block parses to is part of its cache key
+        salt = json.dumps(
+            [
+                parser.ans_version,
+                parser.soup_parse_lib,
+                sorted(set(parser.WRAPPER_TAGS)),
+                sorted({str(string) for string in parser.EMPTY_STRINGS}),
+                sorted(set(parser.EMPTY_TAGS)),
+            ]
+        )
+        return self.parse_cached_elements(parser, main_tag.children, salt)
+
+    def parse_cached_elements(self, parser: "Html2Ans", elements, salt: str):
+        """the same walk as Html2Ans._parse_elements, unwrapping wrappers such as <block>, but each element left is looked up
+        in the block cache before it is parsed. the output is identical to parsing the whole body."""
+        output_elements = []
+        for item in elements:
+            if parser.is_empty(item):
+                continue
+            if parser.is_wrapper(item) and isinstance(item, bs4.Tag):
+                output_elements.extend(self.parse_cached_elements(parser, item.children, salt))
+                continue
+            # embed parsers remove the script that follows the embed, so an element followed by a script is always parsed
+            if self.precedes_script(parser, item):
+                output_elements.extend(parser._parse_elements([item]))
+                continue
+            key = content_cache.key(salt, f"{type(item).__name__}\n{item}")
+            cached = content_cache.get(key)
+            if cached is None:
+                cached = parser._parse_elements([item])
+                content_cache.put(key, cached)
+            output_elements.extend(cached)
+        return output_elements
+
+    @staticmethod
+    def precedes_script(parser: "Html2Ans", item):
+        sibling = item.next_sibling
+        while sibling is not None and parser.is_empty(sibling):
+            sibling = sibling.next_sibling
+        return isinstance(sibling, bs4.Tag) and (sibling.name == "script" or sibling.find("script") is not None)
+
+
+# left out of a photo's sha1 because they may change without signaling a substantive change to the actual content.
+# urgency only decides the order wires are sent in, and was not part of the hash before it was in the feed projection
+PHOTO_HASH_EXCLUDED = frozenset(["download_url", "url", "priced", "pricetag", "urgency", "editorialpriority"])
 
 
 class APPhotoConverter(AssociatedPressBaseConverter):
     def convert_ans(self):
         """Transform AP Photo into Arc ANS"""
+        if self.shared is not None:
+            return self.convert_shared()
+        if self.batch_converted:
+            return self.converted_ans
         self.converted_ans = super().convert_ans()
         if self.converted_ans["type"] != "image":
             raise MismatchedContentTypeException
 
-        self.converted_ans.update(
-            {
-                "additional_properties": {
-                    "originalName": self.source_data.get("originalfilename"),
-                    "originalUrl": self.source_data.get("download_url"),
-                    "ap_item_url": self.source_data.get("url"),
-                    "expiration_date": self.get_expiration_date(),
-                    "sha1": self.get_sha1(),
-                },
-                "caption": self.source_data.get("description_caption"),
-                "subtitle": self.source_data.get("headline"),
-            }
-        )
+        self.converted_ans.update(self.photo_fields(self.get_expiration_date(), self.get_sha1()))
 
         logger.info(
             "photo conversion",
@@ -259,21 +399,35 @@ class APPhotoConverter(AssociatedPressBaseConverter):
                 "source_id": self.source_data.get("source_id"),
                 "headline": self.source_data.get("headline"),
                 "firstcreated": self.source_data.get("firstcreated"),
-                "converted_ans": self.converted_ans,
+                "sha1": self.converted_ans["additional_properties"]["sha1"],
             },
         )
         return self.converted_ans
 
+    def photo_fields(self, expiration_date: str, sha1: str):
+        """the ans fields of a photo on top of base_fields"""
+        return {
+            "additional_properties": {
+                "originalName": self.source_data.get("originalfilename"),
+                "originalUrl": self.source_data.get("download_url"),
+                "ap_item_url": self.source_data.get("url"),
+                "expiration_date": expiration_date,
+                "sha1": sha1,
+            },
+            "caption": self.source_data.get("description_caption"),
+            "subtitle": self.source_data.get("headline"),
+        }
+
+    def hash_source(self):
+        """the bytes the sha1 is computed over. nothing nested is changed, so leaving keys out of a shallow copy gives
+        exactly the bytes a deep copy with the keys popped gave"""
+        return hash_bytes({key: value for key, value in self.source_data.items() if key not in PHOTO_HASH_EXCLUDED})
+
     def get_sha1(self):
         """create a hash value that you can use to determnine later if this object has been updated since it was imported into arc"""
-
-        hash_source = copy.deepcopy(self.source_data)
-        # remove items from contributing to the hash if they may change without signaling a substantive change to the actual content
-        hash_source.pop("download_url", None)
-        hash_source.pop("url", None)
-        hash_source.pop("priced", None)
-        hash_source.pop("pricetag", None)
-        source_data_str = json.dumps(hash_source).encode("utf-8")
+        if self.batch_converted:
+            return self.converted_ans["additional_properties"]["sha1"]
+        source_data_str = self.hash_source()
         logger.info(
             "computing sha1 hash for photo",
             extra={
@@ -285,3 +439,44 @@ class APPhotoConverter(AssociatedPressBaseConverter):
         )
         hash_object = hashlib.sha1(source_data_str).hexdigest()
         return hash_object
+
+
+def convert_photo_batch(converters: list):
+    """convert a page of photos at once, giving each converter the ans its convert_ans would give it. the expiration
+    date and the fields every wire shares are worked out once for the batch, and the page is logged once instead of
+    three times per photo. converters
+    that are not photos, that share another converter's conversion or that were converted already are left alone.
+    returns the converters converted"""
+    pending = [
+        c
+        for c in converters
+        if isinstance(c, APPhotoConverter)
+        and c.shared is None
+        and not c.batch_converted
+        and "_id" not in c.converted_ans
+    ]
+    if not pending:
+        return []
+    started = time.perf_counter()
+    expiration_date = AssociatedPressBaseConverter.get_expiration_date()
+    constant = AssociatedPressBaseConverter.constant_fields()
+    converted = []
+    for converter in pending:
+        # a mismatched item is left to convert_ans, which raises for it when it is sent
+        if converter.get_arc_type(converter.source_data.get("type")) != "image":
+            continue
+        with converter.trace.child("convert", batch=True):
+            sha1 = hashlib.sha1(converter.hash_source()).hexdigest()
+            converter.converted_ans = {"version": converter.ans_version, **converter.base_fields(constant)}
+            converter.converted_ans.update(converter.photo_fields(expiration_date, sha1))
+        converter.batch_converted = True
+        converted.append(converter)
+    logger.info(
+        "photo batch conversion",
+        extra={
+            "photos": len(converted),
+            "seconds": time.perf_counter() - started,
+            "source_ids": [c.source_data.get("source_id") for c in converted],
+        },
+    )
+    return converted
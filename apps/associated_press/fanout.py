@@ -0,0 +1,151 @@
+# Sends one AP feed into several Arc orgs and websites. Each item is fetched from AP and converted once, and only the
+# fields that depend on the org are converted again per target, see AssociatedPressBaseConverter.for_target.
+# Every target has its own inventory database, its own token and its own rate limits, and targets send concurrently.
+#
+# AP_TARGETS = site_a,site_b names the targets, and each target's settings are read from variables prefixed with its
+# name in upper case, e.g. SITE_A_ARC_ORG_ID, SITE_A_ARC_ORG_WEBSITE, SITE_A_ARC_WEBSITE_SECTION, SITE_A_ARC_TOKEN,
+# SITE_A_SQLDB_LOCATION, SITE_A_STORY_RATE_LIMIT_CALLS and SITE_A_PHOTO_RATE_LIMIT_CALLS.
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from typing import Optional
+
+from decouple import config
+from ratelimit import limits, sleep_and_retry
+
+from apps import associated_press as ap
+from apps.associated_press.converter import APPhotoConverter, APStoryConverter, convert_photo_batch
+from apps.associated_press.send_policy import send_policy_from_config
+from utils import inventory
+from utils.constants import PHOTO_RATE_LIMIT_CALLS, RATE_LIMIT_PERIOD, STORY_RATE_LIMIT_CALLS
+from utils.logger import get_logger
+from utils.staging import staging_store_from_config
+
+logger = get_logger()
+
+
+class Target:
+    def __init__(
+        self,
+        name: str,
+        org: str,
+        website: str,
+        section: str,
+        token: str = None,
+        sqldb_location: str = ":memory:",
+        story_calls: int = STORY_RATE_LIMIT_CALLS,
+        photo_calls: int = PHOTO_RATE_LIMIT_CALLS,
+        period: int = RATE_LIMIT_PERIOD,
+        store=None,
+    ):
+        self.name = name
+        self.org = org
+        self.website = website
+        self.section = section
+        self.token = token
+        self.sqldb_location = sqldb_location
+        self.store = store
+        self.conn = None
+        # a long-running caller keeps the target's own line of wires between calls, see poll.py
+        self.queue = None
+        self.admission = None
+        # an outage in one org does not pause the others
+        self.send_policy = send_policy_from_config()
+        # the rate limited calls every attempt of this target's sends takes, see ap.story_slot and ap.photo_slot
+        self.story_slot = sleep_and_retry(limits(calls=story_calls, period=period)(lambda: None))
+        self.photo_slot = sleep_and_retry(limits(calls=photo_calls, period=period)(lambda: None))
+
+    def __repr__(self):
+        return f"Target({self.name}, {self.org}, {self.website})"
+
+    def connection(self):
+        """the target's inventory connection, opened once. targets send from a thread pool, and each connection is
+        only ever used by one thread at a time"""
+        if self.conn is None:
+            self.conn = inventory.create_connection(self.sqldb_location, check_same_thread=False)
+            inventory.create_table(self.conn)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def send(self, converter, count: str, conn):
+        if isinstance(converter, APStoryConverter):
+            return ap.process_wire_story(converter, count, conn, target=self)
+        if isinstance(converter, APPhotoConverter):
+            return ap.process_wire_photo(converter, count, conn, target=self)
+
+
+def targets_from_config():
+    """the targets named in AP_TARGETS, an empty list when the feed goes to the single org in ARC_ORG_ID"""
+    targets = []
+    for name in config("AP_TARGETS", default="", cast=lambda v: [n.strip() for n in v.split(",") if n.strip()]):
+        prefix = name.upper()
+        targets.append(
+            Target(
+                name,
+                org=config(f"{prefix}_ARC_ORG_ID"),
+                website=config(f"{prefix}_ARC_ORG_WEBSITE"),
+                section=config(f"{prefix}_ARC_WEBSITE_SECTION"),
+                token=config(f"{prefix}_ARC_TOKEN", default=None),
+                sqldb_location=config(f"{prefix}_SQLDB_LOCATION", default=":memory:"),
+                story_calls=config(f"{prefix}_STORY_RATE_LIMIT_CALLS", default=STORY_RATE_LIMIT_CALLS, cast=int),
+                photo_calls=config(f"{prefix}_PHOTO_RATE_LIMIT_CALLS", default=PHOTO_RATE_LIMIT_CALLS, cast=int),
+                store=staging_store_from_config(name),
+            )
+        )
+    return targets
+
+
+def process_wires_fanout(converters: list, targets: list, stop: Event = None, deadline: Optional[float] = None):
+    """send the converted wires to every target at once. each target gets converters of its own that share the
+    conversion, so each target's queue, freshness stages and relayed images are its own. like ap.process_wires, a
+    target with a queue of its own keeps the wires held, deferred or left unsent by the deadline for the next call"""
+    # converted once here, before the targets share the conversions from their own threads
+    shared = []
+    converters = list(filter(None, converters))
+    convert_photo_batch(converters)
+    for converter in converters:
+        try:
+            converter.convert_ans()
+            shared.append(converter)
+        except Exception as e:
+            logger.error(e, extra={"source_id": converter.source_data.get("source_id")})
+            converter.trace.finish(outcome="failed", error=e)
+    converters = shared
+
+    def send(target: Target):
+        wires = [converter.for_target(target.org, target.website, target.section) for converter in converters]
+        try:
+            unsent = ap.process_wires(
+                wires,
+                target.connection(),
+                stop,
+                target.queue,
+                deadline=deadline,
+                admission=target.admission,
+                target=target,
+            )
+            # like the poller's own, a target's queue keeps the wires its org would not take for the next call
+            if target.queue is not None:
+                target.queue.extend(unsent)
+        except Exception as e:
+            logger.error(e, extra={"target": target.name})
+
+    with ThreadPoolExecutor(max_workers=max(len(targets), 1)) as pool:
+        list(pool.map(send, targets))
+    # each target's sends were traced inside its own span of the item's trace
+    for converter in converters:
+        converter.trace.finish(outcome="fanned_out")
+    logger.info("Wires fanned out", extra={"wires": len(converters), "targets": [target.name for target in targets]})
+
+
+if __name__ == "__main__":  # pragma: no cover
+    fanout_targets = targets_from_config()
+    if not fanout_targets:
+        print("AP_TARGETS is not set, there are no targets to fan out to")
+    else:
+        process_wires_fanout(ap.build_wires(ap.fetch_feed()), fanout_targets)
+        for fanout_target in fanout_targets:
+            fanout_target.close()
@@ -0,0 +1,130 @@
+# The parameters of an AP feed request, built from settings instead of one hand written AP_QUERY. The filters the
+# ingest applies anyway are pushed to AP, so the feed stops returning items that build_wires would throw away:
+# item types other than AP_FEED_TYPES (videos, graphics) and, with in_my_plan, content that costs extra. With the
+# projection on, AP only returns the item fields AP_RESULTS_JMESPATH_STR reads, see AP_FEED_INCLUDE_FIELDS.
+# next_page urls carry these parameters along, so only the first request of a feed is built here.
+import argparse
+import json
+from typing import Iterable, Optional
+
+import requests
+
+from utils.constants import AP_FEED_INCLUDE_FIELDS, AP_FEED_TYPES, AP_RESULTS_JMESPATH_STR
+from utils.lazy import lazy_module
+from utils.settings import get_settings
+
+jmespath = lazy_module("jmespath")
+
+FEED_URL = "https://api.ap.org/media/v/content/feed"
+
+
+class FeedQuery:
+    def __init__(
+        self,
+        query: str = "",
+        types: Iterable[str] = AP_FEED_TYPES,
+        in_my_plan: bool = True,
+        page_size: Optional[int] = None,
+        include: Optional[Iterable[str]] = AP_FEED_INCLUDE_FIELDS,
+    ):
+        self.query = query or ""
+        self.types = list(types or [])
+        self.in_my_plan = in_my_plan
+        self.page_size = page_size
+        self.include = list(include) if include else []
+
+    def __repr__(self):
+        return f"FeedQuery({self.params()})"
+
+    def q(self):
+        """the feed's own query, narrowed to the item types the ingest converts"""
+        clauses = []
+        if self.query:
+            clauses.append(f"({self.query})")
+        if self.types:
+            clauses.append("(" + " OR ".join(f"type:{t}" for t in self.types) + ")")
+        return " AND ".join(clauses)
+
+    def params(self):
+        params = {}
+        q = self.q()
+        if q:
+            params["q"] = q
+        if self.in_my_plan:
+            params["in_my_plan"] = "true"
+        if self.page_size:
+            params["page_size"] = self.page_size
+        if self.include:
+            params["include"] = ",".join(self.include)
+        return params
+
+    def unusable(self, item: dict):
+        """true for a projected feed item build_wires would throw away, which a server side filter should have
+        left out"""
+        if item.get("type") not in (self.types or AP_FEED_TYPES):
+            return True
+        return item.get("type") == "picture" and item.get("pricetag") not in ["Unlimited", "", None]
+
+
+def feed_query_from_settings(query: Optional[str] = None):
+    """the request for a feed, a named feed passes its own query, see apps/associated_press/feeds.py, otherwise
+    AP_QUERY is used"""
+    settings = get_settings()
+    return FeedQuery(
+        query=query if query is not None else settings.ap_query,
+        types=settings.ap_feed_types,
+        in_my_plan=settings.ap_feed_in_my_plan,
+        page_size=settings.ap_feed_page_size,
+        include=AP_FEED_INCLUDE_FIELDS if settings.ap_feed_projection else None,
+    )
+
+
+def estimate_bytes_saved(size: int, usable_items: int, baseline: Optional[float]):
+    """the bytes a page saved by its filters and projection, estimated. the unfiltered page is never downloaded, so it
+    is priced at the unfiltered bytes per usable item --compare measured, AP_FEED_BASELINE_BYTES_PER_ITEM. none
+    without a baseline. a negative estimate means the baseline no longer fits the feed, measure it again"""
+    if baseline is None:
+        return None
+    return round(usable_items * baseline) - size
+
+
+def compare(feed_query: FeedQuery, headers: dict):
+    """fetch the first page of the feed twice, as AP_QUERY alone and with the filters and projection, and report what
+    the filters saved. both pages are asked for the same page size"""
+    page_size = feed_query.page_size or 10
+    plain = FeedQuery(feed_query.query, types=[], in_my_plan=False, page_size=page_size, include=None)
+    filtered = FeedQuery(feed_query.query, feed_query.types, feed_query.in_my_plan, page_size, feed_query.include)
+    report = {}
+    for name, fq in [("unfiltered", plain), ("filtered", filtered)]:
+        res = requests.get(FEED_URL, params=fq.params(), headers=headers)
+        res.raise_for_status()
+        items = jmespath.search(AP_RESULTS_JMESPATH_STR, res.json()) or []
+        report[name] = {
+            "bytes": len(res.content),
+            "items": len(items),
+            "unusable_items": sum(1 for item in items if filtered.unusable(item)),
+        }
+    plain_usable = report["unfiltered"]["items"] - report["unfiltered"]["unusable_items"]
+    filtered_usable = report["filtered"]["items"] - report["filtered"]["unusable_items"]
+    report["bytes_per_usable_item"] = {
+        "unfiltered": report["unfiltered"]["bytes"] / plain_usable if plain_usable else None,
+        "filtered": report["filtered"]["bytes"] / filtered_usable if filtered_usable else None,
+    }
+    report["saved_bytes"] = report["unfiltered"]["bytes"] - report["filtered"]["bytes"]
+    return report
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(
+        description="Show the AP feed request built from settings, or measure what its filters save"
+    )
+    parser.add_argument("--query", default=None, help="the feed's query, defaults to AP_QUERY")
+    parser.add_argument(
+        "--compare", action="store_true", help="fetch one page with and without the filters and compare"
+    )
+    args = parser.parse_args()
+
+    from apps.associated_press import ap_headers
+
+    built = feed_query_from_settings(args.query)
+    print(json.dumps(compare(built, ap_headers()) if args.compare else built.params(), indent=2))
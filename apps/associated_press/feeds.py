@@ -0,0 +1,109 @@
+# Several named AP feed subscriptions polled at once, e.g. one per product or topic query, merged into one stream.
+# The queries overlap, so each version of an item is kept once, before any story XML or photo association is fetched.
+#
+# AP_FEEDS = sports,politics names the feeds, and each feed's query is read from a variable prefixed with its name in
+# upper case, e.g. SPORTS_AP_QUERY. Each feed follows its own next_page cursor, which the poller saves in the
+# ap_feed_cursors table once the items of the poll are sent, see poll.py.
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from decouple import config
+
+from apps import associated_press as ap
+from utils import inventory
+from utils.logger import get_logger
+
+logger = get_logger()
+
+
+class Feed:
+    def __init__(self, name: str, query: str = ""):
+        self.name = name
+        self.query = query
+        self.next_page = None
+        # running totals, logged after every poll
+        self.polls = 0
+        self.failures = 0
+        self.items = 0
+        self.new = 0
+        self.duplicates = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return f"Feed({self.name}, {self.query})"
+
+    def fetch(self):
+        """one page of this feed, following its cursor. on a failed request the cursor is kept, so the next poll asks
+        for the same items again"""
+        started = time.monotonic()
+        items, next_page = ap.fetch_feed_page(self.next_page, self.query)
+        self.seconds += time.monotonic() - started
+        self.polls += 1
+        if items is None and next_page is None:
+            self.failures += 1
+        self.next_page = next_page or self.next_page
+        items = items or []
+        self.items += len(items)
+        return items
+
+    def stats(self):
+        return {
+            "feed": self.name,
+            "polls": self.polls,
+            "failures": self.failures,
+            "items": self.items,
+            "new": self.new,
+            "duplicates": self.duplicates,
+            "items_per_second": self.items / self.seconds if self.seconds else 0,
+            "new_per_poll": self.new / self.polls if self.polls else 0,
+        }
+
+
+class FeedMerger:
+    """merges the items of several feeds, keeping the first copy of each version of an item.
+    the versions seen are remembered across polls, up to max_seen, because a feed often returns an item another feed
+    returned a poll earlier"""
+
+    def __init__(self, max_seen: int = 10000):
+        self.max_seen = max_seen
+        self.seen = OrderedDict()
+
+    def merge(self, feed_items: list):
+        """feed_items are (feed, items), returns the items not seen before"""
+        merged = []
+        for feed, items in feed_items:
+            for item in items:
+                key = (item.get("source_id"), item.get("versioncreated"))
+                if key in self.seen:
+                    self.seen.move_to_end(key)
+                    feed.duplicates += 1
+                    continue
+                self.seen[key] = feed.name
+                feed.new += 1
+                merged.append(item)
+        while len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+        return merged
+
+
+def feeds_from_config(conn=None):
+    """the feeds named in AP_FEEDS, with the cursors saved in conn, an empty list when only AP_QUERY is polled"""
+    feeds = []
+    for name in config("AP_FEEDS", default="", cast=lambda v: [n.strip() for n in v.split(",") if n.strip()]):
+        feed = Feed(name, config(f"{name.upper()}_AP_QUERY", default=""))
+        if conn is not None:
+            feed.next_page = inventory.select_feed_cursor(conn, name)
+        feeds.append(feed)
+    return feeds
+
+
+def fetch_feeds(feeds: list, merger: FeedMerger):
+    """poll every feed at once and merge their items into one stream. returns the items and each feed's
+    (name, next_page) cursor, which the caller saves only once the items are sent, so an interrupted run asks for
+    them again"""
+    with ThreadPoolExecutor(max_workers=max(len(feeds), 1)) as pool:
+        results = list(pool.map(lambda feed: feed.fetch(), feeds))
+    items = merger.merge(zip(feeds, results))
+    logger.info("Feeds merged", extra={"items": len(items), "feeds": [feed.stats() for feed in feeds]})
+    return items, [(feed.name, feed.next_page) for feed in feeds]
@@ -0,0 +1,241 @@
+# Long-running alternative to launching apps/associated_press/__init__.py from cron.
+# The feed is polled on an interval that follows the observed arrival rate of new items, and the AP sequence
+# cursor (next_page) plus the SQLite inventory connection are kept between cycles instead of rebuilt every run.
+import signal
+import time
+from collections import deque
+from threading import Event
+from typing import Optional
+
+from decouple import config
+
+from apps import associated_press as ap
+from apps.associated_press.admission import admission_from_config
+from apps.associated_press.fanout import process_wires_fanout, targets_from_config
+from apps.associated_press.feeds import FeedMerger, feeds_from_config, fetch_feeds
+from apps.associated_press.prefetch import DEFAULT_FEED, Prefetcher
+from apps.associated_press.reconciler import reconcile_from_config
+from apps.associated_press.send_queue import SendQueue, send_queue_from_config
+from utils import inventory
+from utils.inventory_migration import migration_from_config
+from utils.logger import get_logger
+from utils.retention import retention_from_config
+from utils.settings import get_settings
+from utils.staging import staging_store_from_config
+
+logger = get_logger()
+
+
+class AdaptiveInterval:
+    """Derives the wait between polls from a smoothed rate of items arriving in the feed.
+    A busy news cycle shortens the wait toward min_interval, a quiet one backs off toward max_staleness,
+    which is the longest a new AP item is allowed to sit in the feed before this app looks for it."""
+
+    def __init__(self, min_interval: float, max_staleness: float, target_items: float = 10, smoothing: float = 0.3):
+        self.min_interval = min_interval
+        self.max_staleness = max(max_staleness, min_interval)
+        self.target_items = target_items
+        self.smoothing = smoothing
+        self.rate = None  # items per second
+
+    def observe(self, item_count: int, elapsed: float):
+        """record how many new items one poll brought back, and the seconds since the poll before it"""
+        if elapsed <= 0:
+            return
+        rate = item_count / elapsed
+        self.rate = rate if self.rate is None else self.smoothing * rate + (1 - self.smoothing) * self.rate
+
+    @property
+    def interval(self):
+        if self.rate is None:
+            return self.min_interval
+        if self.rate <= 0:
+            return self.max_staleness
+        return min(max(self.target_items / self.rate, self.min_interval), self.max_staleness)
+
+
+def install_signal_handlers(stop: Event):
+    """finish the item in flight and exit the loop on SIGINT/SIGTERM rather than dying mid-send"""
+
+    def handler(signum, frame):
+        logger.info("Poll shutdown requested", extra={"signal": signal.Signals(signum).name})
+        stop.set()
+
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+
+
+def run_poll(stop: Optional[Event] = None, max_cycles: Optional[int] = None):
+    stop = stop or Event()
+    # resolved once, so a missing setting stops the poller before its first feed request
+    settings = get_settings()
+    schedule = AdaptiveInterval(
+        min_interval=config("AP_POLL_MIN_INTERVAL", default=30, cast=float),
+        max_staleness=config("AP_POLL_MAX_STALENESS", default=600, cast=float),
+        target_items=config("AP_POLL_TARGET_ITEMS", default=10, cast=float),
+    )
+    # wires left unsent when a cycle's time is up stay queued, where newer versions of them can replace them
+    queue = send_queue_from_config()
+    # one admission controller for the life of the poller keeps running totals of the wires it sheds
+    admission = admission_from_config()
+    store = staging_store_from_config()
+    # with AP_TARGETS set every cycle is sent to each target, see apps/associated_press/fanout.py. each target keeps a
+    # queue and an admission controller of its own, since targets send from their own threads
+    targets = targets_from_config()
+    for target in targets:
+        target.queue, target.admission = send_queue_from_config(), admission_from_config()
+    queues = [queue, *(target.queue for target in targets)]
+    # connection stays open for the life of the poller
+    conn = inventory.create_connection(settings.sqldb_location)
+    inventory.create_table(conn)
+    # with AP_FEEDS set several feeds are polled at once, each continuing from its saved cursor
+    feeds = feeds_from_config(conn)
+    merger = FeedMerger()
+    # prunes the inventory past its retention horizon at most once every AP_INVENTORY_RETENTION_INTERVAL
+    retention = retention_from_config()
+    # moves a few batches of a legacy inventory into the compact table every cycle, see utils/inventory_migration.py
+    migration = migration_from_config()
+    # with AP_PREFETCH_DEPTH set the single feed is read ahead in the background, from the page after the last one
+    # processed, see apps/associated_press/prefetch.py
+    prefetcher = None
+    depth = config("AP_PREFETCH_DEPTH", default=0, cast=int)
+    max_queued = config("AP_PREFETCH_MAX_QUEUED", default=200, cast=int)
+    # where the feed continues after the last page taken, a prefetcher that died is started again from here
+    resume = inventory.select_feed_cursor(conn, DEFAULT_FEED)
+
+    def new_prefetcher():
+        return Prefetcher(
+            resume,
+            depth,
+            full=lambda: any(len(q) >= max_queued for q in queues),
+            idle_wait=schedule.min_interval,
+        )
+
+    if depth > 0 and not feeds:
+        prefetcher = new_prefetcher()
+    # the (feed, next_page) cursors of the pages not checkpointed yet, oldest first, with the source_ids of their wires
+    pending = deque()
+    # without prefetch the single feed continues from its saved cursor too
+    next_page = resume
+    previous_start = None
+    cycles = 0
+    # cycles failed in a row
+    failures = 0
+    try:
+        if prefetcher is not None and not stop.is_set():
+            prefetcher.start()
+        while not stop.is_set() and (max_cycles is None or cycles < max_cycles):
+            started = time.monotonic()
+            cycles += 1
+            try:
+                cursors = []
+                if feeds:
+                    items, cursors = fetch_feeds(feeds, merger)
+                elif prefetcher is not None:
+                    if not prefetcher.is_alive() and not prefetcher.ready():
+                        # once its pages are taken, every cycle from now on would wait for a page that never comes
+                        logger.error(
+                            "Prefetcher stopped, starting a new one", extra={"url": resume, **prefetcher.stats()}
+                        )
+                        prefetcher = new_prefetcher()
+                        prefetcher.start()
+                    prefetched = prefetcher.take(timeout=schedule.interval)
+                    items = prefetched.items if prefetched else []
+                    if prefetched is not None:
+                        resume = prefetched.next_page
+                        cursors = [(DEFAULT_FEED, prefetched.next_page)]
+                else:
+                    items, page = ap.fetch_feed_page(next_page)
+                    # on a failed request keep the old cursor so the next cycle asks for the same items again
+                    next_page = page or next_page
+                    items = items or []
+                    if page:
+                        cursors = [(DEFAULT_FEED, page)]
+                wires = ap.build_wires(items)
+                if cursors:
+                    pending.append((cursors, [SendQueue.source_id(wire) for wire in wires]))
+                if targets:
+                    process_wires_fanout(wires, targets, stop, deadline=started + schedule.interval)
+                    for target in targets:
+                        if target.store is not None:
+                            reconcile_from_config(target.connection(), target.store, target)
+                else:
+                    unsent = ap.process_wires(
+                        wires,
+                        conn,
+                        stop,
+                        queue,
+                        deadline=started + schedule.interval,
+                        admission=admission,
+                        store=store,
+                    )
+                    # wires migration center would not take wait in line for the next cycle, so their page is not
+                    # checkpointed past them
+                    queue.extend(unsent)
+                    if store is not None:
+                        reconcile_from_config(conn, store)
+
+                # a page is done with once none of its wires wait in the queue, held or past the cycle's deadline.
+                # until then an interrupted run fetches it again
+                checkpoint = {}
+                while pending and not any(source_id in q for q in queues for source_id in pending[0][1]):
+                    checkpoint.update(pending.popleft()[0])
+                if checkpoint:
+                    inventory.update_feed_cursors(conn, list(checkpoint.items()))
+
+                for db in [conn, *(target.connection() for target in targets)]:
+                    migration.run(db)
+
+                if retention.due():
+                    for db in [conn, *(target.connection() for target in targets)]:
+                        retention.run(db)
+
+                if previous_start is not None:
+                    schedule.observe(len(items), started - previous_start)
+                previous_start = started
+                wait = max(schedule.interval - (time.monotonic() - started), 0)
+                # wake early when a held story becomes ready to send
+                ready_in = [r for r in (q.next_ready_in() for q in queues) if r is not None]
+                if ready_in:
+                    wait = min(wait, *ready_in)
+                # catching up, the next page is already here
+                if prefetcher is not None and prefetcher.ready():
+                    wait = 0
+                logger.info(
+                    "Poll cycle complete",
+                    extra={
+                        "cycle": cycles,
+                        "items": len(items),
+                        "queued": sum(len(q) for q in queues),
+                        "rate": schedule.rate,
+                        "interval": schedule.interval,
+                        "wait": wait,
+                        **(prefetcher.stats() if prefetcher is not None else {}),
+                    },
+                )
+                failures = 0
+            except Exception as e:
+                # a failed request to ap or arc, or a bad item, is no reason to stop polling. the next cycle tries
+                # again, later the more cycles in a row have failed
+                failures += 1
+                wait = min(schedule.min_interval * 2 ** (failures - 1), schedule.max_staleness)
+                logger.error(
+                    "Poll cycle failed", extra={"cycle": cycles, "error": repr(e), "failures": failures, "wait": wait}
+                )
+            if max_cycles is None or cycles < max_cycles:
+                stop.wait(wait)
+    finally:
+        if prefetcher is not None and prefetcher.is_alive():
+            prefetcher.stop()
+        if any(len(q) for q in queues):
+            logger.warning("Poller stopped with wires still queued", extra={"queued": sum(len(q) for q in queues)})
+        conn.close()
+        for target in targets:
+            target.close()
+    return cycles
+
+
+if __name__ == "__main__":  # pragma: no cover
+    stop_event = Event()
+    install_signal_handlers(stop_event)
+    run_poll(stop_event)
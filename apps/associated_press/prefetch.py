@@ -0,0 +1,110 @@
+# Follows the feed's next_page in a background thread, up to depth pages ahead of the poller, so that while the
+# poller converts and sends one page the next one is already downloaded. It matters when catching up after downtime,
+# when every page is full and each fetch used to be a round trip on the critical path.
+#
+# The poller checkpoints a page's next_page only once the page's wires have left its send queue, see poll.py, never
+# when the page was prefetched. A run interrupted with pages prefetched but not sent starts again from the first of
+# them.
+import queue
+import time
+from collections import namedtuple
+from threading import Event, Semaphore, Thread
+from typing import Callable, Optional
+
+import requests
+
+from apps import associated_press as ap
+from utils.logger import get_logger
+
+logger = get_logger()
+
+# the single AP_QUERY feed's row in ap_feed_cursors. named feeds use their own names, see feeds.py
+DEFAULT_FEED = "default"
+
+# url is the request the page came from, next_page where the feed continues after it
+Page = namedtuple("Page", ["url", "items", "next_page"])
+
+
+class Prefetcher(Thread):
+    def __init__(
+        self,
+        start_page: Optional[str] = None,
+        depth: int = 1,
+        full: Callable[[], bool] = None,
+        idle_wait: float = 30,
+        pause: float = 1,
+    ):
+        """full tells when the queues downstream have enough to send, and no more pages should be fetched for now.
+        after a page without items the feed is caught up, and the next page is only asked for idle_wait seconds later"""
+        super().__init__(daemon=True)
+        self.url = start_page
+        self.depth = depth
+        self.full = full or (lambda: False)
+        self.idle_wait = idle_wait
+        self.pause = pause
+        self.pages = queue.Queue()
+        # a slot is taken for each page fetched and given back when the poller takes the page
+        self.slots = Semaphore(depth)
+        self.stopped = Event()
+        self.fetched = 0
+        self.failures = 0
+        self.paused = 0
+        self.seconds = 0.0
+
+    def run(self):
+        while not self.stopped.is_set():
+            if not self.slots.acquire(timeout=self.pause):
+                continue
+            while self.full() and not self.stopped.is_set():
+                self.paused += 1
+                self.stopped.wait(self.pause)
+            if self.stopped.is_set():
+                break
+            started = time.monotonic()
+            try:
+                items, next_page = ap.fetch_feed_page(self.url)
+            except requests.exceptions.RequestException as e:
+                # a connection error or a timeout would end the thread, and leave the poller without pages
+                logger.warning("Prefetch request failed", extra={"url": self.url, "error": repr(e)})
+                items, next_page = None, None
+            self.seconds += time.monotonic() - started
+            if items is None and next_page is None:
+                # the same page is asked for again after a pause
+                self.failures += 1
+                self.slots.release()
+                self.stopped.wait(self.idle_wait)
+                continue
+            page = Page(self.url, items or [], next_page or self.url)
+            self.fetched += 1
+            self.pages.put(page)
+            self.url = page.next_page
+            if not page.items:
+                self.stopped.wait(self.idle_wait)
+
+    def take(self, timeout: float = None):
+        """the next page in feed order, or None when none was ready within the timeout"""
+        try:
+            page = self.pages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self.slots.release()
+        return page
+
+    def ready(self):
+        return not self.pages.empty()
+
+    def stats(self):
+        return {
+            "prefetched": self.fetched,
+            "ahead": self.pages.qsize(),
+            "failures": self.failures,
+            "paused": self.paused,
+            "fetch_seconds": self.seconds,
+        }
+
+    def stop(self):
+        """stop fetching, the pages not taken yet are dropped and fetched again by the next run"""
+        self.stopped.set()
+        # wakes the thread if it is waiting for a slot
+        self.slots.release()
+        self.join()
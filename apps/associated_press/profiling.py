@@ -0,0 +1,298 @@
+# Opt-in profiling of the ingest's stages, for when a run is slow and the json logs only tell when each item started.
+# While a Profiler runs, the functions behind each stage (fetch, parse, convert_ans, get_sha1, inventory and send) are
+# wrapped, so every call is timed and run under its stage's cProfile profile, and tracemalloc follows the allocations.
+# When it stops the functions are put back as they were, so a run that is not profiled calls exactly the code it
+# always did, and pays nothing for it.
+#
+# Stages nest, convert_ans computes the sha1 and fetching a story parses its xml, and time is only counted once: an
+# outer stage is paused while an inner one runs. Items are told apart by source_id, from the converter or feed item a
+# wrapped function was called with, and the stages below it are counted to the same item.
+#
+# AP_PROFILE=true, or --profile on the command line, profiles a run of run_ap_ingest_wires(). With the api running,
+# /api/debug/profile?seconds=N profiles whatever the server does in the next N seconds.
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from typing import Optional
+
+import requests
+from decouple import config
+
+from apps import associated_press as ap
+from apps.associated_press import fanout
+from apps.associated_press.converter import APPhotoConverter, APStoryConverter
+from apps.associated_press.send_policy import SendPolicy
+from utils import inventory
+from utils.exceptions import ProfilerActiveException
+from utils.logger import get_logger
+
+logger = get_logger()
+
+FETCH = "fetch"
+PARSE = "parse"
+CONVERT = "convert_ans"
+SHA1 = "get_sha1"
+INVENTORY = "inventory"
+SEND = "send"
+STAGES = [FETCH, PARSE, CONVERT, SHA1, INVENTORY, SEND]
+
+_MISSING = object()
+# only one profiler wraps the stages at a time
+_active = None
+_active_lock = threading.Lock()
+
+
+def hooks():
+    """where the stages happen: the owner and name of a function, the stage of its calls, or None for a function that
+    only tells which item the stages inside it work on, and which of its positional arguments is that item"""
+    return [
+        (ap, "fetch_feed_page", FETCH, None),
+        (ap, "fetch_story_item", FETCH, 1),
+        (ap, "fetch_photo_item", FETCH, 0),
+        (ap, "read_feed_stream", PARSE, None),
+        (requests.Response, "json", PARSE, None),
+        (ap, "story_converter", PARSE, 0),
+        (APStoryConverter, "convert_ans", CONVERT, 0),
+        (APPhotoConverter, "convert_ans", CONVERT, 0),
+        (APPhotoConverter, "photo_fields", CONVERT, 0),
+        (ap, "convert_photo_batch", CONVERT, None),
+        (fanout, "convert_photo_batch", CONVERT, None),
+        (APStoryConverter, "get_sha1", SHA1, 0),
+        (APPhotoConverter, "get_sha1", SHA1, 0),
+        (APPhotoConverter, "hash_source", SHA1, 0),
+        (inventory, "select_inventory_by_sha1", INVENTORY, None),
+        (inventory, "create_inventory", INVENTORY, None),
+        (inventory, "create_freshness", INVENTORY, None),
+        (SendPolicy, "post", SEND, None),
+        (ap, "process_wire_story", None, 0),
+        (ap, "process_wire_photo", None, 0),
+        (fanout.Target, "send", None, 1),
+    ]
+
+
+def source_id_of(value):
+    """the source_id of a feed item or of a converter"""
+    if isinstance(value, dict):
+        return value.get("source_id")
+    source_data = getattr(value, "source_data", None)
+    return source_data.get("source_id") if isinstance(source_data, dict) else None
+
+
+class Profiler:
+    def __init__(
+        self, slow_items: int = 20, top_functions: int = 15, top_allocations: int = 15, directory: Optional[str] = None
+    ):
+        """slow_items is how many of the slowest items the report keeps, directory where the stages' pstats files and
+        the report are written when the profiler stops"""
+        self.slow_items = slow_items
+        self.top_functions = top_functions
+        self.top_allocations = top_allocations
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # one cProfile profile per stage and thread, a profile only ever follows the thread that enabled it
+        self.profiles = []
+        self.totals = {stage: {"calls": 0, "seconds": 0.0, "cpu_seconds": 0.0, "retained_bytes": 0} for stage in STAGES}
+        # source_id: {stage: seconds}
+        self.items = {}
+        self.restore = []
+        self.running = False
+        self.tracing = False
+        self.started = None
+        self.seconds = None
+        self.snapshot = None
+
+    def start(self):
+        global _active
+        with _active_lock:
+            if _active is not None:
+                raise ProfilerActiveException
+            _active = self
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        self.running = True
+        for owner, name, stage, item_arg in hooks():
+            original = vars(owner).get(name, _MISSING)
+            setattr(owner, name, self.wrap(getattr(owner, name), stage, item_arg))
+            self.restore.append((owner, name, original))
+        self.started = time.monotonic()
+        return self
+
+    def stop(self):
+        """put the stages back as they were and return the report"""
+        global _active
+        self.running = False
+        for owner, name, original in reversed(self.restore):
+            if original is _MISSING:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+        self.restore = []
+        self.seconds = time.monotonic() - self.started
+        if tracemalloc.is_tracing():
+            self.snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+            )
+        if self.tracing:
+            tracemalloc.stop()
+        with _active_lock:
+            _active = None
+        report = self.report()
+        if self.directory:
+            self.dump(report)
+        return report
+
+    def wrap(self, func, stage: Optional[str], item_arg: Optional[int]):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            item = source_id_of(args[item_arg]) if item_arg is not None and len(args) > item_arg else None
+            frame = self.enter(stage, item)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.exit(frame)
+
+        return wrapper
+
+    def thread_state(self):
+        local = self.local
+        if not hasattr(local, "stack"):
+            local.stack = []
+            local.profiles = {}
+            local.item = None
+        return local
+
+    def enter(self, stage: Optional[str], item: Optional[str]):
+        local = self.thread_state()
+        # the item of the calling stage, given back on exit
+        frame = {"stage": stage, "outer_item": local.item}
+        if item is not None:
+            local.item = item
+        if stage is None or not self.running:
+            frame["stage"] = None
+            return frame
+        if local.stack:
+            local.stack[-1]["profile"].disable()
+        profile = local.profiles.get(stage)
+        if profile is None:
+            profile = local.profiles[stage] = cProfile.Profile()
+            with self.lock:
+                self.profiles.append((stage, profile))
+        frame.update(
+            profile=profile,
+            wall=time.perf_counter(),
+            cpu=time.thread_time(),
+            memory=tracemalloc.get_traced_memory()[0],
+            inner_wall=0.0,
+            inner_cpu=0.0,
+            inner_memory=0,
+        )
+        local.stack.append(frame)
+        profile.enable()
+        return frame
+
+    def exit(self, frame: dict):
+        local = self.local
+        stage = frame["stage"]
+        if stage is not None:
+            frame["profile"].disable()
+            wall = time.perf_counter() - frame["wall"]
+            cpu = time.thread_time() - frame["cpu"]
+            memory = tracemalloc.get_traced_memory()[0] - frame["memory"]
+            local.stack.pop()
+            with self.lock:
+                totals = self.totals[stage]
+                totals["calls"] += 1
+                totals["seconds"] += wall - frame["inner_wall"]
+                totals["cpu_seconds"] += cpu - frame["inner_cpu"]
+                totals["retained_bytes"] += memory - frame["inner_memory"]
+                if local.item is not None:
+                    breakdown = self.items.setdefault(local.item, {})
+                    breakdown[stage] = breakdown.get(stage, 0.0) + wall - frame["inner_wall"]
+            if local.stack:
+                outer = local.stack[-1]
+                outer["inner_wall"] += wall
+                outer["inner_cpu"] += cpu
+                outer["inner_memory"] += memory
+                # a stage still running when the profiler stopped is not profiled any further
+                if self.running:
+                    outer["profile"].enable()
+        local.item = frame["outer_item"]
+
+    def stats(self, stage: str):
+        """the stage's profiles of every thread as one pstats.Stats, or None when the stage never ran"""
+        stats = None
+        for profile_stage, profile in self.profiles:
+            if profile_stage != stage:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        return stats
+
+    def report(self):
+        stages = {}
+        for stage in STAGES:
+            totals = dict(self.totals[stage])
+            stats = self.stats(stage)
+            rows = sorted(stats.stats.items(), key=lambda row: row[1][2], reverse=True) if stats else []
+            totals["top_functions"] = [
+                {"function": pstats.func_std_string(func), "calls": nc, "own_seconds": tt, "seconds": ct}
+                for func, (cc, nc, tt, ct, callers) in rows[: self.top_functions]
+            ]
+            stages[stage] = totals
+        allocations = []
+        if self.snapshot is not None:
+            for stat in self.snapshot.statistics("lineno")[: self.top_allocations]:
+                frame = stat.traceback[0]
+                allocations.append(
+                    {"site": f"{frame.filename}:{frame.lineno}", "bytes": stat.size, "count": stat.count}
+                )
+        slowest = sorted(self.items.items(), key=lambda item: sum(item[1].values()), reverse=True)[: self.slow_items]
+        return {
+            "seconds": self.seconds,
+            "stages": stages,
+            "allocations": allocations,
+            "slow_items": [
+                {"source_id": source_id, "seconds": sum(breakdown.values()), "stages": breakdown}
+                for source_id, breakdown in slowest
+            ],
+        }
+
+    def dump(self, report: dict):
+        """write each stage's profile as <stage>.prof, for pstats or snakeviz, and the report as profile.json"""
+        os.makedirs(self.directory, exist_ok=True)
+        for stage in STAGES:
+            stats = self.stats(stage)
+            if stats is not None:
+                stats.dump_stats(os.path.join(self.directory, f"{stage}.prof"))
+        with open(os.path.join(self.directory, "profile.json"), "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def profiler_from_config():
+    return Profiler(
+        slow_items=config("AP_PROFILE_SLOW_ITEMS", default=20, cast=int),
+        top_functions=config("AP_PROFILE_TOP_FUNCTIONS", default=15, cast=int),
+        top_allocations=config("AP_PROFILE_TOP_ALLOCATIONS", default=15, cast=int),
+        directory=config("AP_PROFILE_DIR", default=None),
+    )
+
+
+@contextmanager
+def profiled():
+    """profile what runs inside, then log the report and, with AP_PROFILE_DIR, write it out"""
+    profiler = profiler_from_config().start()
+    try:
+        yield profiler
+    finally:
+        report = profiler.stop()
+        logger.info("Profile report", extra={"profile": report})
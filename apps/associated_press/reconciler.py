@@ -0,0 +1,143 @@
+# Cleans the staging store images are relayed into, see apps/associated_press/relay.py.
+# An image is only removed once Photo Center has it, or once the store grows past its age or size caps.
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from decouple import config
+
+from apps.associated_press import bearer_token
+from utils import inventory
+from utils.constants import PHOTO_API_URL
+from utils.logger import get_logger
+from utils.settings import get_settings
+from utils.staging import staging_store_from_config
+
+logger = get_logger()
+
+MAX_BACKOFF = 6 * 60 * 60
+
+
+def check_photo(session: requests.Session, url: str, headers: dict):
+    """True when Photo Center has the image, False when it does not yet, None when the check itself failed"""
+    try:
+        res = session.get(url, headers=headers)
+    except Exception as e:
+        logger.error(e, extra={"url": url})
+        return None
+    if res.ok:
+        return True
+    if res.status_code == 404:
+        return False
+    logger.error(f"{res.status_code} {url}")
+    return None
+
+
+def evict(conn, store, keys: list, reason: str):
+    for key in keys:
+        try:
+            store.delete(key)
+        except Exception as e:
+            logger.error(e, extra={"key": key})
+    inventory.delete_staged_keys(conn, keys)
+    if keys:
+        logger.info("Staged images evicted", extra={"reason": reason, "evicted": len(keys)})
+
+
+def reconcile(
+    conn,
+    store,
+    batch_size: int = 200,
+    max_workers: int = 8,
+    recheck_seconds: float = 300,
+    max_age: float = 3 * 24 * 60 * 60,
+    max_bytes: int = None,
+    photo_api_url: str = PHOTO_API_URL,
+    now: float = None,
+    target=None,
+):
+    """One pass over the staged images that are due a check. All of them are checked against Photo Center at once,
+    over a shared keep alive session. An image Photo Center has is forgotten, and its staged object is evicted when no
+    other arc image uses it. An image Photo Center does not have yet is checked again later, backing off exponentially.
+    The store is then held to its caps: objects older than max_age are evicted, then the oldest objects until the
+    store is under max_bytes, whether Photo Center has them or not.
+    A fan-out target's images are checked in the target's own org."""
+    now = time.time() if now is None else now
+    org = target.org if target else get_settings().arc_org_id
+    headers = bearer_token(target and target.token)
+    due = inventory.select_staged_images_due(conn, now, batch_size)
+    stats = {"checked": len(due), "verified": 0, "unverified": 0, "evicted": 0}
+
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        urls = [photo_api_url.format(org=org, arc_id=arc_id) for _, arc_id, _ in due]
+        results = list(pool.map(lambda url: check_photo(session, url, headers), urls))
+
+    verified = [(key, arc_id) for (key, arc_id, _), ok in zip(due, results) if ok]
+    retries = []
+    for (key, arc_id, attempts), ok in zip(due, results):
+        if not ok:
+            # exponential backoff with jitter, so a burst of images staged together is not rechecked together
+            backoff = min(recheck_seconds * 2**attempts, MAX_BACKOFF) * random.uniform(0.8, 1.2)
+            retries.append((attempts + 1, now + backoff, key, arc_id))
+    inventory.delete_staged_images(conn, verified)
+    inventory.update_staged_images_check(conn, retries)
+    stats["verified"] = len(verified)
+    stats["unverified"] = len(retries)
+
+    # evict the verified objects no other arc image is still waiting on
+    verified_keys = {key for key, _ in verified}
+    still_used = {key for key, _, _ in inventory.select_staged_keys(conn, verified_keys)}
+    unused = sorted(verified_keys - still_used)
+    evict(conn, store, unused, "verified")
+    stats["evicted"] += len(unused)
+
+    staged = inventory.select_staged_keys(conn)
+    expired = {key for key, _, staged_at in staged if staged_at < now - max_age}
+    if expired:
+        logger.warning(
+            "Staged images evicted before Photo Center was verified to have them", extra={"evicted": len(expired)}
+        )
+    evict(conn, store, sorted(expired), "max_age")
+    stats["evicted"] += len(expired)
+
+    staged = [row for row in staged if row[0] not in expired]
+    total = sum(size or 0 for _, size, _ in staged)
+    oversize = []
+    if max_bytes is not None:
+        for key, size, _ in staged:
+            if total <= max_bytes:
+                break
+            oversize.append(key)
+            total -= size or 0
+    evict(conn, store, oversize, "max_bytes")
+    stats["evicted"] += len(oversize)
+
+    stats["staged_bytes"] = total
+    stats["staged_objects"] = len(staged) - len(oversize)
+    logger.info("Staging store reconciled", extra=stats)
+    return stats
+
+
+def reconcile_from_config(conn, store, target=None):
+    return reconcile(
+        conn,
+        store,
+        batch_size=config("AP_STAGING_RECONCILE_BATCH", default=200, cast=int),
+        recheck_seconds=get_settings().staging_recheck_seconds,
+        max_age=config("AP_STAGING_MAX_AGE", default=3 * 24 * 60 * 60, cast=float),
+        max_bytes=config("AP_STAGING_MAX_BYTES", default=None, cast=lambda v: int(v) if v else None),
+        photo_api_url=config("PHOTO_API_URL", default=PHOTO_API_URL),
+        target=target,
+    )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    staging_store = staging_store_from_config()
+    if staging_store is None:
+        print("AP_IMAGE_STAGING is not set, there is no staging store to reconcile")
+    else:
+        db = inventory.create_connection(get_settings().sqldb_location)
+        inventory.create_table(db)
+        reconcile_from_config(db, staging_store)
+        db.close()
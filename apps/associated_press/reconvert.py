@@ -0,0 +1,102 @@
+# Converts the archived AP payloads again, see utils/archive.py, and sends only the items whose ANS is now different
+# from the ANS that was sent for them. Used to roll out converter changes, or to backfill items that were archived
+# but never sent, without downloading anything from AP.
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from apps import associated_press as ap
+from utils import inventory
+from utils.archive import RawArchive, ans_digest, get_archive
+from utils.logger import get_logger
+from utils.settings import get_settings
+from utils.staging import staging_store_from_config
+
+logger = get_logger()
+
+_worker_archive = None
+
+
+def open_worker_archive(directory: str):
+    global _worker_archive
+    _worker_archive = RawArchive(directory, read_only=True)
+
+
+def archived_converter(item: dict, story_data: bytes):
+    if item.get("type") == "text":
+        return ap.story_converter(item, story_data)
+    return ap.fetch_photo_item(item)
+
+
+def convert_archived(entry: tuple, archive: RawArchive = None):
+    """convert one archived item, returns its source_id, version and whether its ans differs from the ans sent"""
+    source_id, version, _, segment, offset, length, sent_digest = entry
+    try:
+        item, story_data = (archive or _worker_archive).read(segment, offset, length)
+        ans = archived_converter(item, story_data).convert_ans()
+        return source_id, version, ans_digest(ans) != sent_digest
+    except Exception as e:
+        logger.error(e, extra={"source_id": source_id, "version": version})
+        return source_id, version, None
+
+
+def reconvert(conn, archive: RawArchive, since: float = 0, workers: int = None, dry_run: bool = False, store=None):
+    """Convert the newest archived version of every item archived since the epoch seconds given, over several processes,
+    then send the items whose ans changed. With one worker the items are converted in this process.
+    When a staging store is configured the changed photos are relayed into it first, as process_wires does."""
+    entries = archive.latest_versions(since)
+    started = time.monotonic()
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        results = [convert_archived(entry, archive) for entry in entries]
+    else:
+        with ProcessPoolExecutor(workers, initializer=open_worker_archive, initargs=(archive.directory,)) as pool:
+            results = list(pool.map(convert_archived, entries, chunksize=16))
+
+    changed = [entry for entry, (_, _, differs) in zip(entries, results) if differs]
+    stats = {
+        "archived": len(entries),
+        "changed": len(changed),
+        "unchanged": sum(1 for _, _, differs in results if differs is False),
+        "failed": sum(1 for _, _, differs in results if differs is None),
+        "convert_seconds": time.monotonic() - started,
+    }
+    logger.info("Archive reconverted", extra={**stats, "dry_run": dry_run})
+    if dry_run:
+        return stats
+
+    converters = []
+    for source_id, version, arc_type, segment, offset, length, _ in changed:
+        item, story_data = archive.read(segment, offset, length)
+        converters.append((arc_type, archived_converter(item, story_data)))
+    if store is None:
+        store = staging_store_from_config()
+    if store is not None:
+        ap.stage_images([converter for arc_type, converter in converters if arc_type != "story"], conn, store)
+    for index, (arc_type, converter) in enumerate(converters):
+        count = f"{index + 1} of {len(changed)}"
+        if arc_type == "story":
+            ap.process_wire_story(converter, count, conn, resend=True)
+        else:
+            ap.process_wire_photo(converter, count, conn, resend=True)
+    return stats
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(
+        description="Convert archived AP payloads again and send the items whose ANS changed"
+    )
+    parser.add_argument("--since-hours", type=float, default=None, help="only items archived in the last N hours")
+    parser.add_argument("--workers", type=int, default=None, help="conversion processes, defaults to the cpu count")
+    parser.add_argument("--dry-run", action="store_true", help="report what changed without sending anything")
+    args = parser.parse_args()
+
+    raw_archive = get_archive()
+    if raw_archive is None:
+        parser.error("AP_ARCHIVE_DIR is not set, there is no archive to reconvert")
+    db = inventory.create_connection(get_settings().sqldb_location)
+    inventory.create_table(db)
+    since_time = time.time() - args.since_hours * 60 * 60 if args.since_hours else 0
+    reconvert(db, raw_archive, since_time, args.workers, args.dry_run)
+    db.close()
@@ -0,0 +1,66 @@
+# Relays AP images into a staging store before their ANS is sent, see utils/staging.py.
+# The image is streamed from AP in chunks, hashed as it arrives and spooled to disk once it outgrows memory_limit,
+# so neither the download nor the upload holds a whole image in memory. Images are stored under the sha256 of their
+# bytes, so an image AP sends under several items is uploaded once.
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from utils.logger import get_logger
+
+logger = get_logger()
+
+CHUNK_SIZE = 64 * 1024
+MEMORY_LIMIT = 1024 * 1024
+
+
+def staging_key(digest: str, converter):
+    extension = os.path.splitext(converter.source_data.get("originalfilename") or "")[1].lower()
+    return f"{digest}{extension}"
+
+
+def relay_image(converter, store, headers: dict):
+    """stream one AP image into the store, set and return its staged url, or None when the download fails"""
+    url = converter.source_data.get("download_url")
+    extra = {"source_id": converter.source_data.get("source_id"), "download_url": url}
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with requests.get(url, headers=headers, stream=True) as res, tempfile.SpooledTemporaryFile(
+            MEMORY_LIMIT
+        ) as spool:
+            res.raise_for_status()
+            for chunk in res.iter_content(CHUNK_SIZE):
+                digest.update(chunk)
+                spool.write(chunk)
+                size += len(chunk)
+            key = staging_key(digest.hexdigest(), converter)
+            if store.exists(key):
+                logger.info("Relayed image already staged", extra={**extra, "key": key})
+            else:
+                spool.seek(0)
+                store.put(key, spool, res.headers.get("Content-Type"))
+                logger.info("Relayed image staged", extra={**extra, "key": key, "bytes": size})
+    except Exception as e:
+        logger.error(e, extra=extra)
+        return None
+
+    converter.staged_key = key
+    converter.staged_size = size
+    converter.staged_url = store.url(key)
+    return converter.staged_url
+
+
+def relay_images(converters: list, store, headers: dict, max_workers: int = 4):
+    """relay the images of the photo converters that have not been staged yet, at most max_workers at a time.
+    returns the converters that were staged"""
+    pending = [c for c in converters if c.staged_url is None and c.source_data.get("download_url")]
+    if not pending:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        staged = list(pool.map(lambda c: relay_image(c, store, headers), pending))
+    logger.info("Relayed images", extra={"relayed": sum(1 for url in staged if url), "failed": staged.count(None)})
+    return [c for c in pending if c.staged_url]
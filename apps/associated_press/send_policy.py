@@ -0,0 +1,187 @@
+# How Migration Center sends are retried, and when they stop. A send that failed because Arc is having trouble
+# (a timeout, a dropped connection, a 5xx or a 429) is retried with exponential backoff and jitter. A send Arc refused
+# (any other 4xx, usually invalid ANS) is not, because it would fail again. A circuit breaker watches the outcome of
+# recent sends from both lanes, stories and photos, and once too many of them fail it stops all sends for a cooldown,
+# then lets a single probe through to find out whether Arc has recovered.
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from decouple import config
+
+from utils.exceptions import CircuitOpenException
+from utils.logger import get_logger
+
+logger = get_logger()
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# the breaker state as a number, for dashboards built on the logs
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def is_retryable(error: Exception, status_code: int = None):
+    """True when the send failed because of arc, not because of what was sent"""
+    if status_code is not None and (status_code in RETRY_STATUS or status_code >= 500):
+        return True
+    return isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+
+
+def is_unavailable(error: Exception):
+    """True when a send failed because arc could not take it, the breaker refused it or its last retry failed too,
+    so the same wire can be sent again later"""
+    if isinstance(error, CircuitOpenException):
+        return True
+    res = getattr(error, "response", None)
+    return is_retryable(error, getattr(res, "status_code", None))
+
+
+class CircuitBreaker:
+    def __init__(
+        self, window: int = 20, threshold: float = 0.5, min_calls: int = 5, cooldown: float = 60, clock=time.monotonic
+    ):
+        self.window = window
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.clock = clock
+        self.outcomes = deque(maxlen=window)
+        self.state = CLOSED
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def transition(self, state: str):
+        if state != self.state:
+            self.state = state
+            logger.warning("Migration Center circuit breaker", extra=self.metrics())
+
+    def metrics(self):
+        return {
+            "breaker_state": self.state,
+            "breaker_state_value": STATE_VALUES[self.state],
+            "error_rate": self.error_rate,
+            "calls": len(self.outcomes),
+        }
+
+    def allow(self):
+        """whether a send may go ahead. once the cooldown has passed an open breaker lets one probe through"""
+        with self.lock:
+            if self.state == OPEN and self.clock() - self.opened_at >= self.cooldown:
+                self.transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self.probing:
+                    return False
+                self.probing = True
+                return True
+            return self.state == CLOSED
+
+    @property
+    def is_open(self):
+        """an open breaker still cooling down, unlike allow this never uses up the probe"""
+        return self.state == OPEN and self.clock() - self.opened_at < self.cooldown
+
+    def retry_in(self):
+        """seconds until an open breaker lets a probe through"""
+        if self.state != OPEN:
+            return 0
+        return max(self.cooldown - (self.clock() - self.opened_at), 0)
+
+    def record(self, success: bool):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probing = False
+                if success:
+                    self.outcomes.clear()
+                    self.transition(CLOSED)
+                else:
+                    self.opened_at = self.clock()
+                    self.transition(OPEN)
+                return
+            self.outcomes.append(success)
+            if self.state == CLOSED and len(self.outcomes) >= self.min_calls and self.error_rate >= self.threshold:
+                self.opened_at = self.clock()
+                self.transition(OPEN)
+
+
+class SendPolicy:
+    def __init__(
+        self,
+        breaker: CircuitBreaker,
+        retries: int = 2,
+        backoff_base: float = 1,
+        backoff_cap: float = 30,
+        timeout: float = 30,
+    ):
+        self.breaker = breaker
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+
+    def backoff(self, attempt: int, res=None):
+        """full jitter exponential backoff, or the Retry-After arc asked for"""
+        retry_after = res.headers.get("Retry-After") if res is not None and getattr(res, "headers", None) else None
+        if retry_after and str(retry_after).isdigit():
+            return min(float(retry_after), self.backoff_cap)
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2**attempt))
+
+    def post(self, url: str, slot=None, **kwargs):
+        """post to migration center, retrying what can be retried. slot is called before every attempt, retries
+        included, to take one of the lane's rate limited calls. raises CircuitOpenException without sending when the
+        breaker is open, and otherwise the error of the last attempt"""
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenException
+            if slot is not None:
+                slot()
+            res = None
+            try:
+                res = requests.post(url, timeout=self.timeout, **kwargs)
+                res.raise_for_status()
+                self.breaker.record(True)
+                return res
+            except Exception as e:
+                retryable = is_retryable(e, getattr(res, "status_code", None))
+                # a refused send says nothing about arc's health
+                self.breaker.record(not retryable)
+                if not retryable or attempt >= self.retries:
+                    if getattr(e, "response", None) is None:
+                        e.response = res
+                    raise
+                wait = self.backoff(attempt, res)
+                logger.warning(
+                    "Migration Center send failed, retrying",
+                    extra={"url": url, "attempt": attempt + 1, "wait": wait, "error": str(e)},
+                )
+                time.sleep(wait)
+                attempt += 1
+
+
+def send_policy_from_config():
+    breaker = CircuitBreaker(
+        window=config("AP_BREAKER_WINDOW", default=20, cast=int),
+        threshold=config("AP_BREAKER_THRESHOLD", default=0.5, cast=float),
+        min_calls=config("AP_BREAKER_MIN_CALLS", default=5, cast=int),
+        cooldown=config("AP_BREAKER_COOLDOWN", default=60, cast=float),
+    )
+    return SendPolicy(
+        breaker,
+        retries=config("AP_SEND_RETRIES", default=2, cast=int),
+        backoff_base=config("AP_SEND_BACKOFF_BASE", default=1, cast=float),
+        backoff_cap=config("AP_SEND_BACKOFF_CAP", default=30, cast=float),
+        timeout=config("AP_SEND_TIMEOUT", default=30, cast=float),
+    )
+
+
+# shared by process_wire_story and process_wire_photo, so an outage seen by one lane pauses the other
+migration_center = send_policy_from_config()
@@ -0,0 +1,219 @@
+import heapq
+import itertools
+import time
+from collections import defaultdict
+from typing import Callable, Optional
+
+from decouple import config
+
+from utils.lazy import lazy_module
+from utils.logger import get_logger
+
+arrow = lazy_module("arrow")
+
+logger = get_logger()
+
+# ap urgency runs from 1, the most urgent, to 8. some items only carry a letter editorialpriority.
+EDITORIAL_PRIORITY_URGENCY = {"f": 1, "b": 2, "u": 3, "r": 4, "d": 5, "a": 6}
+DEFAULT_URGENCY = 4
+# at the same urgency a story goes ahead of a photo
+PHOTO_URGENCY_OFFSET = 0.5
+
+
+def urgency(converter):
+    """the ap urgency of a wire, lower values are sent first"""
+    source_data = converter.source_data
+    value = source_data.get("urgency")
+    if value is None:
+        value = EDITORIAL_PRIORITY_URGENCY.get(str(source_data.get("editorialpriority") or "").lower(), DEFAULT_URGENCY)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_URGENCY
+
+
+class SendQueue:
+    """Wires waiting to be sent to Migration Center, keyed by AP source_id and ordered by priority.
+    AP publishes several versions of a developing story within minutes. When a newer version of an item arrives while
+    an older one is still waiting, the older one is replaced where it sits in line, so only the latest version spends
+    a rate limited call. Stories can also be held for hold_seconds after their last change, giving more versions a
+    chance to coalesce before one is sent.
+
+    Wires are sent most urgent first, stories before photos, and newest first among equals. Every aging_seconds a wire
+    waits moves it up one urgency level, so routine wires still get through on a busy news day.
+    Because aging is linear in the time waited, a wire's place in line is fixed when it is queued, and a heap keeps it.
+    """
+
+    def __init__(
+        self, hold_seconds: float = 0, aging_seconds: float = 300, clock: Callable[[], float] = time.monotonic
+    ):
+        self.hold_seconds = hold_seconds
+        self.aging_seconds = aging_seconds
+        self.clock = clock
+        self.coalesced = 0
+        # per urgency: wires sent, total and max seconds waited in the queue and since ap firstcreated
+        self.latency = defaultdict(
+            lambda: {"count": 0, "wait_total": 0.0, "wait_max": 0.0, "lag_count": 0, "lag_total": 0.0, "lag_max": 0.0}
+        )
+        # source_id -> entry. an entry left in the heap is stale once it is no longer the one in here
+        self._entries = {}
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, source_id):
+        return source_id in self._entries
+
+    def __iter__(self):
+        """the queued wires, in the order they will be sent"""
+        return iter([entry["converter"] for entry in sorted(self._entries.values(), key=lambda e: e["key"])])
+
+    @staticmethod
+    def source_id(converter):
+        return converter.source_data.get("source_id")
+
+    @staticmethod
+    def version(converter):
+        # ap dates are all in the same iso format, so comparing the strings orders the versions
+        return converter.source_data.get("versioncreated") or ""
+
+    @staticmethod
+    def rank(converter):
+        offset = PHOTO_URGENCY_OFFSET if converter.source_data.get("type") == "picture" else 0
+        return urgency(converter) + offset
+
+    @staticmethod
+    def recency(converter):
+        firstcreated = converter.source_data.get("firstcreated")
+        return -arrow.get(firstcreated).int_timestamp if firstcreated else 0
+
+    def _push(self, converter, queued: float, changed: float, deferred: bool = False):
+        key = (
+            deferred,
+            self.rank(converter) * self.aging_seconds + queued,
+            self.recency(converter),
+            next(self._sequence),
+        )
+        entry = {"key": key, "converter": converter, "queued": queued, "changed": changed, "deferred": deferred}
+        self._entries[self.source_id(converter)] = entry
+        heapq.heappush(self._heap, (key, entry))
+
+    def put(self, converter, now: Optional[float] = None):
+        """queue a wire, returns True when it replaced an older version already waiting to be sent"""
+        now = self.clock() if now is None else now
+        source_id = self.source_id(converter)
+        queued = self._entries.get(source_id)
+        if queued is None:
+            self._push(converter, now, now)
+            return False
+
+        if self.version(converter) < self.version(queued["converter"]):
+            logger.info("Older version of a queued wire ignored", extra={"source_id": source_id})
+            converter.trace.finish(outcome="older_version")
+            return False
+
+        if queued["converter"] is not converter:
+            queued["converter"].trace.finish(outcome="replaced")
+
+        # the newer version keeps the time the older one was queued, so it does not lose the aging it has earned
+        self._push(converter, queued["queued"], now, queued["deferred"])
+        self.coalesced += 1
+        logger.info(
+            "Queued wire replaced by newer version",
+            extra={
+                "source_id": source_id,
+                "versioncreated": self.version(converter),
+                "replaced": self.version(queued["converter"]),
+            },
+        )
+        return True
+
+    def extend(self, converters):
+        """queue a batch of wires at the same moment, so within the batch they are ordered by priority alone"""
+        now = self.clock()
+        for converter in converters:
+            self.put(converter, now)
+
+    def remove(self, converter):
+        self._entries.pop(self.source_id(converter), None)
+
+    def is_deferred(self, converter):
+        entry = self._entries.get(self.source_id(converter))
+        return entry is not None and entry["deferred"]
+
+    def defer(self, converter):
+        """move a wire behind every wire that has not been deferred"""
+        entry = self._entries.get(self.source_id(converter))
+        if entry and not entry["deferred"]:
+            self._push(converter, entry["queued"], entry["changed"], deferred=True)
+
+    def is_ready(self, entry: dict, now: float):
+        # only stories are worth holding back, photos do not change the way developing stories do
+        if entry["converter"].source_data.get("type") != "text":
+            return True
+        return now - entry["changed"] >= self.hold_seconds
+
+    def next_ready_in(self):
+        """seconds until the first held wire can be sent, or None when nothing is queued"""
+        if not self._entries:
+            return None
+        now = self.clock()
+        waits = [0 if self.is_ready(e, now) else e["changed"] + self.hold_seconds - now for e in self._entries.values()]
+        return max(min(waits), 0)
+
+    def pop_ready(self, flush: bool = False):
+        """remove and return the first wire in line whose hold has expired, or the first wire in line when flushing"""
+        now = self.clock()
+        held = []
+        converter = None
+        while self._heap:
+            key, entry = heapq.heappop(self._heap)
+            source_id = self.source_id(entry["converter"])
+            if self._entries.get(source_id) is not entry:
+                continue
+            if flush or self.is_ready(entry, now):
+                del self._entries[source_id]
+                converter = entry["converter"]
+                self.record_latency(entry, now)
+                break
+            held.append((key, entry))
+        for item in held:
+            heapq.heappush(self._heap, item)
+        return converter
+
+    def record_latency(self, entry: dict, now: float):
+        converter = entry["converter"]
+        stats = self.latency[urgency(converter)]
+        wait = now - entry["queued"]
+        stats["count"] += 1
+        stats["wait_total"] += wait
+        stats["wait_max"] = max(stats["wait_max"], wait)
+        firstcreated = converter.source_data.get("firstcreated")
+        if firstcreated:
+            lag = (arrow.utcnow() - arrow.get(firstcreated)).total_seconds()
+            stats["lag_count"] += 1
+            stats["lag_total"] += lag
+            stats["lag_max"] = max(stats["lag_max"], lag)
+
+    def latency_report(self):
+        """average and max seconds waited per urgency, in the queue and since ap firstcreated"""
+        return {
+            str(level): {
+                "sent": stats["count"],
+                "avg_wait": stats["wait_total"] / stats["count"],
+                "max_wait": stats["wait_max"],
+                "avg_lag": stats["lag_total"] / stats["lag_count"] if stats["lag_count"] else None,
+                "max_lag": stats["lag_max"],
+            }
+            for level, stats in sorted(self.latency.items())
+            if stats["count"]
+        }
+
+
+def send_queue_from_config():
+    return SendQueue(
+        hold_seconds=config("AP_COALESCE_HOLD_SECONDS", default=0, cast=float),
+        aging_seconds=config("AP_PRIORITY_AGING_SECONDS", default=300, cast=float),
+    )
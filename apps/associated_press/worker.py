@@ -0,0 +1,187 @@
+# Several copies of the ingest sharing one SQLite inventory file. The workers follow one feed cursor, kept in the
+# ap_feed_cursors table, so each page is read once and its items are offered to all of them through the ap_leases
+# table. Each item is claimed, fetched, converted and sent by one worker only. A worker keeps its leases alive with a
+# heartbeat while it works, and when a worker dies its leases expire and the other workers steal its items.
+import argparse
+import os
+import socket
+import time
+from threading import Event, Thread
+
+from decouple import config
+
+from apps import associated_press as ap
+from utils import inventory
+from utils.logger import get_logger
+from utils.settings import get_settings
+from utils.staging import staging_store_from_config
+
+logger = get_logger()
+
+# the workers' shared row in ap_feed_cursors, apart from the poller's
+LEASE_FEED = "leases"
+
+
+class Heartbeat(Thread):
+    """extends the worker's leases every ttl / 3 seconds, over a connection of its own, until stopped"""
+
+    def __init__(self, sqldb_location: str, worker: str, ttl: float, busy_timeout: float = 30):
+        super().__init__(daemon=True)
+        self.sqldb_location = sqldb_location
+        self.worker = worker
+        self.ttl = ttl
+        self.busy_timeout = busy_timeout
+        self.stopped = Event()
+        self.held = 0
+
+    def run(self):
+        conn = inventory.share_connection(inventory.create_connection(self.sqldb_location), self.busy_timeout)
+        try:
+            while not self.stopped.wait(self.ttl / 3):
+                extended = inventory.heartbeat_leases(conn, self.worker, time.time() + self.ttl)
+                if extended < self.held:
+                    logger.warning(
+                        "Leases lost to another worker", extra={"worker": self.worker, "lost": self.held - extended}
+                    )
+                self.held = extended
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Worker:
+    def __init__(
+        self,
+        conn,
+        sqldb_location: str,
+        worker_id: str = None,
+        ttl: float = 300,
+        batch_size: int = 50,
+        busy_timeout: float = 30,
+        store=None,
+    ):
+        """conn is set up with inventory.share_connection, as the heartbeat's own connection is. with a staging store,
+        see utils/staging.py, the images of the wires sent are relayed through it, as the poller's are"""
+        self.conn = conn
+        self.sqldb_location = sqldb_location
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.busy_timeout = busy_timeout
+        self.store = store
+
+    def cycle(self, stop: Event = None):
+        """offer the next page of the feed, then claim, send and complete a batch of items. returns the items claimed"""
+        previous = inventory.select_feed_cursor(self.conn, LEASE_FEED)
+        items, page = ap.fetch_feed_page(previous)
+        now = time.time()
+        offered = inventory.offer_leases(self.conn, items or [], now)
+        # the items are in ap_leases now, so the next page is safe to move on to. on a failed request the cursor stays,
+        # and when another worker read the same page first its offers were ignored and the cursor is already past it
+        if page:
+            inventory.advance_feed_cursor(self.conn, LEASE_FEED, previous, page)
+        expired = inventory.expire_leases(self.conn, now)
+        if expired:
+            logger.warning(
+                "Leases expired", extra={"worker": self.worker_id, "workers": sorted({w for _, _, w in expired})}
+            )
+        claimed = inventory.claim_leases(self.conn, self.worker_id, self.batch_size, self.ttl, now)
+        expired_keys = {(source_id, version) for source_id, version, _ in expired}
+        stolen = [
+            (source_id, version)
+            for source_id, version, _, previous in claimed
+            if (source_id, version) in expired_keys or (previous and previous != self.worker_id)
+        ]
+        logger.info(
+            "Leases claimed",
+            extra={"worker": self.worker_id, "offered": offered, "claimed": len(claimed), "stolen": len(stolen)},
+        )
+        if not claimed:
+            return []
+
+        keys = [(source_id, version) for source_id, version, _, _ in claimed]
+        heartbeat = Heartbeat(self.sqldb_location, self.worker_id, self.ttl, self.busy_timeout)
+        heartbeat.held = len(claimed)
+        heartbeat.start()
+        try:
+            wires = ap.build_wires([item for _, _, item, _ in claimed])
+            left = ap.process_wires(wires, self.conn, stop, store=self.store)
+        except Exception:
+            # given back at once, rather than held until they expire
+            inventory.release_leases(self.conn, self.worker_id, keys)
+            raise
+        finally:
+            heartbeat.stop()
+        # a wire process_wires did not get to, because it stopped first or the circuit opened, or that arc could not
+        # take, is given back for another cycle or worker. an item build_wires dropped, or a wire that failed, is
+        # complete, as it is when one worker runs on its own
+        unsent = {(c.source_data.get("source_id"), c.source_data.get("versioncreated") or "") for c in left}
+        inventory.release_leases(self.conn, self.worker_id, [key for key in keys if key in unsent])
+        done = [key for key in keys if key not in unsent]
+        inventory.complete_leases(self.conn, self.worker_id, done, time.time())
+        return claimed
+
+
+def run_worker(stop: Event = None, max_cycles: int = None, worker_id: str = None):
+    stop = stop or Event()
+    sqldb_location = get_settings().sqldb_location
+    busy_timeout = config("AP_LEASE_BUSY_TIMEOUT", default=30, cast=float)
+    conn = inventory.share_connection(inventory.create_connection(sqldb_location), busy_timeout)
+    inventory.create_table(conn)
+    worker = Worker(
+        conn,
+        sqldb_location,
+        worker_id,
+        ttl=config("AP_LEASE_TTL", default=300, cast=float),
+        batch_size=config("AP_LEASE_BATCH", default=50, cast=int),
+        busy_timeout=busy_timeout,
+        store=staging_store_from_config(),
+    )
+    interval = config("AP_POLL_MIN_INTERVAL", default=30, cast=float)
+    max_wait = config("AP_POLL_MAX_STALENESS", default=600, cast=float)
+    cycles = 0
+    # cycles failed in a row
+    failures = 0
+    try:
+        while not stop.is_set() and (max_cycles is None or cycles < max_cycles):
+            cycles += 1
+            try:
+                worker.cycle(stop)
+                wait = interval
+                failures = 0
+            except Exception as e:
+                # as in the poller, a failed request or a locked database is no reason to stop, the next cycle tries
+                # again, later the more cycles in a row have failed
+                failures += 1
+                wait = min(interval * 2 ** (failures - 1), max_wait)
+                logger.error(
+                    "Worker cycle failed",
+                    extra={
+                        "worker": worker.worker_id,
+                        "cycle": cycles,
+                        "error": repr(e),
+                        "failures": failures,
+                        "wait": wait,
+                    },
+                )
+            if max_cycles is None or cycles < max_cycles:
+                stop.wait(wait)
+    finally:
+        conn.close()
+    return cycles
+
+
+if __name__ == "__main__":  # pragma: no cover
+    from apps.associated_press.poll import install_signal_handlers
+
+    parser = argparse.ArgumentParser(
+        description="Run one of several ingest workers sharing the SQLDB_LOCATION inventory"
+    )
+    parser.add_argument("--worker-id", default=None, help="defaults to the host name and process id")
+    args = parser.parse_args()
+    stop_event = Event()
+    install_signal_handlers(stop_event)
+    run_worker(stop_event, worker_id=args.worker_id)
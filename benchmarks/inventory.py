@@ -0,0 +1,297 @@
+# How the inventory in utils/inventory.py behaves at the sizes it runs at. For each size a synthetic inventory is
+# built, with rows shaped like the ones the ingest writes, and the benchmark measures:
+# - the p50/p95/p99 latency of select_inventory_by_sha1, for a sha1 in the inventory and for one that is not,
+#   select_inventory_by_source, and create_inventory
+# - the rows per second of create_inventory, which commits every row, against one transaction per batch of rows
+# - the size of the database file
+# - the latency of sha1 lookups from reader threads, each with its own connection, while a writer inserts, and how
+#   often one of them found the database locked
+# The report is json, with the schema the numbers were measured on, so the report of one schema can be compared with
+# another's, see --compare. Built databases are kept in --dir and reused, a 10M row inventory takes a while to build.
+import argparse
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from utils import inventory
+from utils.freshness import percentiles
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+BUILD_BATCH = 100_000
+# the rows the measurements insert are numbered from here, and deleted again after, so a built database can be reused
+MEASURED_FROM = 10**12
+
+# a regression is a latency that grew, or a rate that fell, by more than the tolerance
+LOWER_IS_BETTER = ["_us", "_bytes", "locked"]
+
+
+def synthetic_row(n: int):
+    """the nth synthetic inventory row, shaped like the rows process_wire_story and process_wire_photo write"""
+    source_id = hashlib.md5(f"source {n}".encode()).hexdigest()
+    arc_id = base64.b32encode(hashlib.md5(f"arc {n}".encode()).digest()).decode()[:26]
+    sha1 = hashlib.sha1(f"item {n}".encode()).hexdigest()
+    arc_type = "image" if n % 3 else "story"
+    ap_url = f"https://api.ap.org/media/v/content/{source_id}?qt=benchmark&et=0a1aza3c0"
+    # spread over 2022
+    updated = 1640995200 + n % (365 * 24 * 60 * 60)
+    return source_id, arc_id, ap_url, arc_type, sha1, updated
+
+
+def missing_sha1(n: int):
+    """a sha1 no synthetic row has"""
+    return hashlib.sha1(f"missing {n}".encode()).hexdigest()
+
+
+def build(path: str, rows: int):
+    """a database at path holding rows synthetic inventory rows, reused when one is already there"""
+    conn = inventory.create_connection(path)
+    inventory.create_table(conn)
+    existing = inventory.select_inventory_count(conn)
+    started = time.perf_counter()
+    for start in range(existing, rows, BUILD_BATCH):
+        inventory.create_inventory_batch(conn, (synthetic_row(n) for n in range(start, min(start + BUILD_BATCH, rows))))
+    conn.execute("ANALYZE;")
+    conn.close()
+    return {"built_rows": rows - existing, "build_seconds": time.perf_counter() - started}
+
+
+def timed(func, values):
+    """microseconds each call of func took, one call per value"""
+    timings = []
+    for value in values:
+        started = time.perf_counter()
+        func(value)
+        timings.append((time.perf_counter() - started) * 1_000_000)
+    return timings
+
+
+def latency(timings: list):
+    return {f"{key}_us": value for key, value in percentiles(timings).items()}
+
+
+def measure_lookups(conn, rows: int, probes: int):
+    # spread over the whole table, rather than the rows inserted last
+    step = max(rows // probes, 1)
+    present = [synthetic_row(n) for n in range(0, rows, step)][:probes]
+    return {
+        "select_by_sha1_hit": latency(
+            timed(lambda sha1: inventory.select_inventory_by_sha1(conn, sha1), [r[4] for r in present])
+        ),
+        "select_by_sha1_miss": latency(
+            timed(lambda sha1: inventory.select_inventory_by_sha1(conn, sha1), [missing_sha1(n) for n in range(probes)])
+        ),
+        "select_by_source": latency(
+            timed(lambda source_id: inventory.select_inventory_by_source(conn, source_id), [r[0] for r in present])
+        ),
+    }
+
+
+def measure_inserts(conn, next_row: int, inserts: int, batch: int):
+    """create_inventory one row and one commit at a time, then the same number of rows per transaction of batch rows.
+    returns the results and the next synthetic row not in the table"""
+    singles = [synthetic_row(n) for n in range(next_row, next_row + inserts)]
+    timings = timed(lambda row: inventory.create_inventory(conn, row), singles)
+    next_row += inserts
+    started = time.perf_counter()
+    for start in range(next_row, next_row + inserts, batch):
+        inventory.create_inventory_batch(
+            conn, [synthetic_row(n) for n in range(start, min(start + batch, next_row + inserts))]
+        )
+    batched_seconds = time.perf_counter() - started
+    next_row += inserts
+    return {
+        "create_inventory": latency(timings),
+        "single_rows_per_second": inserts / (sum(timings) / 1_000_000),
+        "batched_rows_per_second": inserts / batched_seconds,
+        "batch_size": batch,
+    }, next_row
+
+
+def measure_concurrency(path: str, rows: int, next_row: int, readers: int, seconds: float):
+    """sha1 lookups from reader threads while one writer thread runs create_inventory, each on its own connection"""
+    stop = threading.Event()
+    lock = threading.Lock()
+    reads, locked = [], {"readers": 0, "writer": 0}
+    written = []
+
+    def reader(offset: int):
+        conn = inventory.create_connection(path)
+        timings, n = [], offset
+        while not stop.is_set():
+            sha1 = synthetic_row(n % rows)[4] if n % 2 else missing_sha1(n)
+            started = time.perf_counter()
+            try:
+                inventory.select_inventory_by_sha1(conn, sha1)
+                timings.append((time.perf_counter() - started) * 1_000_000)
+            except sqlite3.OperationalError:
+                with lock:
+                    locked["readers"] += 1
+            n += readers
+        conn.close()
+        with lock:
+            reads.extend(timings)
+
+    def writer():
+        conn = inventory.create_connection(path)
+        n = next_row
+        while not stop.is_set():
+            try:
+                inventory.create_inventory(conn, synthetic_row(n))
+                n += 1
+            except sqlite3.OperationalError:
+                with lock:
+                    locked["writer"] += 1
+        conn.close()
+        written.append(n - next_row)
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)] + [threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return {
+        "readers": readers,
+        "seconds": seconds,
+        "reads_per_second": len(reads) / seconds,
+        "writes_per_second": written[0] / seconds,
+        "read": latency(reads),
+        "readers_locked": locked["readers"],
+        "writer_locked": locked["writer"],
+    }, next_row + written[0]
+
+
+def file_bytes(path: str):
+    return sum(os.path.getsize(path + suffix) for suffix in ["", "-wal", "-journal"] if os.path.exists(path + suffix))
+
+
+def run_size(
+    directory: str,
+    rows: int,
+    probes: int = 1000,
+    inserts: int = 200,
+    batch: int = 1000,
+    readers: int = 4,
+    seconds: float = 5,
+):
+    path = os.path.join(directory, f"inventory-{rows}.db")
+    result = {"rows": rows, **build(path, rows)}
+    result["file_bytes"] = file_bytes(path)
+    conn = inventory.create_connection(path)
+    result["journal_mode"] = conn.execute("PRAGMA journal_mode;").fetchone()[0]
+    result["lookups"] = measure_lookups(conn, rows, probes)
+    result["inserts"], next_row = measure_inserts(conn, MEASURED_FROM, inserts, batch)
+    result["concurrent"], next_row = measure_concurrency(path, rows, next_row, readers, seconds)
+    for start in range(MEASURED_FROM, next_row, BUILD_BATCH):
+        inventory.delete_inventory(
+            conn, [synthetic_row(n)[0] for n in range(start, min(start + BUILD_BATCH, next_row))]
+        )
+    conn.close()
+    return result
+
+
+def schema():
+    """the statements the inventory table and its indexes were created with"""
+    conn = sqlite3.connect(":memory:")
+    inventory.create_table(conn)
+    sql = [
+        row[0]
+        for row in conn.execute(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = ? ORDER BY name;", (inventory.INVENTORY_TABLE,)
+        )
+    ]
+    conn.close()
+    return sql
+
+
+def run(directory: str, sizes: list, **kwargs):
+    os.makedirs(directory, exist_ok=True)
+    return {
+        "sqlite_version": sqlite3.sqlite_version,
+        "python": sys.version.split()[0],
+        "schema": schema(),
+        "sizes": {str(rows): run_size(directory, rows, **kwargs) for rows in sizes},
+    }
+
+
+def flatten(result: dict, prefix: str = ""):
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 1.5):
+    """the metrics of each size in both reports, as baseline, current and their ratio, and the regressions: a latency,
+    size or lock count that grew, or a rate that fell, by more than tolerance times"""
+    rows, problems = {}, []
+    for size, result in current["sizes"].items():
+        if size not in baseline["sizes"]:
+            continue
+        before = flatten(baseline["sizes"][size])
+        for metric, value in flatten(result).items():
+            if (
+                metric not in before
+                or metric.startswith(("build_", "built_", "rows"))
+                or metric in ["inserts.batch_size", "concurrent.readers", "concurrent.seconds"]
+            ):
+                continue
+            ratio = value / before[metric] if before[metric] else None
+            rows[f"{size}.{metric}"] = {"baseline": before[metric], "current": value, "ratio": ratio}
+            if ratio is None:
+                continue
+            worse = ratio > tolerance if any(s in metric for s in LOWER_IS_BETTER) else ratio < 1 / tolerance
+            if worse:
+                problems.append(f"{size} rows {metric}: {before[metric]:.6g} -> {value:.6g}")
+    return {"schema_changed": baseline["schema"] != current["schema"], "metrics": rows, "regressions": problems}
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description="Measure the inventory store at sizes up to millions of rows")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in SIZES), help="comma separated row counts")
+    parser.add_argument(
+        "--dir", default=os.path.join(ROOT, ".benchmarks"), help="where the databases are built and kept"
+    )
+    parser.add_argument("--probes", type=int, default=1000, help="lookups measured per size")
+    parser.add_argument("--inserts", type=int, default=200, help="rows inserted one by one, and again in batches")
+    parser.add_argument("--batch", type=int, default=1000, help="rows per transaction of the batched inserts")
+    parser.add_argument("--readers", type=int, default=4, help="reader threads beside the writer")
+    parser.add_argument("--seconds", type=float, default=5, help="how long readers and writer run together")
+    parser.add_argument("--out", help="write the report here as well")
+    parser.add_argument(
+        "--compare", metavar="BASELINE", help="compare with an earlier report, exit 1 with --check on a regression"
+    )
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+
+    report = run(
+        args.dir,
+        [int(s) for s in args.sizes.split(",") if s.strip()],
+        probes=args.probes,
+        inserts=args.inserts,
+        batch=args.batch,
+        readers=args.readers,
+        seconds=args.seconds,
+    )
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            report = compare(json.load(f), report, args.tolerance)
+        for problem in report["regressions"]:
+            print(problem, file=sys.stderr)
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if args.check and args.compare and report["regressions"] else 0)
@@ -0,0 +1,90 @@
+# Cold start of the ingest, which cron and serverless runs pay on every short poll: the time to import
+# apps.associated_press, and the time until its first feed request goes out. Each run is a fresh interpreter. With
+# --check it fails when either median is over its budget, or when a module that should be imported lazily was
+# imported at startup.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# only needed once an item is converted or sent, see utils/lazy.py. flask is only needed by the api
+LAZY_MODULES = ["arrow", "bs4", "flask", "html2ans", "jmespath", "slugify", "xmltodict"]
+
+# runs in the fresh interpreter. the feed request is answered by a stub, so nothing leaves the box
+CHILD = """
+import json, sys, time
+import unittest.mock as mock
+started = time.perf_counter()
+import apps.associated_press as ap
+imported = time.perf_counter()
+loaded = [m for m in LAZY_MODULES if m in sys.modules]
+first = []
+def get(*args, **kwargs):
+    first.append(time.perf_counter())
+    return mock.Mock(ok=True, status_code=200, content=b"{}", json=lambda: {"data": {"items": []}})
+with mock.patch("requests.get", get):
+    ap.fetch_feed_page()
+import_ms = (imported - started) * 1000
+print(json.dumps({"import_ms": import_ms, "first_request_ms": (first[0] - started) * 1000, "loaded": loaded}))
+"""
+
+# enough settings for get_settings to resolve, for a box without an .env
+BENCHMARK_ENV = {
+    "AP_API_KEY": "benchmark",
+    "ARC_ORG_ID": "sandbox.benchmark",
+    "ARC_ORG_WEBSITE": "benchmark",
+    "ARC_WEBSITE_SECTION": "/wires/ap",
+    "ARC_TOKEN_SANDBOX": "benchmark",
+}
+
+
+def run_once():
+    env = {**BENCHMARK_ENV, **os.environ, "PYTHONPATH": ROOT}
+    code = f"LAZY_MODULES = {LAZY_MODULES!r}\n{CHILD}"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def measure(runs: int = 5):
+    """the median import and first request times of several cold starts, and the lazy modules any of them imported"""
+    results = [run_once() for _ in range(runs)]
+    return {
+        "runs": runs,
+        "import_ms": statistics.median(r["import_ms"] for r in results),
+        "first_request_ms": statistics.median(r["first_request_ms"] for r in results),
+        "loaded": sorted({m for r in results for m in r["loaded"]}),
+    }
+
+
+def regressions(result: dict, import_budget_ms: float, first_request_budget_ms: float):
+    problems = []
+    if result["import_ms"] > import_budget_ms:
+        problems.append(f"import took {result['import_ms']:.0f}ms, over the {import_budget_ms:.0f}ms budget")
+    if result["first_request_ms"] > first_request_budget_ms:
+        problems.append(
+            f"first feed request after {result['first_request_ms']:.0f}ms, "
+            f"over the {first_request_budget_ms:.0f}ms budget"
+        )
+    if result["loaded"]:
+        problems.append(f"imported at startup: {', '.join(result['loaded'])}")
+    return problems
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description="Measure the cold start of the ingest")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--check", action="store_true", help="exit 1 when over budget or a lazy module was imported")
+    parser.add_argument("--import-budget-ms", type=float, default=400)
+    parser.add_argument("--first-request-budget-ms", type=float, default=500)
+    args = parser.parse_args()
+
+    startup = measure(args.runs)
+    print(json.dumps(startup, indent=2))
+    failures = regressions(startup, args.import_budget_ms, args.first_request_budget_ms)
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    sys.exit(1 if args.check and failures else 0)
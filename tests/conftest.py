@@ -1,10 +1,29 @@
 import codecs
 import json
 import os
+import unittest.mock as mock
+from functools import wraps
 from json.decoder import JSONDecodeError
 
 import pytest
 
+
+# To test any of the process_wire* functions, the @limits() decorator needs to be nullified
+# this runs before any test module imports apps.associated_press, where the decorators are applied
+def mock_decorator(*args, **kwargs):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            return f(*args, **kwargs)
+
+        return decorated_function
+
+    return decorator
+
+
+# used to nullify the @limits() decorator of the rate limited slots each process_wire* send takes
+mock.patch("ratelimit.limits", mock_decorator).start()
+
 _TEST_FOLDER = os.path.dirname(__file__)
 FIXTURE_DIR = os.path.join(_TEST_FOLDER, "fixtures")
 
@@ -0,0 +1,52 @@
+import freezegun
+
+from apps.associated_press.admission import DROP, AdmissionController
+from apps.associated_press.converter import APPhotoConverter, APStoryConverter
+from apps.associated_press.send_queue import SendQueue
+
+
+def story(source_id, firstcreated):
+    return APStoryConverter({"type": "text", "source_id": source_id, "firstcreated": firstcreated}, org_name="myorg")
+
+
+def photo(source_id, firstcreated):
+    return APPhotoConverter({"type": "picture", "source_id": source_id, "firstcreated": firstcreated}, org_name="myorg")
+
+
+@freezegun.freeze_time("2022-01-10 00:00")
+def test_expired_wires_dropped():
+    queue = SendQueue()
+    fresh = story("fresh", "2022-01-09T23:00:00Z")
+    expired = story("expired", "2022-01-06T00:00:00Z")
+    undated = photo("undated", None)
+    for converter in [fresh, expired, undated]:
+        queue.put(converter)
+
+    admission = AdmissionController()
+    assert admission.review(queue) == {"expired": 1}
+    assert list(queue) == [fresh, undated]
+
+
+@freezegun.freeze_time("2022-01-10 00:00")
+def test_backlog_makes_wire_stale():
+    # two stories a minute: the third story in line is sent a minute from now, and is then an hour and a minute old
+    queue = SendQueue()
+    wires = [story(str(i), "2022-01-09T23:30:00Z") for i in range(2)] + [story("2", "2022-01-09T23:00:00Z")]
+    wires.append(photo("3", "2022-01-09T23:10:00Z"))
+    for converter in wires:
+        queue.put(converter)
+
+    admission = AdmissionController(max_age=60 * 60)
+    assert admission.drain_seconds(queue) == 90
+    assert admission.review(queue) == {"deferred": 1}
+    # the photo lane has no backlog, so the photo is sent now, before it turns stale
+    assert list(queue) == [wires[0], wires[1], wires[3], wires[2]]
+    # a wire already deferred is not deferred, or counted, again by the next review
+    assert admission.review(queue) == {}
+    assert admission.shed == {"deferred": 1}
+    assert list(queue) == [wires[0], wires[1], wires[3], wires[2]]
+
+    admission = AdmissionController(max_age=60 * 60, stale_mode=DROP)
+    assert admission.review(queue) == {"stale": 1}
+    assert list(queue) == [wires[0], wires[1], wires[3]]
+    assert admission.shed == {"stale": 1}
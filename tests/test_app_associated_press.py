@@ -1,27 +1,11 @@
-import unittest.mock as mock
-from functools import wraps
-
-
-# To test any of the process_wire* functions, the @limits() decorator needs to be nullified
-def mock_decorator(*args, **kwargs):
-    def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            return f(*args, **kwargs)
-
-        return decorated_function
-
-    return decorator
-
-
-# used to nullify @limits() decorator used by process-wire* functions
-mock.patch("ratelimit.limits", mock_decorator).start()
-
 import http
+import json
+import unittest.mock as mock
 
 import freezegun
 import pytest
 import requests
+from html2ans.default import Html2Ans
 
 from apps.associated_press import (
     fetch_feed,
@@ -29,10 +13,18 @@ from apps.associated_press import (
     fetch_story_item,
     process_wire_photo,
     process_wire_story,
+    process_wires,
     run_ap_ingest_wires,
 )
-from apps.associated_press.converter import APPhotoConverter, APStoryConverter, AssociatedPressBaseConverter
+from apps.associated_press.converter import (
+    APPhotoConverter,
+    APStoryConverter,
+    AssociatedPressBaseConverter,
+    convert_photo_batch,
+)
 from tests.fixtures.content_elements import TEST_CASES as content_elements_tests
+from utils.archive import ans_digest
+from utils.block_cache import content_cache
 
 
 class MockResponse:
@@ -127,6 +119,35 @@ def test_base_converter(ap_type, arc_type):
     assert converter.get_expiration_date() == "2022-01-04T00:00:00Z"
 
 
+@freezegun.freeze_time("2022-01-01 00:00")
+def test_photo_batch_matches_convert_ans(monkeypatch, test_content):
+    monkeypatch.setattr(
+        requests,
+        "get",
+        lambda *args, **kwargs: MockResponse(
+            test_content.get_content("associated_press_feed_all_entitled_content.json")
+        ),
+    )
+    items = [test_content.get_content("ap_picture_item_test_converter_data.json")]
+    items += [item for item in fetch_feed() if item["type"] == "picture"]
+    story = APStoryConverter({"type": "text", "source_id": "s"}, org_name="myorg")
+    batch = [APPhotoConverter(dict(item), org_name="myorg") for item in items]
+    one_by_one = [APPhotoConverter(dict(item), org_name="myorg") for item in items]
+
+    assert convert_photo_batch(batch + [story]) == batch
+    assert [c.convert_ans() for c in batch] == [c.convert_ans() for c in one_by_one]
+    assert batch[0].get_sha1() == "ac40eec930916383cc39ebce51cb036227e2f2fe"
+    assert [c.get_sha1() for c in batch] == [c.get_sha1() for c in one_by_one]
+    # the constant fields are built once for the batch
+    assert batch[0].converted_ans["distributor"] is batch[1].converted_ans["distributor"]
+    # converted once, a second batch leaves them alone
+    assert convert_photo_batch(batch) == []
+    # a fan-out target shares the batch's conversion with its own org fields
+    target = batch[0].for_target("otherorg")
+    assert target.convert_ans()["_id"] != batch[0].converted_ans["_id"]
+    assert target.convert_ans()["additional_properties"]["sha1"] == batch[0].get_sha1()
+
+
 @freezegun.freeze_time("2022-01-01 00:00")  # mocks the use of arrow.utcnow() in the converter
 def test_photo_converter(test_content):
     converter = APPhotoConverter(test_content.get_content("ap_picture_item_test_converter_data.json"), org_name="myorg")
@@ -268,6 +289,39 @@ def test_story_content_elements(source_id, content_elements, test_content):
     assert converter.get_content_elements(converter.story_data) == content_elements
 
 
+def full_parse(converter, story_data):
+    parser = Html2Ans(ans_version=converter.ans_version)
+    parser.WRAPPER_TAGS += ["block"]
+    parser.EMPTY_STRINGS += ["\\n"]
+    return parser.generate_ans(story_data, "body.content")
+
+
+@pytest.mark.parametrize("fixture", ["ap_text_item_test_converter_storydata.xml", "ap_text_story_Election_2022.xml"])
+def test_story_content_elements_cached(fixture, test_content):
+    story_data = test_content.get_content(fixture)
+    converter = APStoryConverter(
+        test_content.get_content("ap_text_item_test_converter_itemdata.json"),
+        org_name="myorg",
+        website="mywebsite",
+        section="/sample/wires",
+        story_data=story_data,
+    )
+    expected = full_parse(converter, story_data)
+    content_cache.clear()
+    # the first conversion fills the cache, the second comes entirely from the cache, both match a full parse
+    assert converter.get_content_elements(story_data) == expected
+    first = content_cache.stats()
+    lookups = first["hits"] + first["misses"]
+    assert first["blocks"] == first["misses"] > 0
+    assert converter.get_content_elements(story_data) == expected
+    assert content_cache.stats()["hits"] == first["hits"] + lookups
+
+    # an updated story only parses the paragraph that changed
+    updated = story_data.replace("<p>", "<p>Updated. ", 1)
+    assert converter.get_content_elements(updated) == full_parse(converter, updated)
+    assert content_cache.stats()["misses"] == first["misses"] + 1
+
+
 def test_story_related_content_arc_id(test_content):
     """make sure the ans ids generated when writing related content references are the same as
     when the photos in the references generate their ans ids.  if these are not the same values,
@@ -301,7 +355,7 @@ def test_story_related_content_arc_id(test_content):
 @mock.patch("sqlite3.connect")
 @mock.patch("apps.associated_press.converter.APStoryConverter")
 def test_process_wire_story_incomplete(mock_converter, mock_connect):
-    # note: is affected by the mock_decorator function at top of test file.
+    # note: is affected by the mock_decorator function in conftest.py.
     mock_converter.get_circulation.return_value = None
     assert (
         process_wire_story(mock_converter, "0 of 0", mock_connect)
@@ -326,7 +380,7 @@ def test_process_wire_story_incomplete(mock_converter, mock_connect):
 @mock.patch("sqlite3.connect")
 @mock.patch("apps.associated_press.converter.APStoryConverter")
 def test_process_wire_story_sha1_exists(mock_converter, mock_connect, mock_select):
-    # note: is affected by the mock_decorator function at top of test file.
+    # note: is affected by the mock_decorator function in conftest.py.
     mock_converter.convert_ans.return_value = {
         "_id": "123",
         "source": {"source_id": "abc"},
@@ -346,7 +400,7 @@ def test_process_wire_story_sha1_exists(mock_converter, mock_connect, mock_selec
 @mock.patch("sqlite3.connect")
 @mock.patch("apps.associated_press.converter.APStoryConverter")
 def test_process_wire_story_error_migration_center(mock_converter, mock_connect, mock_select, monkeypatch):
-    # note: is affected by the mock_decorator function at top of test file.
+    # note: is affected by the mock_decorator function in conftest.py.
 
     def mock_post(*args, **kwargs):
         return MockResponse(
@@ -406,7 +460,7 @@ def test_process_wire_story_migration_center_error(mock_converter, mock_post, mo
 @mock.patch("requests.post")
 @mock.patch("apps.associated_press.converter.APStoryConverter")
 def test_process_wire_story_happy_path(mock_converter, mock_post, mock_connect, mock_create, mock_select):
-    # note: is affected by the mock_decorator function at top of test file.
+    # note: is affected by the mock_decorator function in conftest.py.
     mock_converter.get_circulation.return_value = {}
     mock_converter.convert_ans.return_value = {
         "_id": "123",
@@ -427,7 +481,7 @@ def test_process_wire_story_happy_path(mock_converter, mock_post, mock_connect,
 @mock.patch("sqlite3.connect")
 @mock.patch("apps.associated_press.converter.APPhotoConverter")
 def test_process_wire_photo_incomplete(mock_converter, mock_connect):
-    # note: is affected by the mock_decorator function at top of test file.
+    # note: is affected by the mock_decorator function in conftest.py.
     mock_converter.convert_ans.return_value = None
     assert (
         process_wire_photo(mock_converter, "0 of 0", mock_connect)
@@ -440,7 +494,7 @@ def test_process_wire_photo_incomplete(mock_converter, mock_connect):
 @mock.patch("requests.post")
 @mock.patch("apps.associated_press.converter.APPhotoConverter")
 def test_process_wire_photo_error_photoapi(mock_converter, mock_post, mock_connect, mock_inventory):
-    # note: is affected by the mock_decorator function at top of test file.
+    # note: is affected by the mock_decorator function in conftest.py.
     mock_converter.convert_ans.return_value = {
         "_id": "123",
         "source": {"source_id": "abc"},
@@ -448,6 +502,8 @@ def test_process_wire_photo_error_photoapi(mock_converter, mock_post, mock_conne
         "additional_properties": {"sha1": "1a2b3c", "originalUrl": "http://stuff"},
         "caption": "a caption",
     }
+    # the payload is encoded before it is posted, so the mock converter cannot hand over a mock staged url
+    mock_converter.staged_url = None
     mock_post.side_effect = [MockResponse(raise_for_status=requests.exceptions.RequestException("Response not OK!"))]
     mock_inventory.return_value = False
     assert process_wire_photo(mock_converter, "0 of 0", mock_connect) == "Response not OK!"
@@ -481,3 +537,64 @@ def test_run_ap_ingest_wires(mock_fetch_feed, mock_process_wires, test_content,
     for wire in wires:
         assert isinstance(wire, AssociatedPressBaseConverter)
     assert mock_process_wires.called == True
+
+
+@mock.patch("apps.associated_press.process_wire_photo")
+@mock.patch("apps.associated_press.process_wire_story")
+@mock.patch("sqlite3.connect")
+def test_process_wires_coalesces_versions(mock_connect, mock_story, mock_photo):
+    older = APStoryConverter({"type": "text", "source_id": "a", "versioncreated": "2022-05-11T04:07:27Z"})
+    photo = APPhotoConverter({"type": "picture", "source_id": "b", "versioncreated": "2022-05-11T04:07:27Z"})
+    newer = APStoryConverter({"type": "text", "source_id": "a", "versioncreated": "2022-05-11T04:10:00Z"})
+
+    process_wires([older, photo, None, newer], mock_connect)
+    assert mock_story.call_count == 1
+    assert mock_story.call_args.args[0] is newer
+    assert mock_story.call_args.args[1] == "1 of 2"
+    assert mock_photo.call_count == 1
+    assert mock_connect.close.called is False
+
+
+@mock.patch("utils.inventory.create_freshness")
+@mock.patch("utils.inventory.select_inventory_by_sha1")
+@mock.patch("utils.inventory.create_inventory")
+@mock.patch("sqlite3.connect")
+@mock.patch("requests.post")
+@mock.patch("apps.associated_press.converter.APPhotoConverter")
+def test_process_wire_photo_relayed(mock_converter, mock_post, mock_connect, mock_create, mock_select, mock_freshness):
+    mock_converter.convert_ans.return_value = {
+        "_id": "123",
+        "source": {"source_id": "abc"},
+        "additional_properties": {"sha1": "1a2b3c", "originalUrl": "https://api.ap.org/download"},
+        "caption": "a caption",
+    }
+    mock_converter.staged_url = "https://images.example.com/abc.jpg"
+    mock_select.return_value = False
+    assert process_wire_photo(mock_converter, "0 of 0", mock_connect) == http.HTTPStatus.CREATED
+    payload = json.loads(mock_post.call_args.kwargs["data"])
+    assert payload["ANS"]["additional_properties"]["originalUrl"] == "https://images.example.com/abc.jpg"
+    assert mock_create.call_count == 1
+
+
+@mock.patch("apps.associated_press.get_archive")
+@mock.patch("utils.inventory.create_freshness")
+@mock.patch("utils.inventory.select_inventory_by_sha1")
+@mock.patch("utils.inventory.create_inventory")
+@mock.patch("sqlite3.connect")
+@mock.patch("requests.post")
+@mock.patch("apps.associated_press.converter.APPhotoConverter")
+def test_process_wire_photo_relayed_digest(
+    mock_converter, mock_post, mock_connect, mock_create, mock_select, mock_freshness, mock_archive
+):
+    converted = {
+        "_id": "123",
+        "source": {"source_id": "abc"},
+        "additional_properties": {"sha1": "1a2b3c", "originalUrl": "https://api.ap.org/download"},
+        "caption": "a caption",
+    }
+    mock_converter.convert_ans.return_value = json.loads(json.dumps(converted))
+    mock_converter.staged_url = "https://images.example.com/abc.jpg"
+    mock_select.return_value = False
+    assert process_wire_photo(mock_converter, "0 of 0", mock_connect) == http.HTTPStatus.CREATED
+    # the digest is of the ans as converted, which is what reconvert.py compares it with, not of the staged url sent
+    assert mock_archive.return_value.mark_sent.call_args.args[2] == ans_digest(converted)
@@ -0,0 +1,113 @@
+import unittest.mock as mock
+
+from apps.associated_press import reconvert as reconvert_module
+from apps.associated_press.reconvert import reconvert
+from utils.archive import RawArchive, ans_digest
+from utils.inventory import create_connection, create_table
+
+
+def test_archive_roundtrip(tmp_path):
+    archive = RawArchive(str(tmp_path), segment_bytes=50)
+    first = {"source_id": "abc", "versioncreated": "2022-05-11T19:35:25Z", "type": "text", "headline": "x" * 400}
+    assert archive.append(first, b"<nitf>story</nitf>", "story") is True
+    # the same version is only archived once
+    assert archive.append(first, b"<nitf>story</nitf>", "story") is False
+    second = {**first, "versioncreated": "2022-05-11T20:00:00Z"}
+    assert archive.append(second, b"<nitf>updated</nitf>", "story") is True
+    photo = {"source_id": "def", "versioncreated": "2022-05-11T19:00:00Z", "type": "picture"}
+    assert archive.append(photo, None, "image") is True
+    # a record that does not fit in what is left of the segment starts a new one, these records are each bigger than one
+    assert len(list(tmp_path.glob("segment-*.bin"))) == 3
+
+    latest = archive.latest_versions()
+    assert [(row[0], row[1]) for row in latest] == [("abc", "2022-05-11T20:00:00Z"), ("def", "2022-05-11T19:00:00Z")]
+    source_id, version, arc_type, segment, offset, length, sent_digest = latest[0]
+    assert archive.read(segment, offset, length) == (second, b"<nitf>updated</nitf>")
+    assert archive.read(*latest[1][3:6]) == (photo, None)
+    assert sent_digest is None
+
+    archive.mark_sent("abc", "2022-05-11T20:00:00Z", "digest")
+    assert archive.latest_versions()[0][6] == "digest"
+    archive.close()
+
+    # an archive opened again, read only as the reconvert workers do, reads what was written before
+    reopened = RawArchive(str(tmp_path), segment_bytes=50, read_only=True)
+    assert reopened.read(segment, offset, length) == (second, b"<nitf>updated</nitf>")
+    reopened.close()
+
+
+def test_archive_two_writers(tmp_path):
+    # a cron run appending while the poller is up, each process with a writer of its own
+    poller, cron = RawArchive(str(tmp_path)), RawArchive(str(tmp_path))
+    items = [{"source_id": s, "versioncreated": "1", "type": "text"} for s in ["a", "b", "c"]]
+    poller.append(items[0], b"<nitf>a</nitf>", "story")
+    cron.append(items[1], b"<nitf>b</nitf>", "story")
+    poller.append(items[2], b"<nitf>c</nitf>", "story")
+    for row in poller.latest_versions():
+        item, story_data = poller.read(*row[3:6])
+        assert item["source_id"] == row[0] and story_data == f"<nitf>{row[0]}</nitf>".encode()
+    poller.close()
+    cron.close()
+
+
+def test_ans_digest_ignores_expiration():
+    ans = {"_id": "1", "additional_properties": {"sha1": "a", "expiration_date": "2022-05-14"}}
+    moved = {"_id": "1", "additional_properties": {"sha1": "a", "expiration_date": "2022-05-15"}}
+    assert ans_digest(ans) == ans_digest(moved)
+    assert ans_digest(ans) != ans_digest({**ans, "caption": "changed"})
+
+
+@mock.patch("apps.associated_press.process_wire_photo")
+@mock.patch("apps.associated_press.process_wire_story")
+def test_reconvert_sends_changed(mock_story, mock_photo, tmp_path, test_content):
+    archive = RawArchive(str(tmp_path))
+    story = test_content.get_content("ap_text_item_test_converter_itemdata.json")
+    story_data = test_content.get_content("ap_text_item_test_converter_storydata.xml").encode("utf-8")
+    photo = test_content.get_content("ap_picture_item_test_converter_data.json")
+    archive.append(story, story_data, "story")
+    archive.append(photo, None, "image")
+    conn = create_connection()
+    create_table(conn)
+
+    # neither item was sent, so both are
+    stats = reconvert(conn, archive, workers=1)
+    assert stats["changed"] == 2 and stats["failed"] == 0
+    assert mock_story.call_count == 1 and mock_photo.call_count == 1
+    assert mock_story.call_args.kwargs["resend"] is True
+    assert mock_story.call_args.args[0].source_data["source_id"] == story["source_id"]
+
+    # once the ans sent matches the ans converted now, nothing is sent
+    for source_id, version, _, segment, offset, length, _ in archive.latest_versions():
+        item, data = archive.read(segment, offset, length)
+        archive.mark_sent(source_id, version, ans_digest(reconvert_module.archived_converter(item, data).convert_ans()))
+    mock_story.reset_mock()
+    mock_photo.reset_mock()
+    stats = reconvert(conn, archive, workers=1)
+    assert stats["changed"] == 0 and stats["unchanged"] == 2
+    assert mock_story.call_count == 0 and mock_photo.call_count == 0
+
+    # a dry run reports without sending
+    archive.mark_sent(story["source_id"], story["versioncreated"], "stale")
+    assert reconvert(conn, archive, workers=1, dry_run=True)["changed"] == 1
+    assert mock_story.call_count == 0
+    archive.close()
+
+
+@mock.patch("apps.associated_press.process_wire_photo")
+@mock.patch("apps.associated_press.process_wire_story")
+@mock.patch("apps.associated_press.stage_images")
+def test_reconvert_relays_photos(mock_stage, mock_story, mock_photo, tmp_path, test_content):
+    archive = RawArchive(str(tmp_path))
+    story = test_content.get_content("ap_text_item_test_converter_itemdata.json")
+    archive.append(
+        story, test_content.get_content("ap_text_item_test_converter_storydata.xml").encode("utf-8"), "story"
+    )
+    archive.append(test_content.get_content("ap_picture_item_test_converter_data.json"), None, "image")
+    conn = create_connection()
+    create_table(conn)
+    store = mock.Mock()
+    reconvert(conn, archive, workers=1, store=store)
+    # the photo is staged before it is sent, so its ans carries the staged url and not the ap one
+    (photos, _, staged_to), _ = mock_stage.call_args
+    assert photos == [mock_photo.call_args.args[0]] and staged_to is store
+    assert mock_story.call_count == 1
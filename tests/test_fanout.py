@@ -0,0 +1,91 @@
+import json
+import time
+import unittest.mock as mock
+
+import freezegun
+
+from apps.associated_press.admission import AdmissionController
+from apps.associated_press.converter import APPhotoConverter, APStoryConverter
+from apps.associated_press.fanout import Target, process_wires_fanout
+from apps.associated_press.send_queue import SendQueue
+from utils import inventory
+from utils.arc_id import generate_arc_id
+
+
+def story(test_content):
+    return APStoryConverter(
+        test_content.get_content("ap_text_item_test_converter_itemdata.json"),
+        org_name="myorg",
+        website="mywebsite",
+        section="/sample/wires",
+        story_data=test_content.get_content("ap_text_item_test_converter_storydata.xml"),
+    )
+
+
+def test_for_target_converts_once(test_content):
+    shared = story(test_content)
+    with mock.patch.object(APStoryConverter, "get_content_elements", wraps=shared.get_content_elements) as parse:
+        first = shared.for_target("org-a", "site-a", "/a")
+        second = shared.for_target("org-b", "site-b", "/b")
+        ans_a = first.convert_ans()
+        ans_b = second.convert_ans()
+    assert parse.call_count == 1
+
+    source_id = shared.source_data["source_id"]
+    assert ans_a["_id"] == generate_arc_id(source_id, "org-a")
+    assert ans_b["_id"] == generate_arc_id(source_id, "org-b")
+    assert ans_a["owner"] == {"id": "org-a"}
+    assert ans_b["canonical_website"] == "site-b"
+    assert ans_a["related_content"] != ans_b["related_content"]
+    # everything that does not depend on the org is the same as a conversion for that org alone
+    alone = story(test_content)
+    alone.org_name, alone.website = "org-b", "site-b"
+    assert ans_b == alone.convert_ans()
+    assert second.get_circulation()["website_primary_section"]["referent"]["id"] == "/b"
+    assert first.get_scheduled_delete_operation()["organization_id"] == "org-a"
+
+
+@freezegun.freeze_time("2022-05-11 20:00:00")
+def test_process_wires_fanout(test_content, monkeypatch):
+    posts = []
+
+    def mock_post(url, params=None, data=None, headers=None, **kwargs):
+        posts.append((url, params["website"], headers["Authorization"], json.loads(data)["ANS"]["_id"]))
+        return mock.Mock(ok=True, status_code=201)
+
+    monkeypatch.setattr("requests.post", mock_post)
+    targets = [
+        Target("a", "org-a", "site-a", "/a", token="token-a"),
+        Target("b", "org-b", "site-b", "/b", token="token-b"),
+    ]
+    photo = APPhotoConverter(test_content.get_content("ap_picture_item_test_converter_data.json"), org_name="myorg")
+    process_wires_fanout([story(test_content), photo], targets)
+
+    assert len(posts) == 4
+    for target in targets:
+        sent = [post for post in posts if post[1] == target.website]
+        assert len(sent) == 2
+        assert all(url == f"https://api.{target.org}.arcpublishing.com/migrations/v3/content/ans" for url, *_ in sent)
+        assert all(auth == f"Bearer {target.token}" for _, _, auth, _ in sent)
+        # each target inventories what it was sent, under its own arc ids
+        rows = target.connection().execute("SELECT arc_id FROM ap_inventory").fetchall()
+        assert sorted(inventory.unpack_arc_id(row[0]) for row in rows) == sorted(arc_id for *_, arc_id in sent)
+        assert inventory.select_freshness(target.connection())
+        target.close()
+
+
+@freezegun.freeze_time("2022-05-11 20:00:00")
+def test_process_wires_fanout_keeps_each_target_queue(test_content, monkeypatch):
+    posts = []
+    monkeypatch.setattr("requests.post", lambda url, **kwargs: posts.append(url) or mock.Mock(ok=True, status_code=201))
+    target = Target("a", "org-a", "site-a", "/a", token="token-a")
+    # a target sends through its own queue, which holds a story for more versions to arrive like the poller's does
+    target.queue, target.admission = SendQueue(hold_seconds=60), AdmissionController()
+    photo = APPhotoConverter(test_content.get_content("ap_picture_item_test_converter_data.json"), org_name="myorg")
+    process_wires_fanout([story(test_content), photo], [target], deadline=time.monotonic() + 5)
+
+    assert len(posts) == 1
+    assert [type(converter) for converter in target.queue] == [APStoryConverter]
+    assert next(iter(target.queue)).org_name == "org-a"
+    assert isinstance(target.connection(), inventory.InventoryConnection)
+    target.close()
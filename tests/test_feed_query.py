@@ -0,0 +1,98 @@
+import unittest.mock as mock
+
+import pytest
+
+from apps.associated_press import fetch_feed_page
+from apps.associated_press.feed_query import FeedQuery, compare, estimate_bytes_saved
+from utils.constants import AP_FEED_INCLUDE_FIELDS
+from utils.settings import reset_settings
+
+
+@pytest.fixture
+def fresh_settings():
+    reset_settings()
+    yield
+    reset_settings()
+
+
+def feed_response(items, content=b"{}"):
+    data = {"data": {"items": [{"item": item} for item in items], "next_page": "https://api.ap.org/feed?seq=2"}}
+    return mock.Mock(ok=True, status_code=200, content=content, json=lambda: data)
+
+
+def test_params():
+    fq = FeedQuery("productid:1 OR productid:2", page_size=50)
+    assert fq.params() == {
+        "q": "(productid:1 OR productid:2) AND (type:text OR type:picture)",
+        "in_my_plan": "true",
+        "page_size": 50,
+        "include": ",".join(AP_FEED_INCLUDE_FIELDS),
+    }
+    assert FeedQuery("", types=[], in_my_plan=False, include=None).params() == {}
+
+
+def test_unusable():
+    fq = FeedQuery()
+    assert fq.unusable({"type": "video"})
+    assert fq.unusable({"type": "picture", "pricetag": "Priced"})
+    assert not fq.unusable({"type": "picture", "pricetag": "Unlimited"})
+    assert not fq.unusable({"type": "text"})
+
+
+@mock.patch("requests.get")
+def test_fetch_feed_page_filters(mock_get, fresh_settings, monkeypatch):
+    monkeypatch.setenv("AP_QUERY", "productid:1")
+    monkeypatch.setenv("AP_FEED_PAGE_SIZE", "100")
+    monkeypatch.setenv("AP_FEED_PROJECTION", "false")
+    mock_get.return_value = feed_response([{"type": "text", "altids": {"itemid": "a"}}])
+    items, next_page = fetch_feed_page()
+    assert mock_get.call_args.kwargs["params"] == {
+        "q": "(productid:1) AND (type:text OR type:picture)",
+        "in_my_plan": "true",
+        "page_size": 100,
+    }
+    assert [item["source_id"] for item in items] == ["a"]
+
+    # the next page carries the parameters of the first request
+    fetch_feed_page(next_page)
+    assert mock_get.call_args.args == (next_page,)
+    assert "params" not in mock_get.call_args.kwargs
+
+
+@mock.patch("requests.get")
+def test_compare(mock_get):
+    plain = [
+        {"type": "text"},
+        {"type": "video"},
+        {"type": "picture", "renditions": {"main": {"pricetag": "Priced"}}},
+        {"type": "picture"},
+    ]
+    mock_get.side_effect = [
+        feed_response(plain, b"x" * 4000),
+        feed_response([{"type": "text"}, {"type": "picture"}], b"x" * 1000),
+    ]
+    report = compare(FeedQuery("productid:1"), {})
+    assert mock_get.call_args_list[0].kwargs["params"] == {"q": "(productid:1)", "page_size": 10}
+    assert report["unfiltered"] == {"bytes": 4000, "items": 4, "unusable_items": 2}
+    assert report["filtered"] == {"bytes": 1000, "items": 2, "unusable_items": 0}
+    assert report["saved_bytes"] == 3000
+    assert report["bytes_per_usable_item"] == {"unfiltered": 2000, "filtered": 500}
+
+
+def test_estimate_bytes_saved():
+    assert estimate_bytes_saved(1000, 2, None) is None
+    assert estimate_bytes_saved(1000, 2, 2000) == 3000
+    # a baseline that no longer fits the feed shows as a negative saving
+    assert estimate_bytes_saved(1000, 2, 400) == -200
+
+
+@mock.patch("requests.get")
+def test_fetch_feed_page_bytes_saved(mock_get, fresh_settings, monkeypatch):
+    monkeypatch.setenv("AP_FEED_BASELINE_BYTES_PER_ITEM", "2000")
+    items = [{"type": "text", "altids": {"itemid": "a"}}, {"type": "video", "altids": {"itemid": "b"}}]
+    mock_get.return_value = feed_response(items, b"x" * 1000)
+    with mock.patch("apps.associated_press.logger") as logger:
+        fetch_feed_page()
+    extra = logger.info.call_args.kwargs["extra"]
+    # the video got through the filters, only the text item is priced at the baseline
+    assert (extra["bytes"], extra["unusable_items"], extra["bytes_saved"]) == (1000, 1, 1000)
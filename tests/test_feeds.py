@@ -0,0 +1,105 @@
+import unittest.mock as mock
+
+import requests
+
+from apps.associated_press.feeds import Feed, FeedMerger, feeds_from_config, fetch_feeds
+from apps.associated_press.poll import run_poll
+from utils.inventory import create_connection, create_table, select_feed_cursor
+from utils.settings import reset_settings
+
+
+def pages(responses):
+    """a fetch_feed_page stand in answering each query with its own list of responses"""
+
+    def fetch(next_page, query):
+        return responses[query].pop(0)
+
+    return fetch
+
+
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_fetch_feeds_dedupes(mock_fetch):
+    mock_fetch.side_effect = pages(
+        {
+            "sports": [
+                (
+                    [{"source_id": "a", "versioncreated": "1"}, {"source_id": "b", "versioncreated": "1"}],
+                    "https://next?seq=s1",
+                ),
+                ([{"source_id": "b", "versioncreated": "2"}], "https://next?seq=s2"),
+            ],
+            "politics": [
+                (
+                    [{"source_id": "b", "versioncreated": "1"}, {"source_id": "c", "versioncreated": "1"}],
+                    "https://next?seq=p1",
+                ),
+                (None, None),
+            ],
+        }
+    )
+    sports, politics = Feed("sports", "sports"), Feed("politics", "politics")
+    merger = FeedMerger()
+
+    items, cursors = fetch_feeds([sports, politics], merger)
+    assert [(i["source_id"], i["versioncreated"]) for i in items] == [("a", "1"), ("b", "1"), ("c", "1")]
+    assert (sports.new, sports.duplicates, politics.new, politics.duplicates) == (2, 0, 1, 1)
+    assert cursors == [("sports", "https://next?seq=s1"), ("politics", "https://next?seq=p1")]
+
+    # a new version of b is a new item, and a failed feed keeps its cursor
+    items, cursors = fetch_feeds([sports, politics], merger)
+    assert [(i["source_id"], i["versioncreated"]) for i in items] == [("b", "2")]
+    assert [c.args for c in mock_fetch.call_args_list[2:]] == [
+        ("https://next?seq=s1", "sports"),
+        ("https://next?seq=p1", "politics"),
+    ]
+    assert cursors == [("sports", "https://next?seq=s2"), ("politics", "https://next?seq=p1")]
+    assert politics.stats()["failures"] == 1
+    assert sports.stats()["new_per_poll"] == 1.5
+
+
+def test_feeds_from_config(monkeypatch):
+    monkeypatch.setenv("AP_FEEDS", "sports, politics")
+    monkeypatch.setenv("SPORTS_AP_QUERY", "productid:1")
+    conn = create_connection()
+    create_table(conn)
+    conn.execute(
+        "INSERT INTO ap_feed_cursors(feed, next_page, updated_date) VALUES ('sports', 'https://next?seq=9', 'now')"
+    )
+    feeds = feeds_from_config(conn)
+    assert [(f.name, f.query, f.next_page) for f in feeds] == [
+        ("sports", "productid:1", "https://next?seq=9"),
+        ("politics", "", None),
+    ]
+
+
+def test_feed_merger_forgets_oldest():
+    feed = Feed("all")
+    merger = FeedMerger(max_seen=2)
+    merger.merge([(feed, [{"source_id": "a"}, {"source_id": "b"}, {"source_id": "c"}])])
+    assert merger.merge([(feed, [{"source_id": "a"}, {"source_id": "c"}])]) == [{"source_id": "a"}]
+
+
+@mock.patch("apps.associated_press.process_wires")
+@mock.patch("apps.associated_press.build_wires")
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_run_poll_saves_feed_cursors_after_sending(mock_fetch, mock_build, mock_process, monkeypatch, tmp_path):
+    monkeypatch.setenv("SQLDB_LOCATION", str(tmp_path / "inventory.db"))
+    monkeypatch.setenv("AP_FEEDS", "sports")
+    monkeypatch.setenv("AP_POLL_MIN_INTERVAL", "0")
+    reset_settings()
+    mock_fetch.side_effect = pages(
+        {"": [([{"source_id": "a"}], "https://next?seq=s1"), ([{"source_id": "a"}], "https://next?seq=s1")]}
+    )
+    mock_build.return_value = []
+    # the cycle fails while sending, so its cursor is not saved and a restarted poller fetches the items again
+    mock_process.side_effect = [requests.exceptions.ConnectionError("arc down"), []]
+    try:
+        assert run_poll(max_cycles=1) == 1
+        conn = create_connection(str(tmp_path / "inventory.db"))
+        assert select_feed_cursor(conn, "sports") is None
+        assert run_poll(max_cycles=1) == 1
+        assert mock_fetch.call_args_list[1].args == (None, "")
+        assert select_feed_cursor(conn, "sports") == "https://next?seq=s1"
+        conn.close()
+    finally:
+        reset_settings()
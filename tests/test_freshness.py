@@ -0,0 +1,65 @@
+import freezegun
+
+from apps.associated_press.converter import APStoryConverter
+from utils.freshness import freshness_report, percentiles
+from utils.inventory import create_connection, create_freshness, create_table
+
+
+def test_percentiles():
+    assert percentiles([]) == {"p50": None, "p95": None, "p99": None}
+    assert percentiles([None, 3, 1, 2]) == {"p50": 2, "p95": 3, "p99": 3}
+    assert percentiles(list(range(1, 101))) == {"p50": 50, "p95": 95, "p99": 99}
+
+
+@freezegun.freeze_time("2022-05-11 04:10:00")
+def test_converter_freshness():
+    converter = APStoryConverter(
+        {"source_id": "abc", "firstcreated": "2022-05-11T04:00:00Z", "versioncreated": "2022-05-11T04:05:00Z"}
+    )
+    converter.mark("fetched")
+    converter.stages["sent"] = 1652242260.0
+    row = converter.get_freshness("story")
+    assert row == (
+        "abc",
+        "2022-05-11T04:05:00Z",
+        "story",
+        1652241600.0,
+        1652241900.0,
+        None,
+        1652242200.0,
+        None,
+        None,
+        1652242260.0,
+        None,
+    )
+
+
+@freezegun.freeze_time("2022-05-11 05:00:00")
+def test_freshness_report():
+    conn = create_connection()
+    create_table(conn)
+    published = 1652241600.0  # 2022-05-11 04:00:00
+    for i in range(10):
+        create_freshness(
+            conn,
+            (f"story{i}", "v1", "story", published, published + 60, published + 70, published + 75, published + 76)
+            + (published + 80, published + 90 + i, published + 91 + i),
+        )
+    create_freshness(conn, ("photo", "v1", "image", published, published, None, None, None, None, None, published + 5))
+    # a new version of the same item replaces the old row
+    create_freshness(conn, ("photo", "v1", "image", published, published, None, None, None, None, None, published + 7))
+    # outside of the reporting window
+    create_freshness(conn, ("old", "v1", "story", 0, 0, None, None, None, None, None, 10))
+
+    report = freshness_report(conn, hours=24)
+    assert list(report.keys()) == ["image", "story"]
+    assert report["image"]["count"] == 1
+    assert report["image"]["publish_lag"] == {"p50": 7, "p95": 7, "p99": 7}
+    assert report["story"]["count"] == 10
+    assert report["story"]["publish_lag"] == {"p50": 95, "p95": 100, "p99": 100}
+    assert report["story"]["version_lag"] == {"p50": 35, "p95": 40, "p99": 40}
+    assert report["story"]["stages"]["feed_seen"]["p50"] == 10
+    assert report["story"]["stages"]["sent"] == {"p50": 14, "p95": 19, "p99": 19}
+    assert report["story"]["stages"]["inventoried"]["p99"] == 1
+
+    assert list(freshness_report(conn, hours=24, arc_type="image").keys()) == ["image"]
@@ -31,7 +31,7 @@ def test_create_table(mock_connect):
 
 @mock.patch("sqlite3.connect")
 def test_update_inventory(mock_connect):
-    update_inventory(mock_connect, ("url", "sha1", "date"))
+    update_inventory(mock_connect, ("url", "sha1", "date", "source_id"))
     assert mock_connect.cursor.call_count == 1
 
 
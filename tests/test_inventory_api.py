@@ -0,0 +1,101 @@
+import hashlib
+import json
+
+import pytest
+
+from api import associated_press as api
+from utils import inventory
+from utils.settings import reset_settings
+
+START = 1654128000  # 2022-06-02 00:00 UTC
+
+
+def row(n: int):
+    source_id = hashlib.md5(f"source {n}".encode()).hexdigest()
+    arc_type = "story" if n % 3 == 0 else "image"
+    return (
+        source_id,
+        f"ARC{n:023d}",
+        f"https://api.ap.org/media/v/content/{source_id}",
+        arc_type,
+        hashlib.sha1(str(n).encode()).hexdigest(),
+        START + n * 60,
+    )
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # every setting the api reads, so these tests do not depend on the shell they run from
+    for name, value in {
+        "AP_API_KEY": "testkey",
+        "ARC_ORG_ID": "sandbox.myorg",
+        "ARC_ORG_WEBSITE": "mywebsite",
+        "ARC_WEBSITE_SECTION": "/wires/ap",
+        "SQLDB_LOCATION": str(tmp_path / "inventory.db"),
+    }.items():
+        monkeypatch.setenv(name, value)
+    reset_settings()
+    conn = inventory.create_connection(str(tmp_path / "inventory.db"))
+    inventory.create_table(conn)
+    inventory.create_inventory_batch(conn, [row(n) for n in range(25)])
+    # an id that is kept as text sorts before the packed ones
+    inventory.create_inventory(conn, ("mysourceid1", "ABC123", "url", "story", "54332abbas5", START))
+    conn.close()
+    yield api.app.test_client()
+    reset_settings()
+
+
+def walk(client, query: str):
+    rows, after, pages = [], "", 0
+    while after is not None:
+        res = client.get(f"/api/ap/inventory?limit=10&{query}&after={after}")
+        assert res.status_code == 200
+        rows += res.json["rows"]
+        after = res.json["next"]
+        pages += 1
+    return rows, pages
+
+
+def test_inventory_pages(client):
+    rows, pages = walk(client, "")
+    assert pages == 3
+    assert len({r["source_id"] for r in rows}) == 26
+    assert rows[0]["source_id"] == "mysourceid1"
+    assert [r["source_id"] for r in rows[1:]] == sorted(r[0] for r in map(row, range(25)))
+    assert rows[1]["arc_id"] in {r[1] for r in map(row, range(25))}
+
+    # a time range is walked in updated_at order
+    rows, pages = walk(client, f"since={START + 5 * 60}&until={START + 19 * 60}&type=image")
+    assert [r["updated_at"] for r in rows] == [START + n * 60 for n in range(5, 19) if n % 3]
+    assert pages == 1
+
+    res = client.get(f"/api/ap/inventory?sha1={row(7)[4]}")
+    assert [r["source_id"] for r in res.json["rows"]] == [row(7)[0]] and res.json["next"] is None
+    res = client.get("/api/ap/inventory?source_id=mysourceid1")
+    assert res.json["rows"][0]["sha1"] == "54332abbas5"
+
+
+def test_inventory_bad_requests(client):
+    assert client.get("/api/ap/inventory?order=arc_id").status_code == 400
+    assert client.get("/api/ap/inventory?after=nonsense").status_code == 400
+    after = client.get("/api/ap/inventory?limit=1").json["next"]
+    # a cursor only continues the order it came from
+    assert client.get(f"/api/ap/inventory?order=updated_at&after={after}").status_code == 400
+
+
+def test_inventory_ndjson(client, monkeypatch):
+    monkeypatch.setattr(api, "INVENTORY_EXPORT_BATCH", 4)
+    res = client.get("/api/ap/inventory.ndjson?type=story")
+    assert res.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in res.data.decode().splitlines()]
+    assert len(lines) == 10 and {line["arc_type"] for line in lines} == {"story"}
+
+    lines = client.get("/api/ap/inventory.ndjson?order=updated_at&limit=6").data.decode().splitlines()
+    assert [json.loads(line)["updated_at"] for line in lines] == [
+        START,
+        START,
+        START + 60,
+        START + 120,
+        START + 180,
+        START + 240,
+    ]
@@ -0,0 +1,42 @@
+import sqlite3
+
+from benchmarks.inventory import compare, run
+
+
+def test_inventory_benchmark(tmp_path):
+    options = {"probes": 50, "inserts": 20, "batch": 10, "readers": 2, "seconds": 0.2}
+    report = run(str(tmp_path), [500, 2000], **options)
+    assert any("ap_inventory_sha1" in sql for sql in report["schema"])
+    for rows in [500, 2000]:
+        result = report["sizes"][str(rows)]
+        assert result["built_rows"] == rows and result["file_bytes"] > 0
+        assert set(result["lookups"]) == {"select_by_sha1_hit", "select_by_sha1_miss", "select_by_source"}
+        assert result["lookups"]["select_by_sha1_hit"]["p99_us"] > 0
+        assert result["inserts"]["create_inventory"]["p50_us"] > 0
+        assert result["inserts"]["batched_rows_per_second"] > 0
+        assert result["concurrent"]["reads_per_second"] > 0 and result["concurrent"]["writes_per_second"] > 0
+
+    # the databases are reused, and left as they were built
+    again = run(str(tmp_path), [500], **options)
+    assert again["sizes"]["500"]["built_rows"] == 0
+    conn = sqlite3.connect(str(tmp_path / "inventory-500.db"))
+    assert conn.execute("SELECT COUNT(*) FROM ap_inventory;").fetchone()[0] == 500
+    conn.close()
+
+
+def test_compare_reports():
+    def report(p99, batched, schema="CREATE TABLE ap_feed_inventory"):
+        size = {
+            "rows": 10,
+            "lookups": {"select_by_sha1_hit": {"p99_us": p99}},
+            "inserts": {"batched_rows_per_second": batched},
+        }
+        return {"schema": [schema], "sizes": {"10": size}}
+
+    same = compare(report(10, 1000), report(12, 900))
+    assert same["regressions"] == [] and same["schema_changed"] is False
+    assert same["metrics"]["10.lookups.select_by_sha1_hit.p99_us"]["ratio"] == 1.2
+
+    worse = compare(report(10, 1000), report(30, 500, schema="CREATE TABLE ap_feed_inventory_v2"))
+    assert worse["schema_changed"] is True
+    assert len(worse["regressions"]) == 2
@@ -0,0 +1,65 @@
+import os
+import shutil
+
+from utils import inventory
+from utils.inventory_migration import InventoryMigration
+
+LEGACY_DB = os.path.join(os.path.dirname(os.path.dirname(__file__)), "inbound-feeds-inventory.db")
+PHOTO = "75c2f692dc644ea58b3f51d3a7c77d02"
+PHOTO_SHA1 = "c40756d14d9b5eeb28536dba21df4b80d9e41142"
+
+
+def test_pack_round_trips():
+    assert inventory.pack_hex(PHOTO) == bytes.fromhex(PHOTO)
+    assert inventory.unpack_hex(inventory.pack_hex(PHOTO_SHA1)) == PHOTO_SHA1
+    # ids that would not read back the same are kept as text
+    for value in ["54332abbas5", "ABCDEF", "abc", "", None]:
+        assert inventory.pack_hex(value) == value
+    arc_id = "B7BINKNHQTOSTCQ3MCSOFG4X6M"
+    assert len(inventory.pack_arc_id(arc_id)) == 16
+    assert inventory.unpack_arc_id(inventory.pack_arc_id(arc_id)) == arc_id
+    assert inventory.pack_arc_id("ABC123") == "ABC123"
+    # the legacy updated_date only keeps its date and hour
+    assert inventory.epoch("2022-06-02 15:06:50.504") == 1654182000
+    assert inventory.epoch("2022-06-02") == 1654128000
+    assert inventory.epoch(1654182000.5) == 1654182000
+    assert inventory.epoch("date") == 0
+
+
+def test_migration_keeps_lookups_working(tmp_path):
+    path = str(tmp_path / "inventory.db")
+    shutil.copy(LEGACY_DB, path)
+    conn = inventory.create_connection(path)
+    inventory.create_table(conn)
+
+    def lookups():
+        assert inventory.select_inventory_count(conn) == 12
+        assert inventory.select_inventory_by_sha1(conn, PHOTO_SHA1)
+        assert not inventory.select_inventory_by_sha1(conn, "0" * 40)
+        (row,) = inventory.select_inventory_by_source(conn, PHOTO)
+        assert row[:5] == (PHOTO, "B7BINKNHQTOSTCQ3MCSOFG4X6M", row[2], "image", PHOTO_SHA1)
+        assert row[5] == 1654182000
+        (row,) = inventory.select_inventory_by_source(conn, "mysourceid1")
+        assert row[1] == "ABC123" and row[4] == "54332abbas5"
+
+    lookups()
+    # an item sent again goes to the new table, and its legacy row with the old sha1 goes away
+    inventory.create_inventory(conn, ("mysourceid1", "ABC123", "https://apfeedurl/test3", "story", "00ff", 1700000000))
+    assert not inventory.select_inventory_by_sha1(conn, "54332abbas5")
+    assert inventory.select_inventory_by_sha1(conn, "00ff")
+
+    migration = InventoryMigration(batch_size=5, max_batches=1, pause=0)
+    assert migration.run(conn) == 5
+    assert inventory.legacy_inventory_exists(conn)
+    assert inventory.select_inventory_by_sha1(conn, PHOTO_SHA1)
+    assert inventory.select_inventory_count(conn) == 12
+    assert migration.run(conn) == 5
+    assert migration.run(conn) == 1
+    # the empty legacy table is dropped on the next run
+    assert migration.run(conn) == 0
+    assert not inventory.legacy_inventory_exists(conn)
+    assert migration.migrated == 11
+    assert inventory.select_inventory_by_source(conn, "mysourceid1")[0][2] == "https://apfeedurl/test3"
+    inventory.create_inventory(conn, (PHOTO, "B7BINKNHQTOSTCQ3MCSOFG4X6M", "url", "image", PHOTO_SHA1, 1700000000))
+    assert inventory.select_inventory_count(conn) == 12
+    conn.close()
@@ -0,0 +1,49 @@
+import datetime
+import json
+import logging
+
+import pytest
+from pythonjsonlogger import jsonlogger
+
+from utils.arc_id import generate_arc_id
+from utils.json_codec import ORJSON, STDLIB, JsonCodec, hash_bytes, id_bytes
+
+SAMPLE = {"headline": "Zürich – “quoted”", "b": [1, 2.5, None, True], "a": {"nested": "é"}}
+
+
+def test_hash_and_id_bytes_match_the_legacy_encoding():
+    assert hash_bytes(SAMPLE) == json.dumps(SAMPLE).encode("utf-8")
+    assert id_bytes((("a", 1), {"k": "é"})) == json.dumps(
+        (("a", 1), {"k": "é"}), sort_keys=1, separators=(",", ":")
+    ).encode("utf-8")
+    # ids already in arc do not change
+    assert generate_arc_id("sandbox.myorg", "abc") == "FFNGDBEMDB67OES3NS2RK2MQHY"
+
+
+@pytest.mark.parametrize("backend", [STDLIB, ORJSON])
+def test_backends_agree(backend):
+    codec = JsonCodec(backend)
+    assert codec.backend == backend
+    encoded = codec.dumps(SAMPLE)
+    assert isinstance(encoded, bytes)
+    assert codec.loads(encoded) == SAMPLE == json.loads(encoded)
+    # orjson refuses keys that are not strings, the stdlib encoder does not
+    assert codec.loads(codec.dumps({1: "one"})) == {"1": "one"}
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        JsonCodec("simplejson")
+
+
+@pytest.mark.parametrize("backend", [STDLIB, ORJSON])
+def test_log_serializer(backend):
+    codec = JsonCodec(backend)
+    formatter = jsonlogger.JsonFormatter(json_serializer=codec.log_serializer)
+    record = logging.LogRecord("test", logging.ERROR, __file__, 1, ValueError("bad"), None, None)
+    record.when = datetime.datetime(2022, 5, 11, 20, 0, 0)
+    record.thing = object
+    logged = json.loads(formatter.format(record))
+    assert logged["message"] == "bad"
+    assert logged["when"] == "2022-05-11T20:00:00"
+    assert logged["thing"] == str(object)
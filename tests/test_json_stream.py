@@ -0,0 +1,105 @@
+import json
+import tracemalloc
+import unittest.mock as mock
+
+import pytest
+
+from apps.associated_press import fetch_feed_page
+from utils.json_stream import JsonStream
+from utils.settings import reset_settings
+
+DOCUMENT = {
+    "params": {"seq": 1234, "other": [1, {"x": "y"}]},
+    "data": {
+        "next_page": "https://api.ap.org/feed?seq=1235",
+        "items": [{"n": 12345}, {"s": "Zürich “é”"}, [], 0.5],
+        "after": True,
+    },
+}
+
+
+def chunked(data: bytes, size: int):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 100000])
+def test_stream_any_chunking(size):
+    raw = json.dumps(DOCUMENT, ensure_ascii=False).encode("utf-8")
+    stream = JsonStream(chunked(raw, size), ("data", "items"), [("data", "next_page"), ("params", "seq")])
+    assert list(stream) == DOCUMENT["data"]["items"]
+    assert stream.captured == {("data", "next_page"): "https://api.ap.org/feed?seq=1235", ("params", "seq"): 1234}
+    assert stream.found and stream.bytes == len(raw)
+
+
+def test_stream_without_the_array():
+    stream = JsonStream([b'{"data": {"item": {"a": 1}}}'], ("data", "items"), [("data", "item")])
+    assert list(stream) == []
+    assert not stream.found
+    assert stream.captured == {("data", "item"): {"a": 1}}
+
+
+@pytest.mark.parametrize("raw", [b'{"data": {"items": [1, 2', b'{"data": {"items": [1 2]}}', b'{"data": {}} {}'])
+def test_stream_invalid(raw):
+    with pytest.raises(json.JSONDecodeError):
+        list(JsonStream(chunked(raw, 4), ("data", "items")))
+
+
+@pytest.fixture
+def streaming(monkeypatch):
+    monkeypatch.setenv("AP_FEED_STREAMING", "true")
+    reset_settings()
+    yield
+    reset_settings()
+
+
+def streamed_response(raw: bytes, chunk_size: int = 4096):
+    res = mock.Mock(ok=True, status_code=200)
+    # chunks are cut as they are read, as they arrive from the network
+    res.iter_content.side_effect = lambda size: (raw[i : i + chunk_size] for i in range(0, len(raw), chunk_size))
+    return res
+
+
+@mock.patch("requests.get")
+def test_streamed_page_matches_parsed_page(mock_get, test_content, streaming):
+    page = test_content.get_content("associated_press_feed_all_entitled_content.json")
+    mock_get.return_value = streamed_response(json.dumps(page).encode("utf-8"))
+    items, next_page = fetch_feed_page()
+    assert mock_get.call_args.kwargs["stream"] is True
+    assert mock_get.return_value.close.called
+
+    reset_settings()
+    with mock.patch.dict("os.environ", {"AP_FEED_STREAMING": "false"}):
+        mock_get.return_value = mock.Mock(ok=True, status_code=200, content=b"{}", json=lambda: page)
+        assert fetch_feed_page() == (items, next_page)
+    assert len(items) == 10 and next_page
+
+
+def verbose_page(count: int):
+    item = {"type": "text", "altids": {"itemid": "x"}, "headline": "h", "verbose": ["padding " * 50] * 20}
+    return json.dumps({"params": {"seq": 1}, "data": {"next_page": None, "items": [{"item": item}] * count}}).encode(
+        "utf-8"
+    )
+
+
+def peak_memory(fetch):
+    tracemalloc.start()
+    try:
+        fetch()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@mock.patch("requests.get")
+def test_streaming_memory_stays_flat(mock_get, streaming):
+    # the first fetch imports jmespath and friends
+    mock_get.return_value = streamed_response(verbose_page(1))
+    fetch_feed_page()
+    peaks = {}
+    for count in [100, 1000]:
+        raw = verbose_page(count)
+        mock_get.return_value = streamed_response(raw)
+        peaks[count] = peak_memory(fetch_feed_page)
+        # parsing the whole page holds every verbose item at once, streaming only keeps the small projected items
+        assert peak_memory(lambda: json.loads(raw)) > 5 * peaks[count]
+        assert peaks[count] < len(raw) / 5
@@ -0,0 +1,104 @@
+import unittest.mock as mock
+from threading import Event
+
+import requests
+
+from apps.associated_press.poll import AdaptiveInterval, run_poll
+from apps.associated_press.prefetch import DEFAULT_FEED
+from utils import inventory
+from utils.settings import reset_settings
+
+
+def test_adaptive_interval():
+    schedule = AdaptiveInterval(min_interval=30, max_staleness=600, target_items=10, smoothing=1)
+    assert schedule.interval == 30
+
+    # 10 items in 100 seconds asks for a poll every 100 seconds
+    schedule.observe(10, 100)
+    assert schedule.interval == 100
+
+    # busy news cycle is clamped to the minimum
+    schedule.observe(100, 10)
+    assert schedule.interval == 30
+
+    # quiet feed backs off, but never past the max staleness
+    schedule.observe(0, 300)
+    assert schedule.interval == 600
+
+
+def test_adaptive_interval_smoothing():
+    schedule = AdaptiveInterval(min_interval=1, max_staleness=1000, target_items=10, smoothing=0.5)
+    schedule.observe(10, 10)
+    schedule.observe(0, 10)
+    assert schedule.rate == 0.5
+    assert schedule.interval == 20
+
+
+@mock.patch("apps.associated_press.process_wires")
+@mock.patch("apps.associated_press.build_wires")
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_run_poll_follows_cursor(mock_fetch, mock_build, mock_process, monkeypatch):
+    monkeypatch.setenv("AP_POLL_MIN_INTERVAL", "0")
+    monkeypatch.setenv("AP_POLL_MAX_STALENESS", "0")
+    mock_fetch.side_effect = [
+        ([{"source_id": "a"}], "https://next?seq=1"),
+        (None, None),
+        ([], "https://next?seq=2"),
+    ]
+    mock_build.return_value = []
+
+    assert run_poll(max_cycles=3) == 3
+    # a failed page keeps the previous cursor
+    assert [c.args[0] for c in mock_fetch.call_args_list] == [None, "https://next?seq=1", "https://next?seq=1"]
+    # the same connection is reused for every cycle
+    connections = {c.args[1] for c in mock_process.call_args_list}
+    assert len(connections) == 1
+
+
+@mock.patch("apps.associated_press.process_wires")
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_run_poll_stops(mock_fetch, mock_process):
+    stop = Event()
+    stop.set()
+    assert run_poll(stop) == 0
+    assert mock_fetch.called is False
+
+
+@mock.patch("apps.associated_press.process_wires")
+@mock.patch("apps.associated_press.build_wires")
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_run_poll_survives_a_failed_cycle(mock_fetch, mock_build, mock_process, monkeypatch):
+    monkeypatch.setenv("AP_POLL_MIN_INTERVAL", "0")
+    monkeypatch.setenv("AP_POLL_MAX_STALENESS", "0")
+    mock_fetch.side_effect = [
+        requests.exceptions.ConnectionError("connection reset"),
+        ([{"source_id": "a"}], "https://next?seq=1"),
+    ]
+    mock_build.return_value = []
+
+    assert run_poll(max_cycles=2) == 2
+    assert mock_fetch.call_count == 2
+    assert mock_process.call_count == 1
+
+
+@mock.patch("apps.associated_press.process_wires")
+@mock.patch("apps.associated_press.build_wires")
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_run_poll_saves_cursor(mock_fetch, mock_build, mock_process, monkeypatch, tmp_path):
+    monkeypatch.setenv("SQLDB_LOCATION", str(tmp_path / "inventory.db"))
+    monkeypatch.setenv("AP_POLL_MIN_INTERVAL", "0")
+    monkeypatch.setenv("AP_POLL_MAX_STALENESS", "0")
+    reset_settings()
+    mock_fetch.side_effect = [([{"source_id": "a"}], "https://next?seq=1"), ([], "https://next?seq=2")]
+    mock_build.return_value = []
+    mock_process.return_value = []
+    try:
+        assert run_poll(max_cycles=1) == 1
+        conn = inventory.create_connection(str(tmp_path / "inventory.db"))
+        assert inventory.select_feed_cursor(conn, DEFAULT_FEED) == "https://next?seq=1"
+        conn.close()
+        # a restarted poller continues from the saved cursor, not from the start of the feed
+        assert run_poll(max_cycles=1) == 1
+        assert mock_fetch.call_args.args[0] == "https://next?seq=1"
+    finally:
+        reset_settings()
@@ -0,0 +1,186 @@
+import time
+import types
+import unittest.mock as mock
+from http import HTTPStatus
+
+import pytest
+import requests
+
+from apps.associated_press import MAX_REQUEUES
+from apps.associated_press.converter import APStoryConverter
+from apps.associated_press.poll import run_poll
+from apps.associated_press.prefetch import DEFAULT_FEED, Prefetcher
+from utils import inventory
+from utils.settings import reset_settings
+
+
+def pages(count: int):
+    """a feed of count full pages, then empty pages"""
+
+    def fetch(next_page, query=None):
+        seq = int(next_page.split("seq=")[-1]) if next_page else 0
+        items = [{"source_id": f"{seq}"}] if seq < count else []
+        return items, f"https://next?seq={seq + 1}"
+
+    return fetch
+
+
+def wait_for(condition, seconds: float = 2):
+    deadline = time.monotonic() + seconds
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_prefetch_depth(mock_fetch):
+    mock_fetch.side_effect = pages(10)
+    prefetcher = Prefetcher(depth=2, pause=0.01)
+    prefetcher.start()
+    try:
+        assert wait_for(lambda: prefetcher.fetched == 2)
+        # no further than depth pages ahead of the pages taken
+        time.sleep(0.05)
+        assert mock_fetch.call_count == 2
+        page = prefetcher.take(timeout=1)
+        assert page.url is None and page.items == [{"source_id": "0"}] and page.next_page == "https://next?seq=1"
+        assert wait_for(lambda: prefetcher.fetched == 3)
+        assert [prefetcher.take(timeout=1).url for _ in range(2)] == ["https://next?seq=1", "https://next?seq=2"]
+    finally:
+        prefetcher.stop()
+
+
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_prefetch_backpressure_and_failures(mock_fetch):
+    full = [True]
+    mock_fetch.side_effect = [(None, None), ([{"source_id": "a"}], "https://next?seq=1")]
+    prefetcher = Prefetcher("https://next?seq=0", depth=1, full=lambda: full[0], idle_wait=0.01, pause=0.01)
+    prefetcher.start()
+    try:
+        # nothing is fetched while the queues downstream are full
+        assert wait_for(lambda: prefetcher.paused >= 3)
+        assert mock_fetch.call_count == 0
+        full[0] = False
+        # a failed page is asked for again
+        page = prefetcher.take(timeout=1)
+        assert [c.args[0] for c in mock_fetch.call_args_list] == ["https://next?seq=0"] * 2
+        assert page.items == [{"source_id": "a"}] and prefetcher.failures == 1
+    finally:
+        prefetcher.stop()
+
+
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_prefetch_survives_a_failed_request(mock_fetch):
+    mock_fetch.side_effect = [requests.exceptions.ConnectionError("down"), ([{"source_id": "a"}], "https://next?seq=1")]
+    prefetcher = Prefetcher("https://next?seq=0", depth=1, idle_wait=0.01, pause=0.01)
+    prefetcher.start()
+    try:
+        page = prefetcher.take(timeout=1)
+        assert page.items == [{"source_id": "a"}] and prefetcher.failures == 1
+        assert prefetcher.is_alive()
+    finally:
+        prefetcher.stop()
+
+
+@pytest.fixture
+def prefetch_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("SQLDB_LOCATION", str(tmp_path / "inventory.db"))
+    monkeypatch.setenv("AP_PREFETCH_DEPTH", "2")
+    monkeypatch.setenv("AP_POLL_MIN_INTERVAL", "0.2")
+    monkeypatch.setenv("AP_POLL_MAX_STALENESS", "0.2")
+    reset_settings()
+    yield tmp_path / "inventory.db"
+    reset_settings()
+
+
+@mock.patch("apps.associated_press.process_wires")
+@mock.patch("apps.associated_press.build_wires")
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_run_poll_checkpoints_processed_pages(mock_fetch, mock_build, mock_process, prefetch_env):
+    mock_fetch.side_effect = pages(10)
+    mock_build.return_value = []
+    assert run_poll(max_cycles=3) == 3
+    assert [c.args[0] for c in mock_build.call_args_list] == [
+        [{"source_id": "0"}],
+        [{"source_id": "1"}],
+        [{"source_id": "2"}],
+    ]
+    # pages were fetched ahead, but the checkpoint is the page after the last one processed
+    assert mock_fetch.call_count > 3
+    conn = inventory.create_connection(str(prefetch_env))
+    assert inventory.select_feed_cursor(conn, DEFAULT_FEED) == "https://next?seq=3"
+    conn.close()
+
+    # a new run continues from the checkpoint, the prefetched pages are fetched again
+    mock_fetch.reset_mock(side_effect=True)
+    mock_fetch.side_effect = pages(10)
+    assert run_poll(max_cycles=1) == 1
+    assert mock_fetch.call_args_list[0].args[0] == "https://next?seq=3"
+    assert mock_build.call_args.args[0] == [{"source_id": "3"}]
+
+
+@mock.patch("apps.associated_press.process_wires")
+@mock.patch("apps.associated_press.build_wires")
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_run_poll_restarts_a_dead_prefetcher(mock_fetch, mock_build, mock_process, prefetch_env):
+    fetch = pages(10)
+    calls = []
+
+    def flaky(next_page, query=None):
+        calls.append(next_page)
+        # something the prefetcher does not expect ends its thread after the first page
+        if len(calls) == 2:
+            raise ValueError("bad page")
+        return fetch(next_page, query)
+
+    mock_fetch.side_effect = flaky
+    mock_build.return_value = []
+    assert run_poll(max_cycles=3) == 3
+    # the new prefetcher continues after the last page taken, no page is skipped
+    taken = [c.args[0][0]["source_id"] for c in mock_build.call_args_list if c.args[0]]
+    assert taken == [str(n) for n in range(len(taken))] and len(taken) >= 2
+    assert calls[:3] == [None, "https://next?seq=1", "https://next?seq=1"]
+
+
+@mock.patch("apps.associated_press.process_wires")
+@mock.patch("apps.associated_press.build_wires")
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_run_poll_checkpoints_only_sent_pages(mock_fetch, mock_build, mock_process, prefetch_env):
+    mock_fetch.side_effect = pages(10)
+    mock_build.side_effect = lambda items: [types.SimpleNamespace(source_data=dict(item)) for item in items]
+    cursors = []
+
+    def process(wires, conn, stop, queue, **kwargs):
+        cursors.append(inventory.select_feed_cursor(conn, DEFAULT_FEED))
+        # the first page's wire is held in the queue for two cycles
+        if wires[0].source_data["source_id"] == "0":
+            queue.extend(wires)
+        elif wires[0].source_data["source_id"] == "2":
+            queue.remove(next(iter(queue)))
+        return []
+
+    mock_process.side_effect = process
+    assert run_poll(max_cycles=4) == 4
+    assert cursors == [None, None, None, "https://next?seq=3"]
+
+
+@mock.patch("apps.associated_press.process_wire_story")
+@mock.patch("apps.associated_press.build_wires")
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_run_poll_keeps_wires_arc_would_not_take(mock_fetch, mock_build, mock_story, prefetch_env):
+    mock_fetch.side_effect = pages(10)
+    mock_build.side_effect = lambda items: [APStoryConverter({**item, "type": "text"}) for item in items]
+    sends = []
+
+    def story(converter, count, conn):
+        sends.append((converter.source_data["source_id"], inventory.select_feed_cursor(conn, DEFAULT_FEED)))
+        # arc is down for every attempt of the first cycle, past the times one call puts a wire back
+        return HTTPStatus.SERVICE_UNAVAILABLE if len(sends) <= MAX_REQUEUES + 1 else HTTPStatus.CREATED
+
+    mock_story.side_effect = story
+    assert run_poll(max_cycles=2) == 2
+    # the wire given up on waited for the next cycle, and its page was only checkpointed once it was sent
+    assert sends == [("0", None)] * (MAX_REQUEUES + 2) + [("1", None)]
+    conn = inventory.create_connection(str(prefetch_env))
+    assert inventory.select_feed_cursor(conn, DEFAULT_FEED) == "https://next?seq=2"
+    conn.close()
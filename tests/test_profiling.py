@@ -0,0 +1,103 @@
+import json
+import os
+import unittest.mock as mock
+
+import freezegun
+import pytest
+
+from apps import associated_press as ap
+from apps.associated_press.converter import APPhotoConverter
+from apps.associated_press.profiling import STAGES, Profiler
+from apps.associated_press.send_policy import SendPolicy
+from utils import inventory
+from utils.exceptions import ProfilerActiveException
+
+
+@pytest.fixture
+def photo_items(test_content):
+    # the photos build_wires converts, the others would cost extra
+    items = test_content.get_content("ap_feed_items.json")
+    return [item for item in items if item["type"] == "picture" and item.get("pricetag") in ["Unlimited", "", None]]
+
+
+@freezegun.freeze_time("2022-05-11 20:00:00")
+@mock.patch("requests.post")
+def test_profiler_reports_stages_and_items(mock_post, photo_items):
+    mock_post.return_value = mock.Mock(status_code=201, headers={})
+    originals = [ap.process_wire_photo, inventory.create_inventory, SendPolicy.post, APPhotoConverter.convert_ans]
+
+    profiler = Profiler(slow_items=3).start()
+    with pytest.raises(ProfilerActiveException):
+        Profiler().start()
+    ap.process_wires(ap.build_wires(photo_items))
+    report = profiler.stop()
+
+    stages = report["stages"]
+    assert list(stages) == STAGES
+    assert stages["fetch"]["calls"] == len(photo_items)
+    assert stages["send"]["calls"] == len(photo_items)
+    assert stages["inventory"]["calls"] == 3 * len(photo_items)
+    assert stages["convert_ans"]["calls"] > 0 and stages["get_sha1"]["calls"] > 0
+    assert stages["send"]["top_functions"]
+    assert stages["parse"]["calls"] == 0 and stages["parse"]["top_functions"] == []
+    # the slowest items, each with the stages it went through
+    assert len(report["slow_items"]) == 3
+    assert {item["source_id"] for item in report["slow_items"]} <= {item["source_id"] for item in photo_items}
+    assert set(report["slow_items"][0]["stages"]) == {"fetch", "convert_ans", "get_sha1", "inventory", "send"}
+    assert report["allocations"]
+
+    # the stages are back as they were, and another profiler can start
+    assert [
+        ap.process_wire_photo,
+        inventory.create_inventory,
+        SendPolicy.post,
+        APPhotoConverter.convert_ans,
+    ] == originals
+    assert "base_fields" not in vars(APPhotoConverter)
+    Profiler().start().stop()
+
+
+def test_nested_stages_are_counted_once():
+    profiler = Profiler().start()
+    try:
+        outer = profiler.enter("convert_ans", "a")
+        inner = profiler.enter("get_sha1", None)
+        profiler.exit(inner)
+        profiler.exit(outer)
+    finally:
+        report = profiler.stop()
+    assert report["stages"]["convert_ans"]["calls"] == 1
+    assert report["stages"]["get_sha1"]["calls"] == 1
+    breakdown = report["slow_items"][0]
+    assert breakdown["source_id"] == "a"
+    assert breakdown["seconds"] == pytest.approx(
+        report["stages"]["convert_ans"]["seconds"] + report["stages"]["get_sha1"]["seconds"]
+    )
+
+
+@freezegun.freeze_time("2022-05-11 20:00:00")
+@mock.patch("requests.post")
+@mock.patch("apps.associated_press.fetch_feed")
+def test_run_ap_ingest_wires_profiled(mock_fetch_feed, mock_post, photo_items, tmp_path, monkeypatch):
+    mock_fetch_feed.return_value = photo_items
+    mock_post.return_value = mock.Mock(status_code=201, headers={})
+    monkeypatch.setenv("AP_PROFILE_DIR", str(tmp_path))
+    wires = ap.run_ap_ingest_wires(profile=True)
+    assert len(wires) == len(photo_items)
+    assert {"fetch.prof", "convert_ans.prof", "send.prof", "profile.json"} <= set(os.listdir(tmp_path))
+    with open(tmp_path / "profile.json") as f:
+        assert json.load(f)["stages"]["send"]["calls"] == len(photo_items)
+
+
+def test_debug_profile_route():
+    from api.associated_press import app
+
+    res = app.test_client().get("/api/debug/profile?seconds=0")
+    assert res.status_code == 200
+    assert set(res.json["profile"]["stages"]) == set(STAGES)
+
+    profiler = Profiler().start()
+    try:
+        assert app.test_client().get("/api/debug/profile?seconds=0").status_code == 409
+    finally:
+        profiler.stop()
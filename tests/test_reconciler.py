@@ -0,0 +1,91 @@
+import io
+
+import requests
+
+from apps.associated_press.reconciler import reconcile
+from utils.inventory import create_connection, create_staged_images, create_table, select_staged_keys
+from utils.staging import LocalStagingStore
+
+
+class FakeSession:
+    """Photo Center has the images whose arc ids are in found"""
+
+    found = set()
+    requested = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def get(self, url, headers=None):
+        FakeSession.requested.append(url)
+        arc_id = url.rsplit("/", 1)[-1]
+        status = 200 if arc_id in FakeSession.found else 404
+        return type("Response", (), {"ok": status == 200, "status_code": status})()
+
+
+def staged_store(tmp_path, conn, rows):
+    store = LocalStagingStore(str(tmp_path), "https://images")
+    for key, arc_id, size, staged_at in rows:
+        store.put(key, io.BytesIO(b"x" * size))
+        create_staged_images(conn, [(key, arc_id, "source", size, staged_at, staged_at)])
+    return store
+
+
+def test_reconcile_verifies_and_evicts(tmp_path, monkeypatch):
+    monkeypatch.setattr(requests, "Session", FakeSession)
+    FakeSession.found = {"ARC1", "ARC2"}
+    FakeSession.requested = []
+    conn = create_connection()
+    create_table(conn)
+    # shared.jpg is used by two arc images, and Photo Center has only one of them
+    store = staged_store(
+        tmp_path, conn, [("one.jpg", "ARC1", 10, 100), ("shared.jpg", "ARC2", 10, 100), ("shared.jpg", "ARC3", 10, 100)]
+    )
+
+    stats = reconcile(conn, store, recheck_seconds=60, photo_api_url="http://photos/{org}/{arc_id}", now=1000)
+    assert stats["checked"] == 3
+    assert stats["verified"] == 2
+    assert stats["unverified"] == 1
+    assert stats["evicted"] == 1
+    assert len(FakeSession.requested) == 3
+    assert store.exists("one.jpg") is False
+    assert store.exists("shared.jpg") is True
+    assert [row[0] for row in select_staged_keys(conn)] == ["shared.jpg"]
+
+    # the unverified image backs off, so it is not checked again straight away
+    FakeSession.requested = []
+    assert reconcile(conn, store, recheck_seconds=60, now=1010)["checked"] == 0
+    assert FakeSession.requested == []
+
+    FakeSession.found.add("ARC3")
+    stats = reconcile(conn, store, recheck_seconds=60, photo_api_url="http://photos/{org}/{arc_id}", now=2000)
+    assert stats["verified"] == 1
+    assert store.exists("shared.jpg") is False
+    assert select_staged_keys(conn) == []
+
+
+def test_reconcile_caps(tmp_path, monkeypatch):
+    monkeypatch.setattr(requests, "Session", FakeSession)
+    FakeSession.found = set()
+    conn = create_connection()
+    create_table(conn)
+    store = staged_store(
+        tmp_path,
+        conn,
+        [
+            ("old.jpg", "A", 10, 100),
+            ("older.jpg", "B", 10, 500),
+            ("new.jpg", "C", 30, 900),
+            ("newest.jpg", "D", 30, 950),
+        ],
+    )
+
+    stats = reconcile(conn, store, max_age=600, max_bytes=40, photo_api_url="http://photos/{org}/{arc_id}", now=1000)
+    # old.jpg is past max_age, then the oldest objects go until the store is under max_bytes
+    assert stats["evicted"] == 3
+    assert stats["staged_bytes"] == 30
+    assert [store.exists(k) for k in ["old.jpg", "older.jpg", "new.jpg", "newest.jpg"]] == [False, False, False, True]
+    assert [row[0] for row in select_staged_keys(conn)] == ["newest.jpg"]
@@ -0,0 +1,109 @@
+import io
+import os
+import unittest.mock as mock
+
+import requests
+
+from apps.associated_press.converter import APPhotoConverter
+from apps.associated_press.relay import relay_image, relay_images
+from utils.staging import LocalStagingStore, S3StagingStore
+
+IMAGE = b"\xff\xd8\xff" + b"jpeg bytes " * 10000
+
+
+class StreamResponse:
+    def __init__(self, content=b"", status=200):
+        self.content = content
+        self.status = status
+        self.headers = {"Content-Type": "image/jpeg"}
+        self.chunks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status} error")
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            self.chunks += 1
+            yield self.content[i : i + chunk_size]
+
+
+def photo(source_id):
+    return APPhotoConverter(
+        {
+            "type": "picture",
+            "source_id": source_id,
+            "originalfilename": "Photo.JPG",
+            "download_url": f"https://ap/{source_id}",
+        },
+        org_name="myorg",
+    )
+
+
+def test_relay_image_local_store(tmp_path, monkeypatch):
+    responses = []
+
+    def mock_get(url, headers=None, stream=False):
+        assert stream is True
+        assert headers == {"x-api-key": "key"}
+        responses.append(StreamResponse(IMAGE))
+        return responses[-1]
+
+    monkeypatch.setattr(requests, "get", mock_get)
+    store = LocalStagingStore(str(tmp_path), "https://images.example.com/staged/")
+    first, second = photo("a"), photo("b")
+
+    url = relay_image(first, store, {"x-api-key": "key"})
+    assert url.startswith("https://images.example.com/staged/")
+    assert url.endswith(".jpg")
+    assert first.staged_url == url
+    assert responses[0].chunks > 1
+    with open(store.path(first.staged_key), "rb") as f:
+        assert f.read() == IMAGE
+
+    # the same image under another item is stored once
+    assert relay_image(second, store, {"x-api-key": "key"}) == url
+    assert os.listdir(tmp_path) == [first.staged_key]
+
+    store.delete(first.staged_key)
+    assert store.exists(first.staged_key) is False
+
+
+def test_relay_image_failure(tmp_path, monkeypatch):
+    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: StreamResponse(status=403))
+    converter = photo("a")
+    assert relay_image(converter, LocalStagingStore(str(tmp_path), "https://images"), {}) is None
+    assert converter.staged_url is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_relay_images_skips_staged(tmp_path, monkeypatch):
+    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: StreamResponse(IMAGE))
+    staged = photo("staged")
+    staged.staged_url = "https://already"
+    pending = [photo("a"), photo("b")]
+    assert relay_images([staged] + pending, LocalStagingStore(str(tmp_path), "https://images"), {}, 2) == pending
+    assert pending[0].staged_size == len(IMAGE)
+    assert staged.staged_url == "https://already"
+
+
+def test_s3_store():
+    client = mock.Mock()
+    missing = Exception("not found")
+    missing.response = {"Error": {"Code": "404"}}
+    client.head_object.side_effect = [missing, None]
+    store = S3StagingStore("bucket", endpoint_url="http://localhost:9000/", prefix="ap/", client=client)
+
+    assert store.exists("abc.jpg") is False
+    assert store.exists("abc.jpg") is True
+    store.put("abc.jpg", io.BytesIO(IMAGE), "image/jpeg")
+    client.upload_fileobj.assert_called_once()
+    assert client.upload_fileobj.call_args.args[1:] == ("bucket", "ap/abc.jpg")
+    assert store.url("abc.jpg") == "http://localhost:9000/bucket/ap/abc.jpg"
+    assert S3StagingStore("bucket", client=client).url("abc.jpg") == "https://bucket.s3.amazonaws.com/abc.jpg"
@@ -0,0 +1,63 @@
+import os
+import shutil
+
+from utils.inventory import create_connection, create_freshness, create_inventory, create_table
+from utils.retention import ARCHIVE, INCREMENTAL, Retention, enable_incremental_vacuum, retention_report
+
+LEGACY_DB = os.path.join(os.path.dirname(os.path.dirname(__file__)), "inbound-feeds-inventory.db")
+
+NOW = 1652270400.0  # 2022-05-11 12:00 UTC
+
+
+def inventoried(conn, count: int, day: str, inventoried_at: float, start: int = 0):
+    for i in range(start, start + count):
+        # a date in the format the inventory used to write, which create_inventory still reads
+        create_inventory(conn, (f"source{i}", f"arc{i}", "url", "story", f"sha{i}", f"{day} 10:05:00.000"))
+        create_freshness(conn, (f"source{i}", "v1", "story", None, None, None, None, None, None, None, inventoried_at))
+
+
+def test_retention_archives_in_batches(tmp_path):
+    conn = create_connection(str(tmp_path / "inventory.db"))
+    create_table(conn)
+    inventoried(conn, 5, "2022-05-01", NOW - 10 * 24 * 60 * 60)
+    inventoried(conn, 3, "2022-05-10", NOW - 24 * 60 * 60, start=5)
+
+    retention = Retention(retention_days=7, mode=ARCHIVE, batch_size=2, max_batches=2, pause=0, clock=lambda: NOW)
+    stats = retention.run(conn)
+    # two batches of two from each table, the last old row is left for the next pass
+    assert stats["pruned"] == 8
+    assert stats["inventory_rows"] == 4
+    assert stats["lookup_p50_us"] is not None
+    assert conn.execute("SELECT COUNT(*) FROM ap_feed_inventory_history").fetchone()[0] == 4
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    # not due again until the interval has passed
+    assert retention.run_if_due(conn) is None
+    stats = retention.run(conn)
+    assert stats["pruned"] == 2
+    assert stats["inventory_rows"] == 3 and stats["freshness_rows"] == 3
+    assert [row[0] for row in conn.execute("SELECT source_id FROM ap_inventory ORDER BY source_id")] == [
+        "source5",
+        "source6",
+        "source7",
+    ]
+
+    report = retention_report(conn, hours=24 * 365 * 100)
+    assert report["passes"] == 2
+    assert report["pruned"] == 10
+    assert report["change"]["inventory_rows"] == -1
+    conn.close()
+
+
+def test_retention_never_runs_a_full_vacuum(tmp_path):
+    path = str(tmp_path / "inventory.db")
+    shutil.copy(LEGACY_DB, path)
+    conn = create_connection(path)
+    create_table(conn)
+    # a pass on a database from before incremental vacuum leaves it as it is, the switch over is a separate step
+    Retention(pause=0, clock=lambda: NOW).run(conn)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] != INCREMENTAL
+    assert enable_incremental_vacuum(conn)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == INCREMENTAL
+    assert not enable_incremental_vacuum(conn)
+    conn.close()
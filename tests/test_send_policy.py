@@ -0,0 +1,147 @@
+import unittest.mock as mock
+from http import HTTPStatus
+
+import pytest
+import requests
+
+from apps.associated_press import MAX_REQUEUES, process_wires
+from apps.associated_press.converter import APStoryConverter
+from apps.associated_press.send_policy import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, SendPolicy
+from apps.associated_press.send_queue import SendQueue
+from utils.exceptions import CircuitOpenException
+
+
+class Clock:
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def response(status_code: int):
+    res = mock.Mock(status_code=status_code, headers={})
+    if status_code >= 400:
+        res.raise_for_status.side_effect = requests.exceptions.HTTPError(f"{status_code} error")
+    return res
+
+
+def test_breaker_opens_and_probes():
+    clock = Clock()
+    breaker = CircuitBreaker(window=4, threshold=0.5, min_calls=4, cooldown=60, clock=clock)
+    for success in [True, False, True]:
+        breaker.record(success)
+    assert breaker.state == CLOSED
+    breaker.record(False)
+    assert breaker.state == OPEN and breaker.is_open
+    assert breaker.allow() is False
+    assert breaker.metrics()["breaker_state_value"] == 2
+
+    # after the cooldown a single probe goes through, and its failure opens the breaker again
+    clock.now = 60
+    assert breaker.allow() is True
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow() is False
+    breaker.record(False)
+    assert breaker.state == OPEN and breaker.retry_in() == 60
+
+    clock.now = 120
+    assert breaker.allow() is True
+    breaker.record(True)
+    assert breaker.state == CLOSED and breaker.error_rate == 0
+
+
+@mock.patch("time.sleep")
+@mock.patch("requests.post")
+def test_send_policy_retries(mock_post, mock_sleep):
+    policy = SendPolicy(CircuitBreaker(min_calls=10), retries=2, backoff_base=1, backoff_cap=4)
+    mock_post.side_effect = [response(503), response(201)]
+    slot = mock.Mock()
+    assert policy.post("https://mc", slot=slot).status_code == 201
+    assert mock_post.call_count == 2
+    # the retry took a rate limited call of its own
+    assert slot.call_count == 2
+    assert mock_post.call_args.kwargs["timeout"] == 30
+    assert 0 <= mock_sleep.call_args.args[0] <= 1
+
+    # a refused send is not retried, and does not count against arc
+    mock_post.reset_mock(side_effect=True)
+    mock_post.side_effect = [response(400)]
+    with pytest.raises(requests.exceptions.HTTPError) as e:
+        policy.post("https://mc")
+    assert e.value.response.status_code == 400
+    assert mock_post.call_count == 1
+    assert policy.breaker.error_rate == 1 / 3
+
+    # timeouts are retried until the retries run out
+    mock_post.reset_mock(side_effect=True)
+    mock_post.side_effect = requests.exceptions.Timeout("timed out")
+    with pytest.raises(requests.exceptions.Timeout):
+        policy.post("https://mc")
+    assert mock_post.call_count == 3
+
+
+@mock.patch("requests.post")
+def test_send_policy_open_breaker_does_not_send(mock_post):
+    policy = SendPolicy(CircuitBreaker(min_calls=1, threshold=1), retries=0)
+    mock_post.side_effect = [response(500)]
+    with pytest.raises(requests.exceptions.HTTPError):
+        policy.post("https://mc")
+    with pytest.raises(CircuitOpenException):
+        policy.post("https://mc")
+    assert mock_post.call_count == 1
+
+
+@mock.patch("apps.associated_press.process_wire_story")
+def test_process_wires_pauses_on_open_breaker(mock_story, monkeypatch):
+    policy = SendPolicy(CircuitBreaker(min_calls=1, threshold=1), retries=0)
+    monkeypatch.setattr("apps.associated_press.migration_center", policy)
+
+    def outage(converter, count, conn):
+        policy.breaker.record(False)
+        return HTTPStatus.SERVICE_UNAVAILABLE
+
+    mock_story.side_effect = outage
+    queue = SendQueue()
+    wires = [APStoryConverter({"source_id": s, "type": "text"}) for s in ["a", "b"]]
+    process_wires(wires, mock.MagicMock(), queue=queue, store=False)
+    # the first wire failed and went back in line, the second was never tried
+    assert mock_story.call_count == 1
+    assert len(queue) == 2
+
+
+@mock.patch("apps.associated_press.process_wire_story")
+def test_process_wires_requeues_only_what_arc_could_not_take(mock_story, monkeypatch):
+    clock = Clock()
+    policy = SendPolicy(CircuitBreaker(min_calls=1, threshold=1, cooldown=60, clock=clock), retries=0)
+    monkeypatch.setattr("apps.associated_press.migration_center", policy)
+    # the breaker opened and cooled down, but nothing has asked it since, so it still says open
+    policy.breaker.record(False)
+    clock.now = 60
+    assert policy.breaker.state == OPEN and not policy.breaker.is_open
+
+    # a wire that failed before it was posted is not put back, however the breaker stands
+    mock_story.return_value = "Wire's sha1 exists in inventory"
+    wires = [APStoryConverter({"source_id": s, "type": "text"}) for s in ["a", "b"]]
+    assert process_wires(wires, mock.MagicMock(), store=False) == []
+    assert mock_story.call_count == 2
+
+    # a wire arc keeps failing is put back a few times, then given back to the caller
+    mock_story.reset_mock()
+    mock_story.return_value = HTTPStatus.SERVICE_UNAVAILABLE
+    wire = APStoryConverter({"source_id": "c", "type": "text"})
+    assert process_wires([wire], mock.MagicMock(), store=False) == [wire]
+    assert mock_story.call_count == MAX_REQUEUES + 1
+
+
+@mock.patch("apps.associated_press.process_wire_story")
+def test_process_wires_returns_unsent_when_it_owns_the_queue(mock_story, monkeypatch):
+    policy = SendPolicy(CircuitBreaker(min_calls=1, threshold=1), retries=0)
+    monkeypatch.setattr("apps.associated_press.migration_center", policy)
+
+    def outage(converter, count, conn):
+        policy.breaker.record(False)
+        return HTTPStatus.SERVICE_UNAVAILABLE
+
+    mock_story.side_effect = outage
+    wires = [APStoryConverter({"source_id": s, "type": "text"}) for s in ["a", "b"]]
+    assert sorted(w.source_data["source_id"] for w in process_wires(wires, mock.MagicMock(), store=False)) == ["a", "b"]
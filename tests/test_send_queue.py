@@ -0,0 +1,132 @@
+from apps.associated_press.converter import APPhotoConverter, APStoryConverter
+from apps.associated_press.send_queue import SendQueue, urgency
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def story(source_id, versioncreated):
+    return APStoryConverter(
+        {"type": "text", "source_id": source_id, "versioncreated": versioncreated}, org_name="myorg"
+    )
+
+
+def photo(source_id, versioncreated):
+    return APPhotoConverter(
+        {"type": "picture", "source_id": source_id, "versioncreated": versioncreated}, org_name="myorg"
+    )
+
+
+def test_newer_version_replaced_in_place():
+    queue = SendQueue()
+    first = story("a", "2022-05-11T04:07:27Z")
+    second = photo("b", "2022-05-11T04:07:27Z")
+    newer = story("a", "2022-05-11T04:10:00Z")
+
+    assert queue.put(first) is False
+    assert queue.put(second) is False
+    assert queue.put(newer) is True
+    assert len(queue) == 2
+    assert queue.coalesced == 1
+
+    # newer version keeps the older version's place in line
+    assert queue.pop_ready() is newer
+    assert queue.pop_ready() is second
+    assert queue.pop_ready() is None
+
+
+def test_older_version_ignored():
+    queue = SendQueue()
+    newer = story("a", "2022-05-11T04:10:00Z")
+    queue.put(newer)
+    assert queue.put(story("a", "2022-05-11T04:07:27Z")) is False
+    assert queue.pop_ready() is newer
+
+
+def test_story_hold():
+    clock = FakeClock()
+    queue = SendQueue(hold_seconds=60, clock=clock)
+    queue.put(story("a", "2022-05-11T04:07:27Z"))
+    picture = photo("b", "2022-05-11T04:07:27Z")
+    queue.put(picture)
+
+    # photos are not held, stories wait out the hold
+    assert queue.pop_ready() is picture
+    assert queue.pop_ready() is None
+    assert queue.next_ready_in() == 60
+
+    # a new version restarts the hold
+    clock.now = 50
+    newer = story("a", "2022-05-11T04:10:00Z")
+    queue.put(newer)
+    clock.now = 100
+    assert queue.pop_ready() is None
+    assert queue.next_ready_in() == 10
+    clock.now = 110
+    assert queue.pop_ready() is newer
+    assert queue.next_ready_in() is None
+
+
+def test_flush_ignores_hold():
+    queue = SendQueue(hold_seconds=60, clock=FakeClock())
+    held = story("a", "2022-05-11T04:07:27Z")
+    queue.put(held)
+    assert queue.pop_ready() is None
+    assert queue.pop_ready(flush=True) is held
+
+
+def prioritized(source_id, wire_type, urgency=None, editorialpriority=None, firstcreated=None):
+    data = {"type": wire_type, "source_id": source_id, "firstcreated": firstcreated}
+    if urgency is not None:
+        data["urgency"] = urgency
+    if editorialpriority is not None:
+        data["editorialpriority"] = editorialpriority
+    cls = APStoryConverter if wire_type == "text" else APPhotoConverter
+    return cls(data, org_name="myorg")
+
+
+def test_urgency():
+    assert urgency(prioritized("a", "text", urgency=2)) == 2
+    assert urgency(prioritized("a", "text", editorialpriority="f")) == 1
+    assert urgency(prioritized("a", "text", editorialpriority="?")) == 4
+    assert urgency(prioritized("a", "text")) == 4
+
+
+def test_priority_order():
+    queue = SendQueue(clock=FakeClock())
+    routine_photo = prioritized("photo", "picture", urgency=4)
+    routine_older = prioritized("older", "text", urgency=4, firstcreated="2022-05-11T04:00:00Z")
+    routine_newer = prioritized("newer", "text", urgency=4, firstcreated="2022-05-11T05:00:00Z")
+    flash = prioritized("flash", "text", editorialpriority="f")
+    queue.extend([routine_photo, routine_older, routine_newer, flash])
+
+    assert list(queue) == [flash, routine_newer, routine_older, routine_photo]
+    assert [queue.pop_ready() for _ in range(4)] == [flash, routine_newer, routine_older, routine_photo]
+    assert set(queue.latency_report().keys()) == {"1", "4"}
+    assert queue.latency_report()["4"]["sent"] == 3
+
+
+def test_priority_aging():
+    clock = FakeClock()
+    queue = SendQueue(aging_seconds=300, clock=clock)
+    routine = prioritized("routine", "text", urgency=4)
+    queue.put(routine)
+
+    # an urgent story queued soon after still goes first
+    clock.now = 200
+    urgent = prioritized("urgent", "text", urgency=3)
+    queue.put(urgent)
+    assert list(queue) == [urgent, routine]
+
+    # but not once the routine story has waited more than one aging period longer
+    clock.now = 400
+    later = prioritized("later", "text", urgency=3)
+    queue.put(later)
+    assert list(queue) == [urgent, routine, later]
+    assert queue.pop_ready() is urgent
+    assert queue.latency_report()["3"]["max_wait"] == 200
@@ -0,0 +1,58 @@
+import pytest
+from decouple import UndefinedValueError
+
+from apps import associated_press as ap
+from benchmarks.startup import measure, regressions
+from utils.lazy import lazy_module
+from utils.settings import get_settings, reset_settings
+
+
+@pytest.fixture
+def fresh_settings(monkeypatch):
+    # every setting these tests rely on, so they do not depend on the shell they run from
+    for name, value in {
+        "AP_API_KEY": "testkey",
+        "ARC_ORG_ID": "sandbox.myorg",
+        "ARC_ORG_WEBSITE": "mywebsite",
+        "ARC_WEBSITE_SECTION": "/wires/ap",
+        "ARC_TOKEN_SANDBOX": "sbx",
+        "ARC_TOKEN_PRODUCTION": "prod",
+    }.items():
+        monkeypatch.setenv(name, value)
+    reset_settings()
+    yield
+    reset_settings()
+
+
+def test_cold_start():
+    # budgets well above a laptop's, so only a real regression fails on a slow ci box
+    result = measure(runs=3)
+    assert result["loaded"] == []
+    assert regressions(result, import_budget_ms=2000, first_request_budget_ms=2500) == []
+
+
+def test_lazy_module():
+    module = lazy_module("json")
+    assert "(loaded)" not in repr(module)
+    assert module.dumps([1]) == "[1]"
+    assert "(loaded)" in repr(module)
+
+
+def test_settings_resolved_once(fresh_settings, monkeypatch):
+    settings = get_settings()
+    assert get_settings() is settings
+    assert settings.arc_token_name == "ARC_TOKEN_SANDBOX"
+    monkeypatch.setenv("ARC_ORG_ID", "myorg")
+    # a changed environment is only read again after reset_settings
+    assert get_settings().arc_org_id == settings.arc_org_id
+    reset_settings()
+    assert get_settings().arc_token_name == "ARC_TOKEN_PRODUCTION"
+    assert ap.bearer_token()["Authorization"] == "Bearer prod"
+
+
+def test_missing_token(fresh_settings, monkeypatch):
+    monkeypatch.delenv("ARC_TOKEN_SANDBOX", raising=False)
+    with pytest.raises(UndefinedValueError):
+        ap.bearer_token()
+    # a fan-out target brings its own
+    assert ap.bearer_token("target")["Authorization"] == "Bearer target"
@@ -0,0 +1,95 @@
+import json
+import unittest.mock as mock
+
+import freezegun
+import pytest
+import requests
+
+from apps import associated_press as ap
+from utils.tracing import NOOP_SPAN, Tracer, current_span, start_trace
+
+
+def read_spans(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_spans_are_written_as_zipkin(tmp_path):
+    tracer = Tracer(str(tmp_path / "traces.jsonl"))
+    root = tracer.start_trace("ap.item", source_id="abc", missing=None)
+    with root.child("convert") as span:
+        assert current_span() is span
+        span.child("inner", start=span.start).finish()
+    with pytest.raises(ValueError):
+        with root.child("send"):
+            raise ValueError("refused")
+    assert current_span() is NOOP_SPAN
+    root.finish(outcome="sent")
+    root.finish(outcome="twice")
+
+    inner, convert, send, item = read_spans(tmp_path / "traces.jsonl")
+    assert item["name"] == "ap.item" and "parentId" not in item
+    assert item["tags"] == {"source_id": "abc", "outcome": "sent"}
+    assert len(item["traceId"]) == 32 and len(item["id"]) == 16
+    assert {span["traceId"] for span in [inner, convert, send]} == {item["traceId"]}
+    assert convert["parentId"] == item["id"] and inner["parentId"] == convert["id"]
+    assert send["tags"] == {"error": "refused"}
+    assert convert["localEndpoint"] == {"serviceName": "inbound-feeds"}
+    assert all(span["duration"] >= 1 for span in [inner, convert, send, item])
+
+
+def test_tracing_off(monkeypatch):
+    monkeypatch.delenv("AP_TRACE_FILE", raising=False)
+    span = start_trace("ap.item", source_id="abc")
+    assert span is NOOP_SPAN
+    with span.child("convert") as child:
+        assert child is NOOP_SPAN
+    child.finish()
+
+
+@freezegun.freeze_time("2022-05-11 20:00:00")
+@mock.patch("requests.post")
+@mock.patch("apps.associated_press.fetch_feed")
+def test_story_and_its_photos_share_a_trace(mock_fetch_feed, mock_post, test_content, tmp_path, monkeypatch):
+    monkeypatch.setenv("AP_TRACE_FILE", str(tmp_path / "traces.jsonl"))
+    story = next(item for item in test_content.get_content("ap_feed_items.json") if item["type"] == "text")
+    photo = test_content.get_content("ap_picture_item_test_converter_data.json")
+    # each association fetch brings back a photo of its own
+    mock_fetch_feed.side_effect = lambda url: {**photo, "source_id": url.split("?")[0].split("/")[-1]}
+    xml = test_content.get_content("ap_text_story_Election_2022.xml")
+    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mock.Mock(ok=True, content=xml))
+    mock_post.return_value = mock.Mock(status_code=201, headers={})
+
+    wires = ap.build_wires([story])
+    ap.process_wires(wires)
+
+    spans = read_spans(tmp_path / "traces.jsonl")
+    assert len({span["traceId"] for span in spans}) == 1
+    by_id = {span["id"]: span for span in spans}
+    names = [span["name"] for span in spans]
+    photos = len(wires) - 1
+    assert photos > 0
+    assert names.count("fetch_story") == 1
+    assert names.count("fetch_association") == photos
+    assert names.count("ap.association") == photos
+    assert names.count("migration_center_post") == len(wires)
+    assert names.count("rate_limit_wait") == len(wires)
+
+    (root,) = [span for span in spans if span["name"] == "ap.item"]
+    assert root["tags"]["outcome"] == "sent" and root["tags"]["source_id"] == story["source_id"]
+    for span in spans:
+        if span["name"] == "migration_center_post":
+            # post, send, then the story or one of its photos
+            send = by_id[span["parentId"]]
+            assert send["name"] == "send" and send["tags"]["result"] == "201"
+            assert by_id[send["parentId"]]["name"] in ["ap.item", "ap.association"]
+
+
+def test_failed_story_fetch_is_skipped(test_content, tmp_path, monkeypatch):
+    monkeypatch.setenv("AP_TRACE_FILE", str(tmp_path / "traces.jsonl"))
+    story = next(item for item in test_content.get_content("ap_feed_items.json") if item["type"] == "text")
+    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: mock.Mock(ok=False, status_code=503))
+
+    assert ap.build_wires([story]) == []
+    (root,) = [span for span in read_spans(tmp_path / "traces.jsonl") if span["name"] == "ap.item"]
+    assert root["tags"]["outcome"] == "fetch_failed"
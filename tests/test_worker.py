@@ -0,0 +1,128 @@
+import unittest.mock as mock
+
+import requests
+
+from apps.associated_press.converter import APStoryConverter
+from apps.associated_press.worker import LEASE_FEED, Worker, run_worker
+from utils import inventory
+from utils.settings import reset_settings
+
+
+def leases_db(tmp_path):
+    conn = inventory.share_connection(inventory.create_connection(str(tmp_path / "inventory.db")))
+    inventory.create_table(conn)
+    return conn
+
+
+def test_lease_lifecycle(tmp_path):
+    conn = leases_db(tmp_path)
+    items = [{"source_id": s, "versioncreated": "1"} for s in ["a", "b", "c"]]
+    assert inventory.offer_leases(conn, items, now=100) == 3
+    # the same versions offered by another worker are ignored, a newer version is a new item
+    assert inventory.offer_leases(conn, items + [{"source_id": "a", "versioncreated": "2"}], now=101) == 1
+
+    first = inventory.claim_leases(conn, "one", limit=2, ttl=60, now=110)
+    assert [(s, v) for s, v, _, _ in first] == [("a", "1"), ("b", "1")]
+    # a's newer version waits while worker one holds a lease on a
+    second = inventory.claim_leases(conn, "two", limit=10, ttl=60, now=110)
+    assert [(s, v, item) for s, v, item, _ in second] == [("c", "1", {"source_id": "c", "versioncreated": "1"})]
+
+    assert inventory.heartbeat_leases(conn, "one", expires_at=200) == 2
+    assert inventory.complete_leases(conn, "two", [("c", "1")], now=120) == 1
+    assert inventory.expire_leases(conn, now=150) == []
+
+    # worker one stops heartbeating, its leases expire and worker two steals them
+    assert sorted(inventory.expire_leases(conn, now=250)) == [("a", "1", "one"), ("b", "1", "one")]
+    stolen = inventory.claim_leases(conn, "two", limit=10, ttl=60, now=250)
+    assert sorted((s, v) for s, v, _, _ in stolen) == [("a", "1"), ("a", "2"), ("b", "1")]
+    # worker one cannot complete what it no longer holds
+    assert inventory.complete_leases(conn, "one", [("a", "1")], now=260) == 0
+    assert inventory.release_leases(conn, "two", [("b", "1")]) == 1
+    attempts = dict(conn.execute("SELECT source_id || version, attempts FROM ap_leases").fetchall())
+    assert attempts == {"a1": 2, "a2": 1, "b1": 2, "c1": 1}
+
+
+@mock.patch("apps.associated_press.process_wires")
+@mock.patch("apps.associated_press.build_wires")
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_workers_split_the_feed(mock_fetch, mock_build, mock_process, tmp_path):
+    items = [{"source_id": s, "versioncreated": "1", "type": "text"} for s in ["a", "b", "c", "d"]]
+    mock_fetch.return_value = ([dict(item) for item in items], "https://next?seq=1")
+
+    def build(claimed):
+        wires = [APStoryConverter(item) for item in claimed]
+        for wire in wires:
+            wire.mark("converted")
+        return wires
+
+    mock_build.side_effect = build
+    location = str(tmp_path / "inventory.db")
+    one = Worker(leases_db(tmp_path), location, "one", ttl=60, batch_size=3)
+    two = Worker(leases_db(tmp_path), location, "two", ttl=60, batch_size=3)
+
+    claimed_one = [s for s, _, _, _ in one.cycle()]
+    claimed_two = [s for s, _, _, _ in two.cycle()]
+    assert claimed_one == ["a", "b", "c"]
+    assert claimed_two == ["d"]
+    # the workers follow one cursor, so the second one reads on from where the first one left the feed
+    assert [c.args[0] for c in mock_fetch.call_args_list] == [None, "https://next?seq=1"]
+    assert one.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert one.cycle() == [] and two.cycle() == []
+    done = one.conn.execute("SELECT COUNT(*) FROM ap_leases WHERE done_at IS NOT NULL").fetchone()[0]
+    assert done == 4
+
+
+@mock.patch("apps.associated_press.process_wires")
+@mock.patch("apps.associated_press.build_wires")
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_worker_releases_unsent(mock_fetch, mock_build, mock_process, tmp_path):
+    mock_fetch.return_value = ([{"source_id": s, "versioncreated": "1", "type": "text"} for s in ["a", "b"]], None)
+    # process_wires stopped after sending a, or arc could not take b, so b goes back for another worker
+    wires = [APStoryConverter({"source_id": s, "versioncreated": "1"}) for s in ["a", "b"]]
+    mock_build.return_value = wires
+    mock_process.return_value = [wires[1]]
+    worker = Worker(leases_db(tmp_path), str(tmp_path / "inventory.db"), "one")
+    worker.cycle()
+    rows = worker.conn.execute(
+        "SELECT source_id, worker, done_at IS NOT NULL FROM ap_leases ORDER BY source_id"
+    ).fetchall()
+    assert rows == [("a", "one", 1), ("b", None, 0)]
+
+
+def test_advance_feed_cursor(tmp_path):
+    conn = leases_db(tmp_path)
+    assert inventory.advance_feed_cursor(conn, LEASE_FEED, None, "https://next?seq=1")
+    # a worker that read the feed from where it was before loses to the one that moved it first
+    assert not inventory.advance_feed_cursor(conn, LEASE_FEED, None, "https://next?seq=1")
+    assert inventory.advance_feed_cursor(conn, LEASE_FEED, "https://next?seq=1", "https://next?seq=2")
+    assert not inventory.advance_feed_cursor(conn, LEASE_FEED, "https://next?seq=1", "https://next?seq=2")
+    assert inventory.select_feed_cursor(conn, LEASE_FEED) == "https://next?seq=2"
+
+
+@mock.patch("apps.associated_press.process_wires")
+@mock.patch("apps.associated_press.build_wires")
+@mock.patch("apps.associated_press.fetch_feed_page")
+def test_run_worker_survives_a_failed_cycle(mock_fetch, mock_build, mock_process, tmp_path, monkeypatch):
+    monkeypatch.setenv("SQLDB_LOCATION", str(tmp_path / "inventory.db"))
+    monkeypatch.setenv("AP_POLL_MIN_INTERVAL", "0")
+    reset_settings()
+    mock_fetch.side_effect = [
+        requests.exceptions.ConnectionError("ap down"),
+        ([{"source_id": "a", "versioncreated": "1", "type": "text"}], "https://next?seq=1"),
+        ([], None),
+    ]
+    mock_build.side_effect = lambda items: [APStoryConverter(item) for item in items]
+    # arc fails in a way process_wires does not handle, the claimed lease is given back at once
+    mock_process.side_effect = [requests.exceptions.ConnectionError("arc down"), []]
+    store = mock.Mock()
+    try:
+        with mock.patch("apps.associated_press.worker.staging_store_from_config", return_value=store):
+            assert run_worker(max_cycles=3, worker_id="one") == 3
+    finally:
+        reset_settings()
+    assert mock_process.call_count == 2
+    # the wires a worker sends are relayed through the staging store, as the poller's are
+    assert all(c.kwargs["store"] is store for c in mock_process.call_args_list)
+    conn = leases_db(tmp_path)
+    assert conn.execute("SELECT worker, attempts, done_at IS NOT NULL FROM ap_leases").fetchall() == [("one", 2, 1)]
+    conn.close()
@@ -1,8 +1,9 @@
 import base64
 import hashlib
-import json
 import uuid
 
+from utils.json_codec import id_bytes
+
 
 def generate_arc_id(*args, **kwargs):
     r"""from_hash(*args, *, as_uuid=False, **kwargs)
@@ -23,7 +24,7 @@ def generate_arc_id(*args, **kwargs):
 
     uuid_object = uuid.UUID(
         bytes=hashlib.blake2b(
-            json.dumps((args, kwargs), sort_keys=1, separators=(",", ":")).encode("utf-8"),
+            id_bytes((args, kwargs)),
             digest_size=16,
         ).digest()
     )
@@ -0,0 +1,172 @@
+# Append only archive of the raw AP payloads, the feed item and, for stories, the NITF XML, so items can be converted
+# again without downloading them from AP. Payloads are zlib compressed and appended to numbered segment files,
+# and an SQLite index in the archive directory records where each source_id and version is found.
+# Segments are read back through memory maps, so reading an item only touches the pages it lives in.
+# Several processes may append to one archive, a cron run while the poller is up, so a record is written under an
+# exclusive lock on its segment and at the segment's end as it is then, not where this process last left it.
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from typing import Optional
+
+from decouple import config
+
+from utils.logger import get_logger
+
+logger = get_logger()
+
+SEGMENT_NAME = "segment-{:08d}.bin"
+# each record is a header of the payload's compressed length and crc32, then the payload
+HEADER = struct.Struct(">II")
+# the payload is the length of the feed item json, the feed item json, then the story xml
+ITEM_LENGTH = struct.Struct(">I")
+
+
+class RawArchive:
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024, read_only: bool = False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.index = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self.index.execute(
+            """CREATE TABLE IF NOT EXISTS ap_raw_archive (
+    source_id   STRING   NOT NULL,
+    version     STRING   NOT NULL,
+    arc_type    STRING,
+    segment     INTEGER  NOT NULL,
+    offset      INTEGER  NOT NULL,
+    length      INTEGER  NOT NULL,
+    archived_at REAL     NOT NULL,
+    sent_digest STRING,
+    PRIMARY KEY (source_id, version) ON CONFLICT IGNORE
+); """
+        )
+        self.index.execute("CREATE INDEX IF NOT EXISTS ap_raw_archive_archived_at ON ap_raw_archive (archived_at);")
+        self.lock = threading.Lock()
+        self.maps = {}  # segment -> mmap
+        segments = sorted(int(name[8:16]) for name in os.listdir(directory) if name.startswith("segment-"))
+        self.segment = segments[-1] if segments else 1
+        self.writer = None if read_only else open(self.segment_path(self.segment), "ab")
+
+    def segment_path(self, segment: int):
+        return os.path.join(self.directory, SEGMENT_NAME.format(segment))
+
+    def contains(self, source_id: str, version: str):
+        sql = "SELECT 1 FROM ap_raw_archive WHERE source_id = ? AND version = ?;"
+        return self.index.execute(sql, (source_id, version)).fetchone() is not None
+
+    def append(self, item: dict, story_data: Optional[bytes] = None, arc_type: str = None):
+        """archive one version of an item, once. returns False when this version was already archived"""
+        source_id = item.get("source_id")
+        version = item.get("versioncreated") or ""
+        item_json = json.dumps(item).encode("utf-8")
+        payload = zlib.compress(ITEM_LENGTH.pack(len(item_json)) + item_json + (story_data or b""))
+        with self.lock:
+            if self.contains(source_id, version):
+                return False
+            while True:
+                fcntl.flock(self.writer, fcntl.LOCK_EX)
+                offset = self.writer.seek(0, os.SEEK_END)
+                if offset == 0 or offset + HEADER.size + len(payload) <= self.segment_bytes:
+                    break
+                fcntl.flock(self.writer, fcntl.LOCK_UN)
+                self.writer.close()
+                self.segment += 1
+                self.writer = open(self.segment_path(self.segment), "ab")
+            try:
+                self.writer.write(HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+                self.writer.flush()
+            finally:
+                fcntl.flock(self.writer, fcntl.LOCK_UN)
+            sql = """INSERT INTO ap_raw_archive(source_id, version, arc_type, segment, offset, length, archived_at)
+                     VALUES (?, ?, ?, ?, ?, ?, ?);"""
+            self.index.execute(
+                sql, (source_id, version, arc_type, self.segment, offset, HEADER.size + len(payload), time.time())
+            )
+            self.index.commit()
+        return True
+
+    def segment_map(self, segment: int, end: int):
+        current = self.maps.get(segment)
+        # the segment being written to grows, so map it again once a record is past the end of the old map
+        if current is None or len(current) < end:
+            with open(self.segment_path(segment), "rb") as f:
+                current = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            old = self.maps.get(segment)
+            self.maps[segment] = current
+            if old is not None:
+                old.close()
+        return current
+
+    def read(self, segment: int, offset: int, length: int):
+        """the feed item and story xml archived at this location"""
+        with self.lock:
+            if self.writer is not None:
+                self.writer.flush()
+            view = self.segment_map(segment, offset + length)
+            record = view[offset : offset + length]
+        size, crc = HEADER.unpack_from(record)
+        payload = record[HEADER.size : HEADER.size + size]
+        if zlib.crc32(payload) != crc:
+            raise ValueError(f"Corrupt archive record in segment {segment} at offset {offset}")
+        data = zlib.decompress(payload)
+        (item_length,) = ITEM_LENGTH.unpack_from(data)
+        item = json.loads(data[ITEM_LENGTH.size : ITEM_LENGTH.size + item_length])
+        story_data = data[ITEM_LENGTH.size + item_length :] or None
+        return item, story_data
+
+    def latest_versions(self, since: float = 0):
+        """the location of the newest archived version of every item archived since the epoch seconds given"""
+        sql = """SELECT a.source_id, a.version, a.arc_type, a.segment, a.offset, a.length, a.sent_digest
+                 FROM ap_raw_archive a
+                 WHERE a.archived_at >= ?
+                 AND a.version = (SELECT MAX(b.version) FROM ap_raw_archive b WHERE b.source_id = a.source_id)
+                 ORDER BY a.segment, a.offset;"""
+        return self.index.execute(sql, (since,)).fetchall()
+
+    def mark_sent(self, source_id: str, version: str, digest: str):
+        """remember the digest of the ans sent for this version, reconversion only sends items whose ans differs"""
+        with self.lock:
+            sql = "UPDATE ap_raw_archive SET sent_digest = ? WHERE source_id = ? AND version = ?;"
+            self.index.execute(sql, (digest, source_id, version or ""))
+            self.index.commit()
+
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+            for view in self.maps.values():
+                view.close()
+            self.maps = {}
+            self.index.close()
+
+
+def ans_digest(ans: dict):
+    """a digest of the ans that only changes when the conversion does. the photo expiration date moves every day."""
+    additional_properties = dict(ans.get("additional_properties") or {})
+    additional_properties.pop("expiration_date", None)
+    stable = {**ans, "additional_properties": additional_properties}
+    return hashlib.sha1(json.dumps(stable, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+_archive = None
+_archive_lock = threading.Lock()
+
+
+def get_archive():
+    """the archive in AP_ARCHIVE_DIR, shared by the process, or None when raw payloads are not archived"""
+    global _archive
+    directory = config("AP_ARCHIVE_DIR", default="")
+    if not directory:
+        return None
+    with _archive_lock:
+        if _archive is None or _archive.directory != directory:
+            _archive = RawArchive(directory, config("AP_ARCHIVE_SEGMENT_BYTES", default=64 * 1024 * 1024, cast=int))
+    return _archive
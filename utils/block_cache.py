@@ -0,0 +1,63 @@
+# Least recently used cache of the ANS content elements generated for each block of a story's NITF body,
+# see APStoryConverter.get_content_elements. A live updated story is converted again every time AP versions it,
+# but usually only a paragraph or two changed, so the unchanged paragraphs reuse the elements they produced last time.
+import hashlib
+import threading
+from collections import OrderedDict
+
+from decouple import config
+
+from utils.json_codec import codec
+
+
+class BlockCache:
+    def __init__(self, max_entries: int = 5000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    @staticmethod
+    def key(salt: str, block: str):
+        return hashlib.sha1(f"{salt}\n{block}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """a fresh copy of the elements cached for this key, or None"""
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        # elements are kept as json, so callers can change the elements they get back without changing the cache
+        return codec.loads(cached)
+
+    def put(self, key: str, elements: list):
+        try:
+            cached = codec.dumps(elements)
+        except (TypeError, ValueError):
+            return
+        with self.lock:
+            self.entries[key] = cached
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {"blocks": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+content_cache = BlockCache(config("AP_CONTENT_CACHE_BLOCKS", default=5000, cast=int))
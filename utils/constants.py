@@ -1,6 +1,27 @@
-AP_RESULTS_JMESPATH_STR = 'data.items[*].item.{"type": type, "source_id": altids.itemid, "url": uri, "headline": headline, "bylines": bylines, "firstcreated": firstcreated, "versioncreated": versioncreated, "originalfilename": renditions.main.originalfilename, "description_caption": description_caption, "download_url": renditions.main.href || renditions.nitf.href, "associations": associations, "priced": renditions.main.priced, "pricetag": renditions.main.pricetag}'
+AP_RESULTS_JMESPATH_STR = 'data.items[*].item.{"type": type, "source_id": altids.itemid, "url": uri, "headline": headline, "bylines": bylines, "firstcreated": firstcreated, "versioncreated": versioncreated, "urgency": urgency, "editorialpriority": editorialpriority, "originalfilename": renditions.main.originalfilename, "description_caption": description_caption, "download_url": renditions.main.href || renditions.nitf.href, "associations": associations, "priced": renditions.main.priced, "pricetag": renditions.main.pricetag}'
 
-AP_ASSOCIATIONS_JMESPATH_STR = 'data.item.{"type": type, "source_id": altids.itemid, "url": uri, "headline": headline, "bylines": bylines, "firstcreated": firstcreated, "versioncreated": versioncreated, "originalfilename": renditions.main.originalfilename, "description_caption": description_caption, "download_url": renditions.main.href}'
+AP_ASSOCIATIONS_JMESPATH_STR = 'data.item.{"type": type, "source_id": altids.itemid, "url": uri, "headline": headline, "bylines": bylines, "firstcreated": firstcreated, "versioncreated": versioncreated, "urgency": urgency, "editorialpriority": editorialpriority, "originalfilename": renditions.main.originalfilename, "description_caption": description_caption, "download_url": renditions.main.href}'
+
+# the item fields the two projections above read, requested from AP with the include parameter so the feed leaves out
+# the rest of each item's metadata. see apps/associated_press/feed_query.py
+AP_FEED_INCLUDE_FIELDS = [
+    "type",
+    "altids.itemid",
+    "uri",
+    "headline",
+    "bylines",
+    "firstcreated",
+    "versioncreated",
+    "urgency",
+    "editorialpriority",
+    "description_caption",
+    "associations",
+    "renditions.main",
+    "renditions.nitf",
+]
+
+# the only item types the ingest converts, videos and the rest cost too much or have no converter
+AP_FEED_TYPES = ["text", "picture"]
 
 DRAFT_API_URL = "https://api.{org}.arcpublishing.com/draft/v1/story"
 
@@ -12,6 +33,14 @@ PHOTO_API_URL = "https://api.{org}.arcpublishing.com/photo/api/v2/photos/{arc_id
 
 MIGRATION_CENTER_ANS_URL = "https://api.{org}.arcpublishing.com/migrations/v3/content/ans"
 
+# Migration Center calls allowed per RATE_LIMIT_PERIOD seconds, for each lane
+STORY_RATE_LIMIT_CALLS = 2
+PHOTO_RATE_LIMIT_CALLS = 5
+RATE_LIMIT_PERIOD = 60
+
+# days after import that wire content is deleted from arc by its scheduled operation
+EXPIRATION_DAYS = 3
+
 # This example inbound wires adapter is not using the Draft API PUBLISH endpoint, following the best practice of
 # importing wire content as unpublished only.  Wire content would then be selected by the newsroom and published
 # as needed. This conserves the Draft API rate limit and protects from unnecessary calls to the Draft API publish endpoint.
\ No newline at end of file
@@ -21,3 +21,15 @@ class WireExistsInArcException(Exception):
     ):
         self.message = message
         super().__init__(self.message)
+
+
+class CircuitOpenException(Exception):
+    def __init__(self, message="Migration Center circuit breaker is open, wire was not sent"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class ProfilerActiveException(Exception):
+    def __init__(self, message="A profiler is already running, only one can profile the ingest at a time"):
+        self.message = message
+        super().__init__(self.message)
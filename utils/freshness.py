@@ -0,0 +1,64 @@
+import argparse
+import json
+import math
+import time
+from collections import defaultdict
+
+from decouple import config
+
+from utils import inventory
+
+# the stages an item passes through on its way into arc, in order. the times are stored in ap_feed_freshness.
+STAGES = ["feed_seen", "fetched", "queued", "converted", "sent", "inventoried"]
+PERCENTILES = [50, 95, 99]
+
+
+def percentiles(values: list):
+    """nearest rank percentiles of the values"""
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return {f"p{p}": None for p in PERCENTILES}
+    return {f"p{p}": values[max(math.ceil(p / 100 * len(values)) - 1, 0)] for p in PERCENTILES}
+
+
+def lag(end, start):
+    return end - start if end is not None and start is not None else None
+
+
+def freshness_report(conn, hours: float = 24, arc_type: str = None):
+    """percentiles per arc type of the seconds between ap publishing an item and the item landing in arc.
+    publish_lag is measured from ap firstcreated and version_lag from the versioncreated of the version that was sent.
+    stages breaks the version lag down into the seconds spent reaching each stage from the one before it."""
+    rows = inventory.select_freshness(conn, since=time.time() - hours * 60 * 60, arc_type=arc_type)
+    columns = ["source_id", "version", "arc_type", "firstcreated", "versioncreated"] + STAGES
+    grouped = defaultdict(list)
+    for row in rows:
+        record = dict(zip(columns, row))
+        grouped[record["arc_type"]].append(record)
+
+    report = {}
+    for group, records in sorted(grouped.items()):
+        stages = {}
+        previous = "versioncreated"
+        for stage in STAGES:
+            stages[stage] = percentiles([lag(r[stage], r[previous]) for r in records])
+            previous = stage
+        report[group] = {
+            "count": len(records),
+            "publish_lag": percentiles([lag(r["inventoried"], r["firstcreated"]) for r in records]),
+            "version_lag": percentiles([lag(r["inventoried"], r["versioncreated"]) for r in records]),
+            "stages": stages,
+        }
+    return report
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description="Report how long AP items took to land in Arc")
+    parser.add_argument("--hours", type=float, default=24, help="report on items inventoried in the last N hours")
+    parser.add_argument("--type", dest="arc_type", default=None, help="only report on one arc type, story or image")
+    args = parser.parse_args()
+
+    conn = inventory.create_connection(config("SQLDB_LOCATION", ":memory:"))
+    inventory.create_table(conn)
+    print(json.dumps(freshness_report(conn, args.hours, args.arc_type), indent=2))
+    conn.close()
@@ -1,17 +1,35 @@
+import base64
+import json
 import sqlite3
+import time
+from datetime import datetime, timezone
 from sqlite3 import Error
 
-import arrow
 from decouple import config
+
+from utils.lazy import lazy_module
 from utils.logger import get_logger
 
+arrow = lazy_module("arrow")
+
 logger = get_logger()
 
+# the inventory of the items sent into arc, see create_table. ap_feed_inventory is the table it replaced, which is only
+# still there in a database whose rows have not all been migrated yet, see utils/inventory_migration.py
+INVENTORY_TABLE = "ap_inventory"
+LEGACY_INVENTORY_TABLE = "ap_feed_inventory"
+
+
+class InventoryConnection(sqlite3.Connection):
+    # set once the legacy table is found gone, see legacy_inventory_exists. nothing creates it again, so from then on
+    # lookups skip looking for it
+    legacy_inventory_gone = False
+
 
-def create_connection(dbfile: str = ":memory:"):
+def create_connection(dbfile: str = ":memory:", check_same_thread: bool = True):
     conn = None
     try:
-        conn = sqlite3.connect(dbfile)
+        conn = sqlite3.connect(dbfile, factory=InventoryConnection, check_same_thread=check_same_thread)
         logger.info(f"SQLite3 connection created {sqlite3.version} to db {dbfile}")
         return conn
     except Error as e:
@@ -19,60 +37,589 @@ def create_connection(dbfile: str = ":memory:"):
 
 
 def create_table(conn):
-    create_table_sql = """CREATE TABLE IF NOT EXISTS ap_feed_inventory (
-    source_id    STRING   CONSTRAINT source_id_constraint UNIQUE ON CONFLICT REPLACE
-                          NOT NULL,
-    arc_id       STRING   CONSTRAINT arc_id_constraint UNIQUE ON CONFLICT FAIL
-                          NOT NULL,
+    # source_id, arc_id and sha1 are stored as the bytes their hex or base32 spells, see pack_hex and pack_arc_id, and
+    # updated_at as epoch seconds. keyed on source_id without a rowid, so a row is stored once, in the primary key's tree
+    create_table_sql = """CREATE TABLE IF NOT EXISTS ap_inventory (
+    source_id  BLOB    NOT NULL PRIMARY KEY,
+    arc_id     BLOB    NOT NULL,
+    ap_url     TEXT,
+    arc_type   TEXT    NOT NULL,
+    sha1       BLOB,
+    updated_at INTEGER NOT NULL
+) WITHOUT ROWID; """
+    create_arc_id_index_sql = """CREATE UNIQUE INDEX IF NOT EXISTS ap_inventory_arc_id ON ap_inventory (arc_id);"""
+    # every item sent is looked up by sha1 first, see process_wire_story and process_wire_photo. the index entries carry
+    # the primary key, so the sha1 and updated_at indexes answer their lookups and range scans without the table
+    create_sha1_index_sql = """CREATE INDEX IF NOT EXISTS ap_inventory_sha1 ON ap_inventory (sha1);"""
+    create_updated_index_sql = """CREATE INDEX IF NOT EXISTS ap_inventory_updated_at ON ap_inventory (updated_at);"""
+    # inventory rows moved out by utils/retention.py when AP_INVENTORY_RETENTION_MODE is archive
+    create_history_sql = """CREATE TABLE IF NOT EXISTS ap_feed_inventory_history (
+    source_id    STRING   NOT NULL,
+    arc_id       STRING   NOT NULL,
     ap_url       STRING,
     arc_type     STRING   NOT NULL,
     sha1         STRING,
+    updated_date DATETIME NOT NULL,
+    archived_at  REAL     NOT NULL
+); """
+    # one row per retention pass, to follow the size of the inventory and the speed of its lookups over time
+    create_stats_sql = """CREATE TABLE IF NOT EXISTS ap_inventory_stats (
+    measured_at      REAL    NOT NULL,
+    inventory_rows   INTEGER NOT NULL,
+    freshness_rows   INTEGER NOT NULL,
+    db_bytes         INTEGER NOT NULL,
+    free_bytes       INTEGER NOT NULL,
+    pruned           INTEGER NOT NULL,
+    lookup_p50_us    REAL,
+    lookup_p95_us    REAL
+); """
+    # sidecar to the inventory, one row per version of an item sent into arc, with the epoch seconds it reached each stage
+    create_freshness_sql = """CREATE TABLE IF NOT EXISTS ap_feed_freshness (
+    source_id      STRING   NOT NULL,
+    version        STRING   NOT NULL,
+    arc_type       STRING   NOT NULL,
+    firstcreated   REAL,
+    versioncreated REAL,
+    feed_seen      REAL,
+    fetched        REAL,
+    queued         REAL,
+    converted      REAL,
+    sent           REAL,
+    inventoried    REAL,
+    PRIMARY KEY (source_id, version) ON CONFLICT REPLACE
+); """
+    create_freshness_index_sql = (
+        """CREATE INDEX IF NOT EXISTS ap_feed_freshness_inventoried ON ap_feed_freshness (inventoried);"""
+    )
+    # images relayed into the staging store, one row for each arc image using the staged object
+    create_staged_sql = """CREATE TABLE IF NOT EXISTS ap_staged_images (
+    key        STRING   NOT NULL,
+    arc_id     STRING   NOT NULL,
+    source_id  STRING,
+    size       INTEGER,
+    staged_at  REAL     NOT NULL,
+    attempts   INTEGER  NOT NULL DEFAULT 0,
+    next_check REAL     NOT NULL,
+    PRIMARY KEY (key, arc_id) ON CONFLICT IGNORE
+); """
+    create_staged_index_sql = (
+        """CREATE INDEX IF NOT EXISTS ap_staged_images_next_check ON ap_staged_images (next_check);"""
+    )
+    # the next_page cursor of each named feed subscription, so a restarted poller continues each feed where it left off
+    create_cursors_sql = """CREATE TABLE IF NOT EXISTS ap_feed_cursors (
+    feed         STRING   PRIMARY KEY ON CONFLICT REPLACE,
+    next_page    STRING,
     updated_date DATETIME NOT NULL
 ); """
+    # feed items offered to the ingest workers sharing this database, see apps/associated_press/worker.py.
+    # a worker owns an item until expires_at, and keeps extending it while it works on the item
+    create_leases_sql = """CREATE TABLE IF NOT EXISTS ap_leases (
+    source_id  TEXT     NOT NULL,
+    version    TEXT     NOT NULL,
+    item       TEXT     NOT NULL,
+    offered_at REAL     NOT NULL,
+    worker     TEXT,
+    claimed_at REAL,
+    expires_at REAL     NOT NULL DEFAULT 0,
+    attempts   INTEGER  NOT NULL DEFAULT 0,
+    done_at    REAL,
+    PRIMARY KEY (source_id, version) ON CONFLICT IGNORE
+); """
+    create_leases_index_sql = (
+        """CREATE INDEX IF NOT EXISTS ap_leases_open ON ap_leases (offered_at) WHERE done_at IS NULL;"""
+    )
     try:
         c = conn.cursor()
+        # lets utils/retention.py return pruned pages a few at a time, only takes effect on a new database
+        c.execute("PRAGMA auto_vacuum = INCREMENTAL;")
         c.execute(create_table_sql)
+        c.execute(create_arc_id_index_sql)
+        c.execute(create_sha1_index_sql)
+        c.execute(create_updated_index_sql)
+        c.execute(create_history_sql)
+        c.execute(create_stats_sql)
+        c.execute(create_freshness_sql)
+        c.execute(create_freshness_index_sql)
+        c.execute(create_staged_sql)
+        c.execute(create_staged_index_sql)
+        c.execute(create_cursors_sql)
+        c.execute(create_leases_sql)
+        c.execute(create_leases_index_sql)
     except Error as e:
         logger.error(e)
 
 
-def create_inventory(conn, inventory):
-    sql = """ INSERT INTO ap_feed_inventory(source_id, arc_id, ap_url, arc_type, sha1, updated_date) 
-              VALUES (?, ?, ?, ?, ?, ?) """
+def pack_hex(value):
+    """a hex digest or ap source id as the bytes it spells. anything that would not read back exactly the same,
+    such as upper case hex or an id that is not hex at all, is stored as it is"""
+    if isinstance(value, str) and value and len(value) % 2 == 0:
+        try:
+            packed = bytes.fromhex(value)
+        except ValueError:
+            return value
+        if packed.hex() == value:
+            return packed
+    return value
+
+
+def unpack_hex(value):
+    return value.hex() if isinstance(value, bytes) else value
+
+
+BASE32 = "ABCDEFGHIJKLMNOPQRSTUVWXYZ234567"
+# int() reads base 32 spelled with the digits 0-9 and a-v, a good deal quicker than base64.b32decode
+BASE32_TO_DIGITS = str.maketrans(BASE32, "0123456789abcdefghijklmnopqrstuv")
+
+
+def pack_arc_id(value):
+    """an arc id, 26 characters of base32, as the 16 bytes it spells, anything else as it is"""
+    if isinstance(value, str) and len(value) == 26 and not value.strip(BASE32):
+        number = int(value.translate(BASE32_TO_DIGITS), 32)
+        # 26 characters hold 130 bits, the last 2 are 0 when the id is 16 bytes
+        if not number & 3:
+            return (number >> 2).to_bytes(16, "big")
+    return value
 
+
+def unpack_arc_id(value):
+    return base64.b32encode(value).decode()[:26] if isinstance(value, bytes) else value
+
+
+def epoch(value):
+    """integer epoch seconds of a time given as epoch seconds, or as a legacy updated_date. those were formatted with
+    arrow's "YYYY-MM-DD HH:MM:SS.SSS", where MM is the month and SS hundredths of a second, so only their date and
+    hour can be read back"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    for length, date_format in [(13, "%Y-%m-%d %H"), (10, "%Y-%m-%d")]:
+        try:
+            return int(datetime.strptime(str(value)[:length], date_format).replace(tzinfo=timezone.utc).timestamp())
+        except ValueError:
+            continue
+    return 0
+
+
+def pack_inventory(inventory):
+    """an inventory row (source_id, arc_id, ap_url, arc_type, sha1, updated) as it is stored"""
+    source_id, arc_id, ap_url, arc_type, sha1, updated = inventory
+    return pack_hex(source_id), pack_arc_id(arc_id), ap_url, arc_type, pack_hex(sha1), epoch(updated)
+
+
+def unpack_inventory(row):
+    source_id, arc_id, ap_url, arc_type, sha1, updated_at = row
+    return unpack_hex(source_id), unpack_arc_id(arc_id), ap_url, arc_type, unpack_hex(sha1), updated_at
+
+
+def legacy_inventory_exists(conn):
+    """whether the database still has rows in the legacy ap_feed_inventory table to migrate"""
+    if isinstance(conn, InventoryConnection) and conn.legacy_inventory_gone:
+        return False
+    sql = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ap_feed_inventory';"
+    exists = conn.execute(sql).fetchone() is not None
+    if not exists and isinstance(conn, InventoryConnection):
+        conn.legacy_inventory_gone = True
+    return exists
+
+
+def create_inventory(conn, inventory):
+    """record an item sent into arc, as (source_id, arc_id, ap_url, arc_type, sha1, updated), where updated is epoch
+    seconds. a source_id already in the inventory is replaced"""
+    sql = """ INSERT INTO ap_inventory(source_id, arc_id, ap_url, arc_type, sha1, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+              ON CONFLICT (source_id) DO UPDATE SET arc_id = excluded.arc_id, ap_url = excluded.ap_url,
+              arc_type = excluded.arc_type, sha1 = excluded.sha1, updated_at = excluded.updated_at """
+    row = pack_inventory(inventory)
     cursor = conn.cursor()
     try:
-        cursor.execute(sql, inventory)
+        cursor.execute(sql, row)
     except Exception as e:
-        # sqlite3.IntegrityError: UNIQUE constraint failed: ap_feed_inventory.arc_id
-        sql = """ UPDATE ap_feed_inventory SET ap_url = ?, sha1 = ?, updated_date = ? WHERE source_id = ? """
-        cursor.execute(sql, (inventory[2], inventory[4], inventory[5], inventory[0]))
+        # sqlite3.IntegrityError: UNIQUE constraint failed: ap_inventory.arc_id
+        sql = """ UPDATE ap_inventory SET ap_url = ?, sha1 = ?, updated_at = ? WHERE source_id = ? """
+        cursor.execute(sql, (row[2], row[4], row[5], row[0]))
+    if legacy_inventory_exists(conn):
+        # the row replaces any the legacy table still has for the item, so an old sha1 is not found there
+        cursor.execute("DELETE FROM ap_feed_inventory WHERE source_id = ?", (inventory[0],))
     conn.commit()
     return cursor.lastrowid
 
 
+def create_inventory_batch(conn, inventories):
+    """record many items at once, in one transaction. unlike create_inventory, an arc_id that another source_id
+    already has fails the whole batch"""
+    sql = """ INSERT INTO ap_inventory(source_id, arc_id, ap_url, arc_type, sha1, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+              ON CONFLICT (source_id) DO UPDATE SET arc_id = excluded.arc_id, ap_url = excluded.ap_url,
+              arc_type = excluded.arc_type, sha1 = excluded.sha1, updated_at = excluded.updated_at """
+    cursor = conn.cursor()
+    with conn:
+        cursor.executemany(sql, (pack_inventory(inventory) for inventory in inventories))
+    return cursor.rowcount
+
+
 def update_inventory(conn, inventory):
-    sql = """ UPDATE ap_feed_inventory SET ap_url = ?, sha1 = ?, updated_date = ? WHERE source_id = ? """
+    """update an item's (ap_url, sha1, updated, source_id)"""
+    sql = """ UPDATE ap_inventory SET ap_url = ?, sha1 = ?, updated_at = ? WHERE source_id = ? """
+    ap_url, sha1, updated, source_id = inventory
     cursor = conn.cursor()
-    cursor.execute(sql, inventory)
+    cursor.execute(sql, (ap_url, pack_hex(sha1), epoch(updated), pack_hex(source_id)))
     conn.commit()
     return cursor.lastrowid
 
 
+def delete_inventory(conn, source_ids):
+    sql = "DELETE FROM ap_inventory WHERE source_id = ?;"
+    cursor = conn.cursor()
+    with conn:
+        cursor.executemany(sql, ((pack_hex(source_id),) for source_id in source_ids))
+    return cursor.rowcount
+
+
+def create_freshness(conn, freshness):
+    sql = """ INSERT INTO ap_feed_freshness(source_id, version, arc_type, firstcreated, versioncreated,
+              feed_seen, fetched, queued, converted, sent, inventoried)
+              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) """
+    cursor = conn.cursor()
+    cursor.execute(sql, freshness)
+    conn.commit()
+    return cursor.lastrowid
+
+
+def select_freshness(conn, since: float = 0, arc_type: str = None):
+    sql = """SELECT source_id, version, arc_type, firstcreated, versioncreated, feed_seen, fetched, queued, converted, sent,
+             inventoried FROM ap_feed_freshness WHERE inventoried >= ?"""
+    params = [since]
+    if arc_type:
+        sql += " AND arc_type = ?"
+        params.append(arc_type)
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
+def create_staged_images(conn, staged_images):
+    sql = """ INSERT INTO ap_staged_images(key, arc_id, source_id, size, staged_at, next_check) VALUES (?, ?, ?, ?, ?, ?) """
+    cursor = conn.cursor()
+    cursor.executemany(sql, staged_images)
+    conn.commit()
+    return cursor.rowcount
+
+
+def select_staged_images_due(conn, now: float, limit: int):
+    sql = """SELECT key, arc_id, attempts FROM ap_staged_images WHERE next_check <= ? ORDER BY next_check LIMIT ?;"""
+    cursor = conn.cursor()
+    cursor.execute(sql, (now, limit))
+    return cursor.fetchall()
+
+
+def update_staged_images_check(conn, checks):
+    """checks are (attempts, next_check, key, arc_id)"""
+    sql = """UPDATE ap_staged_images SET attempts = ?, next_check = ? WHERE key = ? AND arc_id = ?;"""
+    cursor = conn.cursor()
+    cursor.executemany(sql, checks)
+    conn.commit()
+
+
+def delete_staged_images(conn, staged_images):
+    """staged_images are (key, arc_id)"""
+    sql = """DELETE FROM ap_staged_images WHERE key = ? AND arc_id = ?;"""
+    cursor = conn.cursor()
+    cursor.executemany(sql, staged_images)
+    conn.commit()
+
+
+def delete_staged_keys(conn, keys):
+    sql = """DELETE FROM ap_staged_images WHERE key = ?;"""
+    cursor = conn.cursor()
+    cursor.executemany(sql, [(key,) for key in keys])
+    conn.commit()
+
+
+def select_staged_keys(conn, keys=None):
+    """each staged object as (key, size, first staged_at), oldest first, limited to the given keys when there are any"""
+    sql = "SELECT key, MAX(size), MIN(staged_at) FROM ap_staged_images"
+    params = []
+    if keys is not None:
+        keys = list(keys)
+        if not keys:
+            return []
+        sql += f" WHERE key IN ({', '.join('?' for _ in keys)})"
+        params = keys
+    sql += " GROUP BY key ORDER BY MIN(staged_at);"
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
+def select_feed_cursor(conn, feed: str):
+    sql = "SELECT next_page FROM ap_feed_cursors WHERE feed = ?;"
+    cursor = conn.cursor()
+    cursor.execute(sql, (feed,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def update_feed_cursors(conn, cursors):
+    """cursors are (feed, next_page)"""
+    sql = """INSERT INTO ap_feed_cursors(feed, next_page, updated_date) VALUES (?, ?, ?);"""
+    now = arrow.utcnow().format("YYYY-MM-DD HH:mm:ss.SSS")
+    cursor = conn.cursor()
+    cursor.executemany(sql, [(feed, next_page, now) for feed, next_page in cursors])
+    conn.commit()
+
+
+def advance_feed_cursor(conn, feed: str, previous: str, next_page: str):
+    """move a feed's cursor from previous to next_page, unless another worker sharing the database moved it first.
+    returns True when this call moved it"""
+    now = arrow.utcnow().format("YYYY-MM-DD HH:mm:ss.SSS")
+    with conn:
+        cursor = conn.execute(
+            "UPDATE ap_feed_cursors SET next_page = ?, updated_date = ? WHERE feed = ? AND next_page IS ?;",
+            (next_page, now, feed, previous),
+        )
+        if cursor.rowcount == 0 and previous is None:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO ap_feed_cursors(feed, next_page, updated_date) VALUES (?, ?, ?);",
+                (feed, next_page, now),
+            )
+    return cursor.rowcount > 0
+
+
+def share_connection(conn, busy_timeout: float = 30):
+    """set up a connection to a database file several processes write to. in wal mode readers do not block the
+    writer, and a writer waits up to busy_timeout seconds for the lock instead of failing with database is locked"""
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)};")
+    return conn
+
+
+def offer_leases(conn, items: list, now: float):
+    """offer feed items to the workers, a version already offered is ignored. returns the number newly offered"""
+    sql = """INSERT INTO ap_leases(source_id, version, item, offered_at) VALUES (?, ?, ?, ?);"""
+    rows = [(item.get("source_id"), item.get("versioncreated") or "", json.dumps(item), now) for item in items]
+    cursor = conn.cursor()
+    with conn:
+        cursor.executemany(sql, rows)
+    return cursor.rowcount
+
+
+def claim_leases(conn, worker: str, limit: int, ttl: float, now: float, max_attempts: int = 3):
+    """claim at most limit open items for the worker, for ttl seconds. an item is open when it was never claimed, or when
+    the lease of the worker that claimed it expired, in which case it is stolen. an item is not claimed while another
+    worker holds a lease on another version of it, so two workers never send the same source_id at once.
+    returns (source_id, version, item, previous worker) for each item claimed"""
+    select_sql = """SELECT l.source_id, l.version, l.item, l.worker FROM ap_leases l
+                    WHERE l.done_at IS NULL AND l.attempts < ? AND (l.worker IS NULL OR l.expires_at < ?)
+                    AND NOT EXISTS (
+                        SELECT 1 FROM ap_leases o WHERE o.source_id = l.source_id AND o.version != l.version
+                        AND o.done_at IS NULL AND o.worker IS NOT NULL AND o.worker != ? AND o.expires_at >= ?)
+                    ORDER BY l.offered_at LIMIT ?;"""
+    update_sql = """UPDATE ap_leases SET worker = ?, claimed_at = ?, expires_at = ?, attempts = attempts + 1
+                    WHERE source_id = ? AND version = ?;"""
+    # the write lock is taken before the select, so two workers cannot claim the same rows
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        rows = conn.execute(select_sql, (max_attempts, now, worker, now, limit)).fetchall()
+        conn.executemany(
+            update_sql, [(worker, now, now + ttl, source_id, version) for source_id, version, _, _ in rows]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return [(source_id, version, json.loads(item), previous) for source_id, version, item, previous in rows]
+
+
+def heartbeat_leases(conn, worker: str, expires_at: float):
+    """extend every open lease the worker holds. returns the number extended, fewer than held means some were stolen"""
+    sql = """UPDATE ap_leases SET expires_at = ? WHERE worker = ? AND done_at IS NULL;"""
+    cursor = conn.cursor()
+    with conn:
+        cursor.execute(sql, (expires_at, worker))
+    return cursor.rowcount
+
+
+def complete_leases(conn, worker: str, keys: list, now: float):
+    """keys are (source_id, version). only the leases the worker still holds are completed"""
+    sql = """UPDATE ap_leases SET done_at = ? WHERE source_id = ? AND version = ? AND worker = ?;"""
+    cursor = conn.cursor()
+    with conn:
+        cursor.executemany(sql, [(now, source_id, version, worker) for source_id, version in keys])
+    return cursor.rowcount
+
+
+def release_leases(conn, worker: str, keys: list):
+    """give unfinished items back, so another worker can claim them straight away"""
+    sql = """UPDATE ap_leases SET worker = NULL, expires_at = 0 WHERE source_id = ? AND version = ? AND worker = ?
+             AND done_at IS NULL;"""
+    cursor = conn.cursor()
+    with conn:
+        cursor.executemany(sql, [(source_id, version, worker) for source_id, version in keys])
+    return cursor.rowcount
+
+
+def expire_leases(conn, now: float):
+    """open the leases of workers that stopped heartbeating. returns (source_id, version, worker) for each one"""
+    select_sql = """SELECT source_id, version, worker FROM ap_leases
+                    WHERE done_at IS NULL AND worker IS NOT NULL AND expires_at < ?;"""
+    update_sql = (
+        """UPDATE ap_leases SET worker = NULL WHERE done_at IS NULL AND worker IS NOT NULL AND expires_at < ?;"""
+    )
+    with conn:
+        expired = conn.execute(select_sql, (now,)).fetchall()
+        conn.execute(update_sql, (now,))
+    return expired
+
+
+def prune_leases(conn, before: float, limit: int):
+    """remove at most limit leases completed before the epoch seconds given. returns the number removed"""
+    sql = """DELETE FROM ap_leases WHERE rowid IN (SELECT rowid FROM ap_leases WHERE done_at < ? LIMIT ?);"""
+    cursor = conn.cursor()
+    with conn:
+        cursor.execute(sql, (before, limit))
+    return cursor.rowcount
+
+
+def prune_inventory(conn, before: float, limit: int, archive: bool = False):
+    """remove at most limit inventory rows last updated before the epoch seconds given, copying them into
+    ap_feed_inventory_history first when archive is set. returns the number of rows removed"""
+    select_sql = """SELECT source_id, arc_id, ap_url, arc_type, sha1, updated_at FROM ap_inventory
+                    WHERE updated_at < ? LIMIT ?"""
+    cursor = conn.cursor()
+    rows = cursor.execute(select_sql, (before, limit)).fetchall()
+    if not rows:
+        return 0
+    with conn:
+        if archive:
+            # the history keeps the text columns the inventory always had, with a sortable updated_date
+            archived_at = time.time()
+            cursor.executemany(
+                """INSERT INTO ap_feed_inventory_history(source_id, arc_id, ap_url, arc_type, sha1, updated_date, archived_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                [
+                    (
+                        *unpack_inventory(row)[:5],
+                        time.strftime("%Y-%m-%d %H:%M:%S.000", time.gmtime(row[5])),
+                        archived_at,
+                    )
+                    for row in rows
+                ],
+            )
+        cursor.executemany("DELETE FROM ap_inventory WHERE source_id = ?", [(row[0],) for row in rows])
+    return len(rows)
+
+
+def prune_freshness(conn, before: float, limit: int):
+    """remove at most limit freshness rows inventoried before the epoch seconds given. returns the number removed"""
+    sql = """DELETE FROM ap_feed_freshness WHERE rowid IN
+             (SELECT rowid FROM ap_feed_freshness WHERE inventoried < ? LIMIT ?);"""
+    cursor = conn.cursor()
+    with conn:
+        cursor.execute(sql, (before, limit))
+    return cursor.rowcount
+
+
+def select_inventory_sha1_sample(conn, size: int):
+    sql = "SELECT sha1 FROM ap_inventory WHERE sha1 IS NOT NULL ORDER BY random() LIMIT ?;"
+    cursor = conn.cursor()
+    cursor.execute(sql, (size,))
+    return [unpack_hex(row[0]) for row in cursor.fetchall()]
+
+
+def select_inventory_count(conn):
+    """the rows in the inventory, counting those of the legacy table not migrated yet"""
+    count = conn.execute("SELECT COUNT(*) FROM ap_inventory;").fetchone()[0]
+    if legacy_inventory_exists(conn):
+        count += conn.execute("SELECT COUNT(*) FROM ap_feed_inventory;").fetchone()[0]
+    return count
+
+
+def create_inventory_stats(conn, stats):
+    sql = """ INSERT INTO ap_inventory_stats(measured_at, inventory_rows, freshness_rows, db_bytes, free_bytes, pruned,
+              lookup_p50_us, lookup_p95_us) VALUES (?, ?, ?, ?, ?, ?, ?, ?) """
+    cursor = conn.cursor()
+    cursor.execute(sql, stats)
+    conn.commit()
+
+
+def select_inventory_stats(conn, since: float = 0):
+    sql = """SELECT measured_at, inventory_rows, freshness_rows, db_bytes, free_bytes, pruned, lookup_p50_us, lookup_p95_us
+             FROM ap_inventory_stats WHERE measured_at >= ? ORDER BY measured_at;"""
+    cursor = conn.cursor()
+    cursor.execute(sql, (since,))
+    return cursor.fetchall()
+
+
 def select_inventory_by_source(conn, source_id):
-    sql = "SELECT * FROM ap_feed_inventory WHERE source_id = ?;"
+    """the item's inventory rows, as (source_id, arc_id, ap_url, arc_type, sha1, updated_at)"""
+    sql = "SELECT source_id, arc_id, ap_url, arc_type, sha1, updated_at FROM ap_inventory WHERE source_id = ?;"
     cursor = conn.cursor()
-    cursor.execute(sql, (source_id,))
-    rows = cursor.fetchall()
+    cursor.execute(sql, (pack_hex(source_id),))
+    rows = [unpack_inventory(row) for row in cursor.fetchall()]
+    if not rows and legacy_inventory_exists(conn):
+        cursor.execute("SELECT * FROM ap_feed_inventory WHERE source_id = ?;", (source_id,))
+        rows = [(*row[:5], epoch(row[5])) for row in cursor.fetchall()]
     return rows
 
 
+# the columns each order of select_inventory_page sorts on, the last row's values of which are the key of the next page
+INVENTORY_PAGE_KEYS = {"source_id": ["source_id"], "updated_at": ["updated_at", "source_id"]}
+
+
+def select_inventory_page(
+    conn,
+    limit: int,
+    after: tuple = None,
+    order: str = "source_id",
+    arc_type: str = None,
+    since: float = None,
+    until: float = None,
+    sha1: str = None,
+    source_id: str = None,
+):
+    """at most limit inventory rows, as (source_id, arc_id, ap_url, arc_type, sha1, updated_at), sorted on the columns
+    of INVENTORY_PAGE_KEYS[order] and starting after the key given, see inventory_page_key. every page is a seek on the
+    primary key or the updated_at index, however deep into the inventory it starts, where OFFSET would step over every
+    row before it. since and until bound updated_at, as epoch seconds"""
+    keys = INVENTORY_PAGE_KEYS[order]
+    conditions, params = [], []
+    if after is not None:
+        conditions.append(f"({', '.join(keys)}) > ({', '.join('?' for _ in keys)})")
+        params += [pack_hex(value) if key == "source_id" else value for key, value in zip(keys, after)]
+    for condition, value in [
+        ("arc_type = ?", arc_type),
+        ("updated_at >= ?", since),
+        ("updated_at < ?", until),
+        ("sha1 = ?", pack_hex(sha1)),
+        ("source_id = ?", pack_hex(source_id)),
+    ]:
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    sql = f"""SELECT source_id, arc_id, ap_url, arc_type, sha1, updated_at FROM ap_inventory {where}
+              ORDER BY {', '.join(keys)} LIMIT ?;"""
+    cursor = conn.cursor()
+    cursor.execute(sql, [*params, limit])
+    return [unpack_inventory(row) for row in cursor.fetchall()]
+
+
+def inventory_page_key(row, order: str = "source_id"):
+    """the key of a row of select_inventory_page, the next page starts after it"""
+    columns = ["source_id", "arc_id", "ap_url", "arc_type", "sha1", "updated_at"]
+    return tuple(row[columns.index(key)] for key in INVENTORY_PAGE_KEYS[order])
+
+
 def select_inventory_by_sha1(conn, sha1):
-    sql = "SELECT sha1 FROM ap_feed_inventory WHERE sha1 = ?;"
+    sql = "SELECT 1 FROM ap_inventory WHERE sha1 = ? LIMIT 1;"
     cursor = conn.cursor()
-    cursor.execute(sql, (sha1,))
-    rows = cursor.fetchall()
-    return bool(rows)
+    cursor.execute(sql, (pack_hex(sha1),))
+    if cursor.fetchone():
+        return True
+    # until its rows are migrated, an item may only be in the legacy table
+    if legacy_inventory_exists(conn):
+        cursor.execute("SELECT 1 FROM ap_feed_inventory WHERE sha1 = ? LIMIT 1;", (sha1,))
+        return cursor.fetchone() is not None
+    return False
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -95,7 +642,7 @@ if __name__ == "__main__":  # pragma: no cover
             "https://apfeedurl/test1",
             "story",
             "aabbaa5434",
-            arrow.utcnow().format("YYYY-MM-DD HH:MM:SS.SSS"),
+            time.time(),
         )
         item = create_inventory(conn, invenory)
         print(item)
@@ -108,7 +655,7 @@ if __name__ == "__main__":  # pragma: no cover
         sha1_exists = select_inventory_by_sha1(conn, "aabbaa5434")
         print(sha1_exists)
 
-        inventory = ("https://apfeedurl/test2", "54332abbas5", arrow.utcnow().format("YYYY-MM-DD HH:MM:SS.SSS"), "mysourceid1")
+        inventory = ("https://apfeedurl/test2", "54332abbas5", time.time(), "mysourceid1")
         item = update_inventory(conn, inventory)
         print(item)
         rows = select_inventory_by_source(conn, "mysourceid1")
@@ -125,6 +672,6 @@ if __name__ == "__main__":  # pragma: no cover
         #     "",
         #     "",
         #     "",
-        #     arrow.utcnow().format("YYYY-MM-DD HH:MM:SS.SSS"),
+        #     time.time(),
         # )
         # item = create_inventory(conn, invenory)
@@ -0,0 +1,101 @@
+# Moves the rows of the legacy ap_feed_inventory table into the compact ap_inventory table, see create_table in
+# utils/inventory.py, while the ingest keeps running. Until a database's legacy table is gone, new rows go into
+# ap_inventory, lookups that miss there look in the legacy table too, and a row written for an item drops the item's
+# legacy row. Rows are moved in small batches that each commit on their own, and the legacy table is
+# dropped once it is empty. The poller moves a few batches every cycle, or to migrate a database all at once:
+#
+# PYTHONPATH=. python utils/inventory_migration.py --vacuum
+import argparse
+import json
+import time
+
+from decouple import config
+
+from utils import inventory
+from utils.logger import get_logger
+
+logger = get_logger()
+
+
+def text(value):
+    # the legacy columns had numeric affinity, so an id of digits alone came back as a number
+    return str(value) if isinstance(value, (int, float)) else value
+
+
+def migrate_batch(conn, limit: int):
+    """move at most limit legacy rows into ap_inventory, and drop the legacy table once it is empty. returns the number
+    of rows moved, 0 when there is nothing left to move"""
+    if not inventory.legacy_inventory_exists(conn):
+        return 0
+    select_sql = "SELECT rowid, source_id, arc_id, ap_url, arc_type, sha1, updated_date FROM ap_feed_inventory LIMIT ?;"
+    rows = conn.execute(select_sql, (limit,)).fetchall()
+    # a row ap_inventory already has for the item is newer than the legacy one, and an arc id another item already has
+    # in ap_inventory is left out, as the legacy table's unique arc_id would have refused it
+    insert_sql = """INSERT OR IGNORE INTO ap_inventory(source_id, arc_id, ap_url, arc_type, sha1, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?);"""
+    with conn:
+        if not rows:
+            conn.execute("DROP TABLE ap_feed_inventory;")
+            return 0
+        conn.executemany(insert_sql, [inventory.pack_inventory((*map(text, row[1:6]), row[6])) for row in rows])
+        conn.executemany("DELETE FROM ap_feed_inventory WHERE rowid = ?;", [(row[0],) for row in rows])
+    return len(rows)
+
+
+class InventoryMigration:
+    def __init__(self, batch_size: int = 1000, max_batches: int = 10, pause: float = 0.01):
+        """max_batches is how many batches one run moves at most, None to move every row"""
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.pause = pause
+        self.migrated = 0
+
+    def run(self, conn):
+        """move up to max_batches batches, pausing between them so the ingest gets the database. returns the rows
+        moved"""
+        if not inventory.legacy_inventory_exists(conn):
+            return 0
+        started = time.monotonic()
+        moved = batches = 0
+        while self.max_batches is None or batches < self.max_batches:
+            count = migrate_batch(conn, self.batch_size)
+            moved += count
+            batches += 1
+            if count == 0:
+                break
+            time.sleep(self.pause)
+        self.migrated += moved
+        done = not inventory.legacy_inventory_exists(conn)
+        logger.info(
+            "Inventory migration" + (" complete" if done else ""),
+            extra={"moved": moved, "total_moved": self.migrated, "done": done, "seconds": time.monotonic() - started},
+        )
+        return moved
+
+
+def migration_from_config():
+    return InventoryMigration(
+        batch_size=config("AP_INVENTORY_MIGRATION_BATCH", default=1000, cast=int),
+        max_batches=config("AP_INVENTORY_MIGRATION_BATCHES", default=10, cast=int),
+    )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description="Move the legacy inventory rows into the compact inventory table")
+    parser.add_argument("--batch", type=int, default=1000, help="rows moved per transaction")
+    parser.add_argument("--vacuum", action="store_true", help="vacuum once done, giving the freed pages back")
+    args = parser.parse_args()
+
+    db = inventory.create_connection(config("SQLDB_LOCATION", ":memory:"))
+    inventory.create_table(db)
+    before = db.execute("PRAGMA page_count;").fetchone()[0] * db.execute("PRAGMA page_size;").fetchone()[0]
+    InventoryMigration(args.batch, max_batches=None, pause=0).run(db)
+    if args.vacuum:
+        db.execute("VACUUM;")
+    after = db.execute("PRAGMA page_count;").fetchone()[0] * db.execute("PRAGMA page_size;").fetchone()[0]
+    print(
+        json.dumps(
+            {"rows": inventory.select_inventory_count(db), "db_bytes_before": before, "db_bytes_after": after}, indent=2
+        )
+    )
+    db.close()
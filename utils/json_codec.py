@@ -0,0 +1,82 @@
+# JSON encoding on the hot path: the story xml round trip, the Migration Center payload, the block cache and the logs.
+# orjson is used when it is installed, and AP_JSON_BACKEND=stdlib turns it off. The sha1 of an item and its arc ids
+# are always encoded by the standard library, exactly as they always were, because the inventory dedupe and every id
+# already in arc depend on each byte of that output.
+import json
+import traceback
+import types
+import warnings
+
+from decouple import config
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+AUTO = "auto"
+ORJSON = "orjson"
+STDLIB = "stdlib"
+
+# json.dumps with its defaults, how get_sha1 has always encoded an item
+_HASH_ENCODER = json.JSONEncoder()
+# sorted and compact, how generate_arc_id has always encoded its factors
+_ID_ENCODER = json.JSONEncoder(sort_keys=True, separators=(",", ":"))
+# what requests.post(json=...) refused, it refused NaN too
+_COMPACT_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), allow_nan=False)
+
+
+def hash_bytes(obj) -> bytes:
+    """the bytes an item's sha1 is computed over, identical to json.dumps(obj).encode() whatever the backend"""
+    return _HASH_ENCODER.encode(obj).encode("utf-8")
+
+
+def id_bytes(obj) -> bytes:
+    """the bytes an arc id is computed over, identical to
+    json.dumps(obj, sort_keys=1, separators=(",", ":")).encode()"""
+    return _ID_ENCODER.encode(obj).encode("utf-8")
+
+
+def log_default(obj):
+    """what python-json-logger's JsonEncoder does with the values json cannot encode"""
+    if isinstance(obj, types.TracebackType):
+        return "".join(traceback.format_tb(obj)).strip()
+    return str(obj)
+
+
+class JsonCodec:
+    def __init__(self, backend: str = AUTO):
+        if backend not in (AUTO, ORJSON, STDLIB):
+            raise ValueError(f"unknown json backend {backend!r}, expected {AUTO}, {ORJSON} or {STDLIB}")
+        if backend == ORJSON and orjson is None:
+            warnings.warn("orjson is not installed, falling back to the stdlib json backend")
+            backend = STDLIB
+        if backend == AUTO:
+            backend = ORJSON if orjson is not None else STDLIB
+        self.backend = backend
+
+    def dumps(self, obj) -> bytes:
+        """compact utf-8 json. orjson refuses a few things the stdlib encodes, such as keys that are not strings"""
+        if self.backend == ORJSON:
+            try:
+                return orjson.dumps(obj)
+            except TypeError:
+                pass
+        return _COMPACT_ENCODER.encode(obj).encode("utf-8")
+
+    def loads(self, data):
+        if self.backend == ORJSON:
+            return orjson.loads(data)
+        return json.loads(data)
+
+    def log_serializer(self, record, default=None, cls=None, indent=None, ensure_ascii=True):
+        """a json.dumps compatible serializer for python-json-logger's JsonFormatter"""
+        if self.backend == ORJSON and indent is None:
+            try:
+                return orjson.dumps(record, default=log_default).decode("utf-8")
+            except TypeError:
+                pass
+        return json.dumps(record, default=default, cls=cls, indent=indent, ensure_ascii=ensure_ascii)
+
+
+codec = JsonCodec(config("AP_JSON_BACKEND", default=AUTO))
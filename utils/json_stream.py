@@ -0,0 +1,114 @@
+# Reads one array out of a large JSON document as the document streams in, e.g. the items of an AP feed page, without
+# ever holding the whole document or its parsed form in memory. Each element of the array is decoded on its own and
+# handed to the caller before the next one is read, and a few other values, such as the feed's next_page, are captured
+# along the way. Values that are neither are decoded one at a time and dropped.
+import codecs
+import json
+from typing import Iterable, Iterator, Tuple
+
+_WHITESPACE = " \t\n\r"
+_decoder = json.JSONDecoder()
+
+
+class JsonStream:
+    def __init__(
+        self, chunks: Iterable[bytes], array_path: Tuple[str, ...], capture_paths: Iterable[Tuple[str, ...]] = ()
+    ):
+        self.chunks = iter(chunks)
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.array_path = tuple(array_path)
+        self.capture_paths = {tuple(p) for p in capture_paths}
+        # objects on the way to the array or to a captured value are walked key by key, everything else is decoded whole
+        self.descend = {p[:i] for p in self.capture_paths | {self.array_path} for i in range(len(p))}
+        self.captured = {}
+        # whether the array was in the document at all
+        self.found = False
+        self.bytes = 0
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """read the next chunk into the buffer, dropping what was already consumed. false once the stream is done"""
+        if self.eof:
+            return False
+        self.buf = self.buf[self.pos :]
+        self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.bytes += len(chunk)
+                self.buf += self.text.decode(chunk)
+                return True
+        self.buf += self.text.decode(b"", final=True)
+        self.eof = True
+        return False
+
+    def peek(self):
+        """the next character that is not whitespace, or an empty string at the end of the stream"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, chars: str):
+        c = self.peek()
+        if not c or c not in chars:
+            raise json.JSONDecodeError(f"Expecting one of {chars!r}", self.buf, self.pos)
+        self.pos += 1
+        return c
+
+    def value(self):
+        """decode the value at the current position, reading more of the stream until it is complete. a value that
+        ends exactly at the end of the buffer may continue in the next chunk, a number in particular"""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # read until the buffer has doubled, so a large value is not decoded again after every chunk
+            needed = 2 * max(len(self.buf) - self.pos, 1)
+            while len(self.buf) - self.pos < needed and self.fill():
+                pass
+
+    def walk(self, path: Tuple[str, ...]) -> Iterator:
+        c = self.peek()
+        if c == "{" and path in self.descend:
+            self.pos += 1
+            if self.peek() == "}":
+                self.pos += 1
+                return
+            while True:
+                key = self.value()
+                self.expect(":")
+                yield from self.walk(path + (key,))
+                if self.expect(",}") == "}":
+                    return
+        elif c == "[" and path == self.array_path:
+            self.found = True
+            self.pos += 1
+            if self.peek() == "]":
+                self.pos += 1
+                return
+            while True:
+                yield self.value()
+                if self.expect(",]") == "]":
+                    return
+        else:
+            value = self.value()
+            if path in self.capture_paths:
+                self.captured[path] = value
+
+    def __iter__(self):
+        """the elements of the array, one at a time. captured values are in self.captured once they have been read,
+        all of them once the iteration is done"""
+        yield from self.walk(())
+        if self.peek():
+            raise json.JSONDecodeError("Extra data", self.buf, self.pos)
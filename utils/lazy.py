@@ -0,0 +1,26 @@
+# Modules that are slow to import and not needed by every run, e.g. html2ans and BeautifulSoup, which only story
+# conversion uses. A cron or serverless run pays the import on first use instead of at startup.
+import importlib
+
+
+class LazyModule:
+    """stands in for a module, importing it the first time one of its attributes is used"""
+
+    def __init__(self, name: str):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}{' (loaded)' if self._module is not None else ''}>"
+
+
+def lazy_module(name: str):
+    return LazyModule(name)
@@ -2,10 +2,12 @@ import logging
 
 from pythonjsonlogger import jsonlogger
 
+from utils.json_codec import codec
+
 logger = logging.getLogger()
 
 logHandler = logging.StreamHandler()
-formatter = jsonlogger.JsonFormatter()
+formatter = jsonlogger.JsonFormatter(json_serializer=codec.log_serializer)
 logHandler.setFormatter(formatter)
 logger.addHandler(logHandler)
 logger.setLevel(logging.INFO)
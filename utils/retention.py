@@ -0,0 +1,191 @@
+# Keeps the inventory database from growing forever. Arc deletes wires EXPIRATION_DAYS after they are sent, see
+# get_scheduled_delete_operation, but their inventory and freshness rows were kept, and every sha1 and source_id
+# lookup got slower as the tables grew. Rows past the retention horizon are pruned, or archived, in small batches
+# that each commit on their own, so a pass never holds the database long enough to stall the ingest.
+import argparse
+import json
+import time
+
+from decouple import config
+
+from utils import inventory
+from utils.constants import EXPIRATION_DAYS
+from utils.freshness import percentiles
+from utils.logger import get_logger
+
+logger = get_logger()
+
+ARCHIVE = "archive"
+PRUNE = "prune"
+# PRAGMA auto_vacuum of a database that gives freed pages back with incremental_vacuum
+INCREMENTAL = 2
+
+
+class Retention:
+    def __init__(
+        self,
+        retention_days: float = EXPIRATION_DAYS + 4,
+        mode: str = PRUNE,
+        batch_size: int = 500,
+        max_batches: int = 20,
+        pause: float = 0.01,
+        vacuum_pages: int = 1000,
+        analyze_every: float = 6 * 60 * 60,
+        interval: float = 60 * 60,
+        probes: int = 50,
+        clock=time.time,
+    ):
+        self.retention_days = retention_days
+        self.mode = mode
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+        self.analyze_every = analyze_every
+        self.interval = interval
+        self.probes = probes
+        self.clock = clock
+        self.last_run = None
+        self.last_analyze = None
+        self.warned = False
+
+    def due(self):
+        return self.last_run is None or self.clock() - self.last_run >= self.interval
+
+    def prune(self, conn):
+        """prune at most max_batches batches of each table, pausing between batches so other writers get the database.
+        returns the rows removed, a table with more to prune carries on in the next pass"""
+        now = self.clock()
+        before = now - self.retention_days * 24 * 60 * 60
+        pruned = 0
+        for _ in range(self.max_batches):
+            removed = inventory.prune_inventory(conn, before, self.batch_size, archive=self.mode == ARCHIVE)
+            removed += inventory.prune_freshness(conn, before, self.batch_size)
+            removed += inventory.prune_leases(conn, before, self.batch_size)
+            pruned += removed
+            if removed == 0:
+                break
+            time.sleep(self.pause)
+        return pruned
+
+    def vacuum(self, conn):
+        """give the pages freed by pruning back to the file system, a few at a time. a database created before
+        incremental vacuum was turned on keeps its freed pages for reuse until enable_incremental_vacuum has run on it,
+        a full VACUUM that would stall the poller for as long as it rewrites the file"""
+        if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] != INCREMENTAL and not self.warned:
+            logger.warning(
+                "Inventory database is not set up for incremental vacuum, freed pages are only reused",
+                extra={"fix": "PYTHONPATH=. python utils/retention.py --enable-incremental-vacuum"},
+            )
+            self.warned = True
+        conn.execute(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)});")
+
+    def measure(self, conn, pruned: int = 0):
+        """the size of the inventory and the latency of sha1 lookups, recorded in ap_inventory_stats"""
+        timings = []
+        for sha1 in inventory.select_inventory_sha1_sample(conn, self.probes):
+            started = time.perf_counter()
+            inventory.select_inventory_by_sha1(conn, sha1)
+            timings.append((time.perf_counter() - started) * 1_000_000)
+        latency = percentiles(timings)
+        page_size = conn.execute("PRAGMA page_size;").fetchone()[0]
+        stats = {
+            "measured_at": self.clock(),
+            "inventory_rows": inventory.select_inventory_count(conn),
+            "freshness_rows": conn.execute("SELECT COUNT(*) FROM ap_feed_freshness;").fetchone()[0],
+            "db_bytes": conn.execute("PRAGMA page_count;").fetchone()[0] * page_size,
+            "free_bytes": conn.execute("PRAGMA freelist_count;").fetchone()[0] * page_size,
+            "pruned": pruned,
+            "lookup_p50_us": latency["p50"],
+            "lookup_p95_us": latency["p95"],
+        }
+        inventory.create_inventory_stats(conn, tuple(stats.values()))
+        return stats
+
+    def run(self, conn):
+        """one retention pass: prune, vacuum, analyze when it is due, then measure"""
+        self.last_run = self.clock()
+        started = time.monotonic()
+        pruned = self.prune(conn)
+        self.vacuum(conn)
+        if self.last_analyze is None or self.clock() - self.last_analyze >= self.analyze_every:
+            # refreshes the statistics the query planner uses to pick the sha1 and source_id indexes
+            conn.execute("ANALYZE;")
+            conn.commit()
+            self.last_analyze = self.clock()
+        stats = self.measure(conn, pruned)
+        logger.info(
+            "Inventory retention pass", extra={**stats, "mode": self.mode, "seconds": time.monotonic() - started}
+        )
+        return stats
+
+    def run_if_due(self, conn):
+        return self.run(conn) if self.due() else None
+
+
+def retention_from_config():
+    return Retention(
+        retention_days=config("AP_INVENTORY_RETENTION_DAYS", default=EXPIRATION_DAYS + 4, cast=float),
+        mode=config("AP_INVENTORY_RETENTION_MODE", default=PRUNE),
+        batch_size=config("AP_INVENTORY_RETENTION_BATCH", default=500, cast=int),
+        interval=config("AP_INVENTORY_RETENTION_INTERVAL", default=60 * 60, cast=float),
+    )
+
+
+def enable_incremental_vacuum(conn):
+    """switch a database created before incremental vacuum was turned on, with one full VACUUM that rewrites the file.
+    a one off step to run while the poller is stopped, returns True when the database was switched"""
+    if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] == INCREMENTAL:
+        return False
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+    conn.execute("VACUUM;")
+    return True
+
+
+def retention_report(conn, hours: float = 24 * 7):
+    """the recorded size and lookup latency of the inventory, oldest first, and how they changed over the period"""
+    columns = [
+        "measured_at",
+        "inventory_rows",
+        "freshness_rows",
+        "db_bytes",
+        "free_bytes",
+        "pruned",
+        "lookup_p50_us",
+        "lookup_p95_us",
+    ]
+    rows = [dict(zip(columns, row)) for row in inventory.select_inventory_stats(conn, time.time() - hours * 60 * 60)]
+    report = {"passes": len(rows), "history": rows}
+    if rows:
+        first, last = rows[0], rows[-1]
+        report["change"] = {
+            key: last[key] - first[key] if last[key] is not None and first[key] is not None else None
+            for key in ["inventory_rows", "db_bytes", "lookup_p50_us", "lookup_p95_us"]
+        }
+        report["pruned"] = sum(row["pruned"] for row in rows)
+    return report
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(
+        description="Prune the inventory past its retention horizon, or report on its size"
+    )
+    parser.add_argument("--report", action="store_true", help="only report the recorded size and lookup latency")
+    parser.add_argument("--hours", type=float, default=24 * 7, help="report on the last N hours")
+    parser.add_argument(
+        "--enable-incremental-vacuum",
+        action="store_true",
+        help="switch an older database to incremental vacuum with one full VACUUM, run it while the poller is stopped",
+    )
+    args = parser.parse_args()
+
+    db = inventory.create_connection(config("SQLDB_LOCATION", ":memory:"))
+    inventory.create_table(db)
+    if args.enable_incremental_vacuum:
+        logger.info(
+            "Switched to incremental vacuum" if enable_incremental_vacuum(db) else "Already on incremental vacuum"
+        )
+    if not args.report:
+        retention_from_config().run(db)
+    print(json.dumps(retention_report(db, args.hours), indent=2))
+    db.close()
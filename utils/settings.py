@@ -0,0 +1,70 @@
+# The settings read for every item the ingest fetches, converts and sends, resolved from the environment once per
+# process instead of once per item. A missing required setting fails the run at startup, before any feed request.
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from decouple import Csv, config
+
+from utils.constants import AP_FEED_TYPES
+
+
+@dataclass(frozen=True)
+class Settings:
+    ap_api_key: str
+    ap_query: Optional[str]
+    arc_org_id: str
+    arc_org_website: str
+    arc_website_section: str
+    # ARC_TOKEN_SANDBOX for a sandbox org, otherwise ARC_TOKEN_PRODUCTION. fan-out targets may bring their own
+    arc_token: Optional[str]
+    arc_token_name: str
+    # the filters and projection pushed to the AP feed request, see apps/associated_press/feed_query.py
+    ap_feed_types: Tuple[str, ...]
+    ap_feed_in_my_plan: bool
+    ap_feed_page_size: Optional[int]
+    ap_feed_projection: bool
+    ap_feed_streaming: bool
+    # unfiltered bytes per usable item, as measured by feed_query.py --compare, see estimate_bytes_saved
+    ap_feed_baseline_bytes_per_item: Optional[float]
+    sqldb_location: str
+    image_relay_concurrency: int
+    staging_recheck_seconds: float
+    # AP_PROFILE profiles every run, see apps/associated_press/profiling.py
+    ap_profile: bool
+
+
+def settings_from_config():
+    arc_org_id = config("ARC_ORG_ID")
+    arc_token_name = "ARC_TOKEN_SANDBOX" if "sandbox." in arc_org_id else "ARC_TOKEN_PRODUCTION"
+    return Settings(
+        ap_api_key=config("AP_API_KEY"),
+        ap_query=config("AP_QUERY", None),
+        arc_org_id=arc_org_id,
+        arc_org_website=config("ARC_ORG_WEBSITE"),
+        arc_website_section=config("ARC_WEBSITE_SECTION"),
+        arc_token=config(arc_token_name, default=None),
+        arc_token_name=arc_token_name,
+        ap_feed_types=config("AP_FEED_TYPES", default=",".join(AP_FEED_TYPES), cast=Csv(post_process=tuple)),
+        ap_feed_in_my_plan=config("AP_FEED_IN_MY_PLAN", default=True, cast=bool),
+        ap_feed_page_size=config("AP_FEED_PAGE_SIZE", default=None, cast=lambda v: int(v) if v else None),
+        ap_feed_projection=config("AP_FEED_PROJECTION", default=True, cast=bool),
+        ap_feed_streaming=config("AP_FEED_STREAMING", default=False, cast=bool),
+        ap_feed_baseline_bytes_per_item=config(
+            "AP_FEED_BASELINE_BYTES_PER_ITEM", default=None, cast=lambda v: float(v) if v else None
+        ),
+        sqldb_location=config("SQLDB_LOCATION", ":memory:"),
+        image_relay_concurrency=config("AP_IMAGE_RELAY_CONCURRENCY", default=4, cast=int),
+        staging_recheck_seconds=config("AP_STAGING_RECHECK_SECONDS", default=300, cast=float),
+        ap_profile=config("AP_PROFILE", default=False, cast=bool),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_settings():
+    """the settings of this process, resolved on first use. reset_settings makes the next call read them again"""
+    return settings_from_config()
+
+
+def reset_settings():
+    get_settings.cache_clear()
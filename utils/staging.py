@@ -0,0 +1,109 @@
+# Stores for AP images relayed on their way to Photo Center. Photo Center cannot send the AP x-api-key header when it
+# downloads an image's originalUrl, so images are downloaded here and staged somewhere Photo Center can reach them.
+import os
+import shutil
+import tempfile
+from typing import BinaryIO, Optional
+
+from decouple import config
+
+from utils.logger import get_logger
+
+logger = get_logger()
+
+
+class LocalStagingStore:
+    """stages images in a local directory, served to Photo Center from base_url by a web server you run in front of
+    it"""
+
+    def __init__(self, directory: str, base_url: str):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str):
+        return os.path.join(self.directory, key)
+
+    def exists(self, key: str):
+        return os.path.exists(self.path(key))
+
+    def put(self, key: str, fileobj: BinaryIO, content_type: Optional[str] = None):
+        # write next to the final location and rename, so a half written image is never served
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as tmp:
+            shutil.copyfileobj(fileobj, tmp)
+        os.replace(tmp.name, self.path(key))
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def url(self, key: str):
+        return f"{self.base_url}/{key}"
+
+
+class S3StagingStore:
+    """stages images in an S3 bucket, or any service with an S3 compatible api found at endpoint_url.
+    boto3 is only needed when this store is used, and is not in requirements.txt."""
+
+    def __init__(self, bucket: str, endpoint_url: str = None, base_url: str = None, prefix: str = "", client=None):
+        if client is None:
+            try:
+                import boto3
+            except ImportError as e:
+                raise ImportError("boto3 is required to stage images in S3, pip install boto3") from e
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        endpoint = (endpoint_url or f"https://{bucket}.s3.amazonaws.com").rstrip("/")
+        self.base_url = (base_url or (f"{endpoint}/{bucket}" if endpoint_url else endpoint)).rstrip("/")
+
+    def object_key(self, key: str):
+        return f"{self.prefix}{key}"
+
+    def exists(self, key: str):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+            return True
+        except Exception as e:
+            # botocore raises ClientError with a 404 code for a missing object
+            if (getattr(e, "response", None) or {}).get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def put(self, key: str, fileobj: BinaryIO, content_type: Optional[str] = None):
+        # upload_fileobj reads the file in parts, and switches to a multipart upload for large images
+        extra_args = {"ContentType": content_type} if content_type else None
+        self.client.upload_fileobj(fileobj, self.bucket, self.object_key(key), ExtraArgs=extra_args)
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def url(self, key: str):
+        return f"{self.base_url}/{self.object_key(key)}"
+
+
+def staging_store_from_config(namespace: str = ""):
+    """the store configured by AP_IMAGE_STAGING, local or s3, or None when images are not relayed.
+    a namespace keeps the images of one fan-out target apart from the others, so each target evicts only its own"""
+    kind = config("AP_IMAGE_STAGING", default="").lower()
+    if kind == "local":
+        directory = config("AP_IMAGE_STAGING_DIR")
+        base_url = config("AP_IMAGE_STAGING_URL")
+        if namespace:
+            directory = os.path.join(directory, namespace)
+            base_url = f"{base_url.rstrip('/')}/{namespace}"
+        return LocalStagingStore(directory, base_url)
+    if kind == "s3":
+        prefix = config("AP_IMAGE_STAGING_PREFIX", default="")
+        return S3StagingStore(
+            config("AP_IMAGE_STAGING_BUCKET"),
+            endpoint_url=config("AP_IMAGE_STAGING_ENDPOINT", default=None),
+            base_url=config("AP_IMAGE_STAGING_URL", default=None),
+            prefix=f"{prefix}{namespace}/" if namespace else prefix,
+        )
+    if kind:
+        logger.error("Unknown AP_IMAGE_STAGING store, images will not be relayed", extra={"store": kind})
+    return None
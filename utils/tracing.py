@@ -0,0 +1,145 @@
+# Per item tracing of the ingest, written to AP_TRACE_FILE as Zipkin v2 spans, one json object per line.
+# Every feed item gets a trace when build_wires first sees it. Its root span lasts until the item is sent, fails, or
+# leaves the queue, and the fetch of a story's xml and of its associated photos, the conversion, the wait for the rate
+# limiter and the post to Migration Center are spans inside it. A story's associated photos are traced inside the
+# story's trace. Without AP_TRACE_FILE every item gets NOOP_SPAN, which records nothing.
+#
+# to look at the traces in a local zipkin (docker run -p 9411:9411 openzipkin/zipkin):
+# jq -s . traces.jsonl | curl -H "Content-Type: application/json" --data-binary @- http://localhost:9411/api/v2/spans
+import contextvars
+import os
+import threading
+import time
+
+from decouple import config
+
+from utils.json_codec import codec
+
+SERVICE_NAME = "inbound-feeds"
+
+# the span a with block is in, so a function can add spans to its caller's without being passed it
+_current = contextvars.ContextVar("span", default=None)
+
+
+class Span:
+    def __init__(self, tracer, name: str, trace_id: str, parent_id: str = None, start: float = None, tags: dict = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = time.time() if start is None else start
+        self.tags = {}
+        self.tag(**(tags or {}))
+        self.finished = False
+        self.token = None
+
+    def child(self, name: str, start: float = None, **tags):
+        """a span inside this one, started now unless start is given"""
+        return Span(self.tracer, name, self.trace_id, self.span_id, start, tags)
+
+    def tag(self, **tags):
+        # zipkin tags are strings
+        for key, value in tags.items():
+            if value is not None:
+                self.tags[key] = str(value)
+        return self
+
+    def finish(self, end: float = None, **tags):
+        """record the span, only its first finish counts"""
+        if self.finished:
+            return
+        self.finished = True
+        self.tag(**tags)
+        self.tracer.export(self, time.time() if end is None else end)
+
+    def __enter__(self):
+        self.token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self.token)
+        if exc is not None:
+            # zipkin shows a span with an error tag as failed
+            self.tag(error=str(exc) or exc_type.__name__)
+        self.finish()
+
+
+class NoopSpan:
+    """the span of every item when tracing is off"""
+
+    trace_id = span_id = parent_id = None
+    start = 0.0
+
+    def child(self, name: str, start: float = None, **tags):
+        return self
+
+    def tag(self, **tags):
+        return self
+
+    def finish(self, end: float = None, **tags):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return None
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Tracer:
+    def __init__(self, path: str, service: str = SERVICE_NAME):
+        self.path = path
+        self.service = service
+        self.lock = threading.Lock()
+
+    def start_trace(self, name: str, **tags):
+        return Span(self, name, os.urandom(16).hex(), tags=tags)
+
+    def export(self, span: Span, end: float):
+        record = {
+            "traceId": span.trace_id,
+            "id": span.span_id,
+            "name": span.name,
+            # microseconds, zipkin drops a span without a duration
+            "timestamp": int(span.start * 1_000_000),
+            "duration": max(int((end - span.start) * 1_000_000), 1),
+            "localEndpoint": {"serviceName": self.service},
+            "tags": span.tags,
+        }
+        if span.parent_id:
+            record["parentId"] = span.parent_id
+        line = codec.dumps(record) + b"\n"
+        with self.lock:
+            with open(self.path, "ab") as f:
+                f.write(line)
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """the tracer writing to AP_TRACE_FILE, shared by the process, or None when items are not traced"""
+    global _tracer
+    path = config("AP_TRACE_FILE", default="")
+    if not path:
+        return None
+    with _tracer_lock:
+        if _tracer is None or _tracer.path != path:
+            _tracer = Tracer(path, config("AP_TRACE_SERVICE_NAME", default=SERVICE_NAME))
+    return _tracer
+
+
+def start_trace(name: str, **tags):
+    """the root span of a new trace, NOOP_SPAN when tracing is off"""
+    tracer = get_tracer()
+    return tracer.start_trace(name, **tags) if tracer is not None else NOOP_SPAN
+
+
+def current_span():
+    """the span of the innermost with block, NOOP_SPAN outside of one"""
+    return _current.get() or NOOP_SPAN